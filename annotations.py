@@ -0,0 +1,267 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import torch
+
+import helpers
+
+
+# bump when the layout of the cached arrays changes, older caches are then rebuilt
+CACHE_VERSION = 1
+# bump when the format of the skip list written by validate.py changes
+SKIP_LIST_VERSION = 1
+CACHE_COLUMNS = ['image_ids', 'offsets', 'heights', 'widths', 'class_ids', 'run_offsets', 'run_starts', 'run_lengths']
+
+
+class AnnotationIndex:
+    '''
+    Columnar index of the segments in train.csv grouped by image, built once so that fetching the annotations
+    of an image does not scan the whole DataFrame.
+    The segments of the image in position idx are rows offsets[idx]:offsets[idx + 1] of the segment columns
+    (class_ids, encoded_pixels), images are kept in the order they first appear in the DataFrame, which is
+    the same order as data_df['ImageId'].unique()
+    The segments are either kept as RLE strings (encoded_pixels) or already parsed, in which case the runs of
+    segment i are run_starts[run_offsets[i]:run_offsets[i + 1]] (0-based) and the matching run_lengths
+    '''
+    def __init__(self, image_ids, offsets, heights, widths, class_ids, encoded_pixels=None, run_offsets=None, run_starts=None, run_lengths=None):
+        assert len(offsets) == len(image_ids) + 1
+        assert len(heights) == len(image_ids) and len(widths) == len(image_ids)
+        assert len(class_ids) == offsets[-1]
+        assert (encoded_pixels is None) != (run_offsets is None), "Exactly one of encoded_pixels and run_offsets is expected"
+        assert encoded_pixels is None or len(encoded_pixels) == offsets[-1]
+        assert run_offsets is None or len(run_offsets) == offsets[-1] + 1
+        self.image_ids = image_ids
+        self.offsets = offsets
+        self.heights = heights
+        self.widths = widths
+        self.class_ids = class_ids
+        self.encoded_pixels = encoded_pixels
+        self.run_offsets = run_offsets
+        self.run_starts = run_starts
+        self.run_lengths = run_lengths
+        self.positions = None
+
+    @staticmethod
+    def from_df(data_df):
+        codes, image_ids = pd.factorize(data_df['ImageId'])
+        order = np.argsort(codes, kind='stable')
+        offsets = np.zeros((len(image_ids) + 1,), dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(image_ids)), out=offsets[1:])
+        # height and width are taken from the first segment of each image
+        first_rows = order[offsets[:-1]]
+        return AnnotationIndex(
+            np.asarray(image_ids, dtype=str),
+            offsets,
+            data_df['Height'].to_numpy(dtype=np.int64)[first_rows],
+            data_df['Width'].to_numpy(dtype=np.int64)[first_rows],
+            data_df['ClassId'].to_numpy(dtype=np.int64)[order],
+            encoded_pixels=data_df['EncodedPixels'].to_numpy(dtype=object)[order])
+
+    def parse(self):
+        '''
+        return: an AnnotationIndex with the RLE strings of all the segments parsed to runs
+        '''
+        if self.run_offsets is not None:
+            return self
+        segment_ids, starts, lengths = helpers.parse_rle(self.encoded_pixels)
+        run_offsets = np.zeros((self.num_segments() + 1,), dtype=np.int64)
+        np.cumsum(np.bincount(segment_ids, minlength=self.num_segments()), out=run_offsets[1:])
+        return AnnotationIndex(self.image_ids, self.offsets, self.heights, self.widths, self.class_ids,
+                               run_offsets=run_offsets, run_starts=starts.astype(np.int32), run_lengths=lengths.astype(np.int32))
+
+    def slice(self, start, stop):
+        '''
+        return: an AnnotationIndex of the images in positions [start, stop), the columns are views of this index
+        '''
+        segment_start, segment_stop = self.offsets[start], self.offsets[stop]
+        segments = slice(segment_start, segment_stop)
+        if self.run_offsets is None:
+            return AnnotationIndex(self.image_ids[start:stop], self.offsets[start:stop + 1] - segment_start,
+                                   self.heights[start:stop], self.widths[start:stop], self.class_ids[segments],
+                                   encoded_pixels=self.encoded_pixels[segments])
+        run_start, run_stop = self.run_offsets[segment_start], self.run_offsets[segment_stop]
+        return AnnotationIndex(self.image_ids[start:stop], self.offsets[start:stop + 1] - segment_start,
+                               self.heights[start:stop], self.widths[start:stop], self.class_ids[segments],
+                               run_offsets=self.run_offsets[segment_start:segment_stop + 1] - run_start,
+                               run_starts=self.run_starts[run_start:run_stop], run_lengths=self.run_lengths[run_start:run_stop])
+
+    def take(self, positions):
+        '''
+        return: an AnnotationIndex of the images in the given positions, in that order, the columns are copies
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+        counts = self.offsets[positions + 1] - self.offsets[positions]
+        offsets = np.zeros((len(positions) + 1,), dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        segments = helpers.expand_runs(self.offsets[positions], counts)
+        if self.run_offsets is None:
+            return AnnotationIndex(self.image_ids[positions], offsets, self.heights[positions], self.widths[positions], self.class_ids[segments],
+                                   encoded_pixels=self.encoded_pixels[segments])
+        run_counts = self.run_offsets[segments + 1] - self.run_offsets[segments]
+        run_offsets = np.zeros((len(segments) + 1,), dtype=np.int64)
+        np.cumsum(run_counts, out=run_offsets[1:])
+        runs = helpers.expand_runs(self.run_offsets[segments].astype(np.int64), run_counts)
+        return AnnotationIndex(self.image_ids[positions], offsets, self.heights[positions], self.widths[positions], self.class_ids[segments],
+                               run_offsets=run_offsets, run_starts=self.run_starts[runs], run_lengths=self.run_lengths[runs])
+
+    def exclude(self, image_ids):
+        '''
+        return: an AnnotationIndex without the given images, or this index when none of them is in it
+        '''
+        keep = ~np.isin(self.image_ids, np.array(list(image_ids), dtype=str))
+        if np.all(keep):
+            return self
+        return self.take(np.flatnonzero(keep))
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def num_segments(self):
+        return len(self.class_ids)
+
+    def get_position(self, image_id):
+        if self.positions is None:
+            self.positions = {image_id: idx for idx, image_id in enumerate(self.image_ids)}
+        return self.positions[image_id]
+
+    def get_segments_slice(self, idx):
+        return slice(self.offsets[idx], self.offsets[idx + 1])
+
+    def get_height_and_width(self, idx):
+        return int(self.heights[idx]), int(self.widths[idx])
+
+    def get_num_segments(self, idx):
+        return int(self.offsets[idx + 1] - self.offsets[idx])
+
+    def get_labels(self, idx):
+        return torch.from_numpy(self.class_ids[self.get_segments_slice(idx)].astype(np.int64))
+
+    def get_runs(self, idx, target_dim=None):
+        '''
+        return: Runs of all the segments of the image in position idx, refer to helpers.get_runs
+        '''
+        height, width = self.get_height_and_width(idx)
+        segments = self.get_segments_slice(idx)
+        if self.run_offsets is None:
+            return helpers.get_runs(self.encoded_pixels[segments], height, width, target_dim)
+        run_offsets = self.run_offsets[segments.start:segments.stop + 1]
+        runs = slice(run_offsets[0], run_offsets[-1])
+        mask_ids = np.repeat(np.arange(len(run_offsets) - 1), np.diff(run_offsets))
+        return helpers.build_runs(mask_ids, self.run_starts[runs].astype(np.int64), self.run_lengths[runs].astype(np.int64),
+                                  len(run_offsets) - 1, height, width, target_dim)
+
+
+def as_annotation_index(data):
+    '''
+    given: a DataFrame in the format of train.csv or an AnnotationIndex
+    return: an AnnotationIndex of the data
+    '''
+    if isinstance(data, AnnotationIndex):
+        return data
+    return AnnotationIndex.from_df(data)
+
+
+def file_sha1(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def load_annotations(csv_path, cache_dir=None):
+    '''
+    Loads train.csv as a parsed AnnotationIndex through a binary cache of .npy files that are memory-mapped,
+    the cache is built on the first call and rebuilt when the CSV changes (mtime and size, then sha1)
+    cache_dir - defaults to the name of the CSV with a '_cache' suffix
+    Processes that load a stale cache at once (distributed ranks, data loader workers) are serialised by an flock
+    on a lock file next to the cache, the first one builds it and the others load what it built
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.splitext(csv_path)[0] + '_cache'
+    if read_cache_meta(csv_path, cache_dir) is None:
+        with open(cache_dir + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # another process may have built the cache while this one waited for the lock
+            if read_cache_meta(csv_path, cache_dir) is None:
+                print("Building annotation cache [{}] from [{}]".format(cache_dir, csv_path))
+                build_annotation_cache(csv_path, cache_dir)
+
+    columns = {column: np.load(os.path.join(cache_dir, column + '.npy'), mmap_mode='r') for column in CACHE_COLUMNS}
+    return AnnotationIndex(**columns)
+
+
+def read_cache_meta(csv_path, cache_dir):
+    '''
+    return: the meta of the annotation cache of csv_path, None when there is no cache or it is stale
+    '''
+    csv_stat = os.stat(csv_path)
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta.get('version') != CACHE_VERSION:
+            meta = None
+        elif meta['csv_mtime'] != csv_stat.st_mtime or meta['csv_size'] != csv_stat.st_size:
+            # the CSV was touched, only rebuild when its content actually changed
+            if meta['csv_size'] == csv_stat.st_size and meta['csv_sha1'] == file_sha1(csv_path):
+                meta['csv_mtime'] = csv_stat.st_mtime
+                write_json_atomic(meta_path, meta)
+            else:
+                meta = None
+    return meta
+
+
+def build_annotation_cache(csv_path, cache_dir):
+    csv_stat = os.stat(csv_path)
+    csv_sha1 = file_sha1(csv_path)
+    annotation_index = AnnotationIndex.from_df(pd.read_csv(csv_path)).parse()
+    columns = {
+        'image_ids': annotation_index.image_ids,
+        'offsets': annotation_index.offsets,
+        'heights': annotation_index.heights.astype(np.int32),
+        'widths': annotation_index.widths.astype(np.int32),
+        'class_ids': annotation_index.class_ids.astype(np.int32),
+        'run_offsets': annotation_index.run_offsets,
+        'run_starts': annotation_index.run_starts,
+        'run_lengths': annotation_index.run_lengths,
+    }
+    # the cache is written to a temporary folder and then moved in place, so a crash never leaves a partial cache
+    tmp_dir = cache_dir + '.tmp.' + str(os.getpid())
+    os.makedirs(tmp_dir)
+    for column, values in columns.items():
+        np.save(os.path.join(tmp_dir, column + '.npy'), values)
+    write_json_atomic(os.path.join(tmp_dir, 'meta.json'), {
+        'version': CACHE_VERSION,
+        'csv_mtime': csv_stat.st_mtime,
+        'csv_size': csv_stat.st_size,
+        'csv_sha1': csv_sha1,
+    })
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+
+
+def write_json_atomic(file_path, obj):
+    tmp_path = file_path + '.tmp.' + str(os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, file_path)
+
+
+def load_skip_list(skip_list_path, csv_path):
+    '''
+    csv_path - the train.csv the skip list is applied to, it must be the one that was validated, since the images a
+               changed CSV adds were not validated
+    return: the set of the ImageIds in a skip list written by validate.py
+    '''
+    with open(skip_list_path, 'r') as f:
+        skip_list = json.load(f)
+    assert skip_list.get('version') == SKIP_LIST_VERSION, "[{}] was written with version [{}], validate again".format(skip_list_path, skip_list.get('version'))
+    assert skip_list['csv_sha1'] == file_sha1(csv_path), "[{}] was written for another version of [{}], validate again".format(skip_list_path, csv_path)
+    return set(skip_list['skipped'].keys())
@@ -0,0 +1,450 @@
+import argparse
+import glob
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+from PIL import Image
+import torchvision.transforms as transforms
+
+import helpers
+
+
+parser = argparse.ArgumentParser(description='Micro benchmarks for the data pipeline')
+subparsers = parser.add_subparsers(dest='benchmark')
+
+rle_parser = subparsers.add_parser('rle', help='Compare the vectorized RLE decoder against the per-run python loop')
+rle_parser.add_argument('--height', type=int, default=3000, metavar='HEIGHT',
+                        help='Height of the synthetic images (default=3000)')
+rle_parser.add_argument('--width', type=int, default=2000, metavar='WIDTH',
+                        help='Width of the synthetic images (default=2000)')
+rle_parser.add_argument('--num-segments', type=int, default=20, metavar='NUM_SEGMENTS',
+                        help='Number of segments per synthetic image (default=20)')
+rle_parser.add_argument('--num-images', type=int, default=5, metavar='NUM_IMAGES',
+                        help='Number of synthetic images to decode (default=5)')
+rle_parser.add_argument('--target-dim', type=int, default=512, metavar='DIM',
+                        help='Dimention the masks are rescaled to by get_masks (default=512)')
+
+letterbox_parser = subparsers.add_parser('letterbox', help='Compare the tensor letterbox against the PIL thumbnail and paste rescale')
+letterbox_parser.add_argument('--height', type=int, default=3000, metavar='HEIGHT',
+                              help='Height of the synthetic images (default=3000)')
+letterbox_parser.add_argument('--width', type=int, default=2000, metavar='WIDTH',
+                              help='Width of the synthetic images (default=2000)')
+letterbox_parser.add_argument('--num-segments', type=int, default=20, metavar='NUM_SEGMENTS',
+                              help='Number of masks per synthetic image (default=20)')
+letterbox_parser.add_argument('--num-images', type=int, default=5, metavar='NUM_IMAGES',
+                              help='Number of synthetic images to rescale (default=5)')
+letterbox_parser.add_argument('--target-dim', type=int, default=512, metavar='DIM',
+                              help='Dimention the images are rescaled to (default=512)')
+
+image_load_parser = subparsers.add_parser('image-load', help='Compare full JPEG decoding against reduced (draft) decoding')
+image_load_parser.add_argument('--image-dir', type=str, default=None, metavar='DIR',
+                               help='Folder of JPEG images to load, synthetic images are generated if not given (default=None)')
+image_load_parser.add_argument('--height', type=int, default=3000, metavar='HEIGHT',
+                               help='Height of the synthetic images (default=3000)')
+image_load_parser.add_argument('--width', type=int, default=2000, metavar='WIDTH',
+                               help='Width of the synthetic images (default=2000)')
+image_load_parser.add_argument('--num-images', type=int, default=20, metavar='NUM_IMAGES',
+                               help='Maximal number of images to load (default=20)')
+image_load_parser.add_argument('--target-dim', type=int, default=512, metavar='DIM',
+                               help='Dimention the images are rescaled to (default=512)')
+
+h5_layout_parser = subparsers.add_parser('h5-layout', help='Compare H5 chunk shapes and compression filters on a synthetic dataset')
+h5_layout_parser.add_argument('--layouts', type=str, nargs='+', default=['20/none', '1/none', '1/lzf', '1/gzip', '1/gzip+shuffle', '20/gzip+shuffle'], metavar='LAYOUT',
+                              help='Layouts to compare, each is CHUNK_ROWS/COMPRESSION with an optional +shuffle suffix (default=20/none 1/none 1/lzf 1/gzip 1/gzip+shuffle 20/gzip+shuffle)')
+h5_layout_parser.add_argument('--compression-level', type=int, default=None, metavar='LEVEL',
+                              help='Level of the gzip filter 0-9, None for the h5py default (default=None)')
+h5_layout_parser.add_argument('--num-images', type=int, default=100, metavar='NUM_IMAGES',
+                              help='Number of synthetic images to write (default=100)')
+h5_layout_parser.add_argument('--num-segments', type=int, default=5, metavar='NUM_SEGMENTS',
+                              help='Number of masks per synthetic image (default=5)')
+h5_layout_parser.add_argument('--target-dim', type=int, default=512, metavar='DIM',
+                              help='Dimention of the synthetic images (default=512)')
+h5_layout_parser.add_argument('--chunk-size', type=int, default=20, metavar='CHUNK_SIZE',
+                              help='Images per writer task (default=20)')
+h5_layout_parser.add_argument('--out-dir', type=str, default=None, metavar='DIR',
+                              help='Folder for the H5 files, should be on the disk the training reads from, a temporary folder if not given (default=None)')
+
+chunk_shuffle_parser = subparsers.add_parser('chunk-shuffle', help='Compare the read amplification of a uniform shuffle and the chunk shuffle sampler on an H5 file')
+chunk_shuffle_parser.add_argument('--h5-file', type=str, default=None, metavar='FILE',
+                                  help='H5 file written by h5py_dataset_writer.py, a synthetic file is written if not given (default=None)')
+chunk_shuffle_parser.add_argument('--num-images', type=int, default=200, metavar='NUM_IMAGES',
+                                  help='Number of synthetic images to write (default=200)')
+chunk_shuffle_parser.add_argument('--chunk-rows', type=int, default=20, metavar='ROWS',
+                                  help='Images per chunk of the synthetic file (default=20)')
+chunk_shuffle_parser.add_argument('--target-dim', type=int, default=512, metavar='DIM',
+                                  help='Dimention of the synthetic images (default=512)')
+chunk_shuffle_parser.add_argument('--window-chunks', type=int, default=4, metavar='CHUNKS',
+                                  help='Shuffle window of the chunk shuffle sampler (default=4)')
+chunk_shuffle_parser.add_argument('--chunk-cache-mb', type=int, default=64, metavar='MB',
+                                  help='Size of the chunk cache of the reader (default=64)')
+chunk_shuffle_parser.add_argument('--batch-size', type=int, default=12, metavar='BATCH_SIZE',
+                                  help='Batch size the samples are read in (default=12)')
+
+
+def parse_args():
+    args = parser.parse_args()
+    if args.benchmark is None:
+        parser.error('a benchmark must be specified')
+    args_text = yaml.safe_dump(args.__dict__, default_flow_style=False)
+    return args, args_text
+
+
+def encode_rle(mask):
+    '''
+    given: a binary mask of shape (H, W)
+    return: the Kaggle RLE string of the mask (1-based starts, pixels numbered top to bottom and then left to right)
+    '''
+    pixels = np.concatenate([[0], mask.reshape(-1, order='F'), [0]])
+    edges = np.where(pixels[1:] != pixels[:-1])[0]
+    starts = edges[0::2] + 1
+    lengths = edges[1::2] - edges[0::2]
+    return ' '.join(map(str, np.stack([starts, lengths], axis=1).reshape(-1)))
+
+
+def random_image_df(image_id, height, width, num_segments, rng):
+    '''
+    return: an image df in the format of train.csv with random elliptic segments
+    '''
+    rows, cols = np.ogrid[0:height, 0:width]
+    segments = []
+    for _ in range(num_segments):
+        center_y, center_x = rng.integers(0, height), rng.integers(0, width)
+        radius_y, radius_x = rng.integers(5, height // 3), rng.integers(5, width // 3)
+        mask = ((rows - center_y) / radius_y) ** 2 + ((cols - center_x) / radius_x) ** 2 <= 1
+        segments.append(encode_rle(mask.astype(np.uint8)))
+    return pd.DataFrame({
+        'ImageId': image_id,
+        'EncodedPixels': segments,
+        'Height': height,
+        'Width': width,
+        'ClassId': rng.integers(0, 46, size=num_segments)})
+
+
+def rescale_pil(matrix, target_dim, interpolation=Image.NEAREST):
+    '''
+    The original PIL thumbnail and paste rescale, kept here as the reference implementation
+    '''
+    if isinstance(matrix, Image.Image):
+        mode = 'RGB'
+        matrix_img = matrix.copy()
+    else:
+        mode = 'L'
+        matrix_img = transforms.ToPILImage(mode=mode)(matrix.clone())
+    if target_dim:
+        orig_shape = matrix_img.size
+        ratio = float(target_dim)/max(orig_shape)
+        new_size = tuple([int(x*ratio) for x in orig_shape])
+        matrix_img.thumbnail(new_size, resample=interpolation)
+        new_im = Image.new(mode, (target_dim, target_dim))
+        new_im.paste(matrix_img, ((target_dim-new_size[0])//2, (target_dim-new_size[1])//2))
+    else:
+        new_im = matrix_img
+    trans = transforms.ToTensor()
+    if isinstance(matrix, Image.Image):
+        return trans(new_im)
+    else:
+        return trans(new_im) * 255
+
+
+def get_masks_loop(image_df, target_dim=None):
+    '''
+    The original decoder, one slice assignment per run, kept here as the reference implementation
+    '''
+    height = image_df['Height'][0]
+    width = image_df['Width'][0]
+    masks = []
+    for segment in list(image_df['EncodedPixels']):
+        mask = torch.zeros((height, width), dtype=torch.uint8).reshape(-1)
+        splitted_pixels = list(map(int, segment.split()))
+        pixel_starts = splitted_pixels[::2]
+        run_lengths = splitted_pixels[1::2]
+        assert max(pixel_starts) < mask.shape[0]
+        for pixel_start, run_length in zip(pixel_starts, run_lengths):
+            pixel_start = int(pixel_start) - 1
+            run_length = int(run_length)
+            mask[pixel_start:pixel_start + run_length] = 1
+        mask = torch.tensor(mask.numpy().reshape(height, width, order='F'), dtype=torch.uint8)
+        mask = rescale_pil(mask, target_dim).type(torch.ByteTensor)
+        masks.append(mask.squeeze())
+    return torch.stack(masks)
+
+
+def time_it(func, *args, **kwargs):
+    start = time.time()
+    res = func(*args, **kwargs)
+    return res, time.time() - start
+
+
+def benchmark_rle(args):
+    rng = np.random.default_rng(1)
+    image_dfs = [random_image_df(str(i), args.height, args.width, args.num_segments, rng) for i in range(args.num_images)]
+    decode_loop_time = 0.0
+    decode_time = 0.0
+    get_masks_loop_time = 0.0
+    get_masks_time = 0.0
+    for image_df in image_dfs:
+        masks_loop, elapsed = time_it(get_masks_loop, image_df)
+        decode_loop_time += elapsed
+        masks, elapsed = time_it(helpers.decode_rle, list(image_df['EncodedPixels']), args.height, args.width)
+        decode_time += elapsed
+        assert torch.equal(masks_loop, torch.from_numpy(masks)), "Decoded masks differ from the reference decoder"
+
+        masks_loop, elapsed = time_it(get_masks_loop, image_df, target_dim=args.target_dim)
+        get_masks_loop_time += elapsed
+        masks, elapsed = time_it(helpers.get_masks, image_df, target_dim=args.target_dim)
+        get_masks_time += elapsed
+        assert torch.equal(masks_loop, masks), "Rescaled masks differ from the reference decoder"
+
+    print("Decoded [{}] images of size [{}x{}] with [{}] segments each, results are identical".format(
+        args.num_images, args.height, args.width, args.num_segments))
+    print("Decode (full resolution) avg per image: loop [{:.4f}] vectorized [{:.4f}] speedup [{:.1f}x]".format(
+        decode_loop_time / args.num_images, decode_time / args.num_images, decode_loop_time / decode_time))
+    print("get_masks (target_dim [{}]) avg per image: loop [{:.4f}] vectorized [{:.4f}] speedup [{:.1f}x]".format(
+        args.target_dim, get_masks_loop_time / args.num_images, get_masks_time / args.num_images, get_masks_loop_time / get_masks_time))
+    print("Mask memory per image: full resolution [{:.1f} MB] decoded at target_dim [{:.1f} MB]".format(
+        args.num_segments * args.height * args.width / 2 ** 20, args.num_segments * args.target_dim ** 2 / 2 ** 20))
+
+
+def benchmark_letterbox(args):
+    rng = np.random.default_rng(1)
+    pil_image_time = 0.0
+    image_time = 0.0
+    pil_masks_time = 0.0
+    masks_time = 0.0
+    for _ in range(args.num_images):
+        image = Image.fromarray(rng.integers(0, 256, size=(args.height, args.width, 3), dtype=np.uint8))
+        masks = torch.from_numpy((rng.random((args.num_segments, args.height, args.width)) > 0.5).astype(np.uint8))
+
+        image_pil, elapsed = time_it(rescale_pil, image, args.target_dim)
+        pil_image_time += elapsed
+        image_tensor, elapsed = time_it(helpers.rescale, image, args.target_dim)
+        image_time += elapsed
+        assert torch.equal(image_pil, image_tensor), "Rescaled image differs from the PIL rescale"
+
+        masks_pil, elapsed = time_it(lambda: torch.stack([rescale_pil(mask, args.target_dim).type(torch.ByteTensor).squeeze() for mask in masks]))
+        pil_masks_time += elapsed
+        masks_tensor, elapsed = time_it(helpers.letterbox, masks, args.target_dim)
+        masks_time += elapsed
+        assert torch.equal(masks_pil, masks_tensor), "Letterboxed masks differ from the PIL rescale"
+
+    print("Rescaled [{}] images of size [{}x{}] with [{}] masks each, results are identical".format(
+        args.num_images, args.height, args.width, args.num_segments))
+    print("Image avg per image: PIL [{:.4f}] tensor [{:.4f}] speedup [{:.1f}x]".format(
+        pil_image_time / args.num_images, image_time / args.num_images, pil_image_time / image_time))
+    print("Mask stack avg per image: PIL [{:.4f}] tensor [{:.4f}] speedup [{:.1f}x]".format(
+        pil_masks_time / args.num_images, masks_time / args.num_images, pil_masks_time / masks_time))
+
+
+def write_random_jpegs(folder, num_images, height, width, rng):
+    rows, cols = np.mgrid[0:height, 0:width]
+    for i in range(num_images):
+        # smooth content compresses like a photo, unlike pure noise
+        image = np.stack([np.sin(rows / rng.uniform(20, 200)), np.cos(cols / rng.uniform(20, 200)), np.sin((rows + cols) / rng.uniform(20, 200))], axis=2)
+        image = ((image + 1) * 127.5).astype(np.uint8)
+        Image.fromarray(image).save(os.path.join(folder, '{}.jpg'.format(i)), quality=90)
+
+
+def benchmark_image_load(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_dir = args.image_dir
+        if image_dir is None:
+            image_dir = tmp_dir
+            write_random_jpegs(image_dir, args.num_images, args.height, args.width, np.random.default_rng(1))
+        image_paths = sorted(glob.glob(os.path.join(image_dir, '*.jpg')))[:args.num_images]
+        full_time = 0.0
+        reduced_time = 0.0
+        max_diff = 0.0
+        mean_diff = 0.0
+        for image_path in image_paths:
+            (image, _), elapsed = time_it(helpers.load_image, image_path, args.target_dim)
+            full_time += elapsed
+            (image_reduced, _), elapsed = time_it(helpers.load_image, image_path, args.target_dim, reduced_decode=True)
+            reduced_time += elapsed
+            diff = torch.abs(image - image_reduced) * 255
+            max_diff = max(max_diff, float(torch.max(diff)))
+            mean_diff += float(torch.mean(diff))
+
+    num_images = len(image_paths)
+    print("Loaded [{}] images".format(num_images))
+    print("Image load avg per image: full decode [{:.4f}] reduced decode [{:.4f}] speedup [{:.1f}x]".format(
+        full_time / num_images, reduced_time / num_images, full_time / reduced_time))
+    print("Pixel difference (0-255): mean [{:.2f}] max [{:.0f}]".format(mean_diff / num_images, max_diff))
+
+
+class SyntheticDataset(torch.utils.data.Dataset):
+    '''
+    Samples in the format IMATDataset returns, generated from the index so that every writer process sees the same data
+    '''
+    def __init__(self, num_images, target_dim, num_segments):
+        self.num_images = num_images
+        self.target_dim = target_dim
+        self.num_segments = num_segments
+
+    def __getitem__(self, idx):
+        rng = np.random.default_rng(idx)
+        rows, cols = np.ogrid[0:self.target_dim, 0:self.target_dim]
+        image = np.stack([np.sin(rows / rng.uniform(20, 200) + cols / rng.uniform(20, 200)) for _ in range(3)])
+        image = np.rint((image + 1) * 127.5).astype(np.uint8)
+        masks = []
+        for _ in range(self.num_segments):
+            center_y, center_x = rng.integers(0, self.target_dim, size=2)
+            radius_y, radius_x = rng.integers(5, self.target_dim // 3, size=2)
+            masks.append(((rows - center_y) / radius_y) ** 2 + ((cols - center_x) / radius_x) ** 2 <= 1)
+        masks = np.stack(masks).astype(np.uint8)
+        crops, _ = helpers.pack_masks(masks)
+        boxes = np.stack([crops[:, 1], crops[:, 0], crops[:, 1] + crops[:, 3] - 1, crops[:, 0] + crops[:, 2] - 1], axis=1)
+        target = {
+            'labels': torch.from_numpy(rng.integers(1, 47, size=self.num_segments)),
+            'masks': torch.from_numpy(masks),
+            'boxes': torch.from_numpy(boxes.astype(np.float32)),
+        }
+        return torch.from_numpy(image).float().div(255), target
+
+    def __len__(self):
+        return self.num_images
+
+
+def drop_page_cache(file_path):
+    '''
+    Best effort eviction of the file from the page cache, so that reads hit the disk as they would in a fresh epoch
+    '''
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def time_reads(file_path, order, target_dim):
+    '''
+    return: (wall seconds, cpu seconds) of reading the samples of the file in the given order with a new reader,
+            as a data loader worker does in a new epoch
+    '''
+    import imat_dataset
+
+    drop_page_cache(file_path)
+    reader = imat_dataset.DatasetH5Reader(file_path)
+    dataset = imat_dataset.IMATDatasetH5PY(reader, 46, target_dim, 'effdet', gather_statistics=False)
+    wall_start = time.time()
+    cpu_start = time.process_time()
+    for idx in order:
+        dataset[idx]
+    elapsed = time.time() - wall_start, time.process_time() - cpu_start
+    reader.close()
+    return elapsed
+
+
+def benchmark_h5_layout(args):
+    # the writer pulls in the training dependencies, so it is only imported by this benchmark
+    import h5py_dataset_writer
+
+    dataset = SyntheticDataset(args.num_images, args.target_dim, args.num_segments)
+    rng = np.random.default_rng(1)
+    random_order = rng.permutation(args.num_images)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_dir = tmp_dir if args.out_dir is None else args.out_dir
+        for layout in args.layouts:
+            chunk_rows, compression = layout.split('/')
+            shuffle_filter = compression.endswith('+shuffle')
+            compression = compression.replace('+shuffle', '')
+            file_path = os.path.join(out_dir, 'layout_{}_{}{}.hdf5'.format(chunk_rows, compression, '_shuffle' if shuffle_filter else ''))
+            writer = h5py_dataset_writer.DatasetH5Writer(dataset, args.target_dim, file_path, chunk_size=args.chunk_size, delete_existing=True,
+                                                         chunk_rows=int(chunk_rows), compression=compression,
+                                                         compression_level=args.compression_level, shuffle_filter=shuffle_filter)
+            _, write_time = time_it(writer.process)
+            writer.close()
+
+            sequential_wall, sequential_cpu = time_reads(file_path, range(args.num_images), args.target_dim)
+            random_wall, random_cpu = time_reads(file_path, random_order, args.target_dim)
+            results.append((layout, os.path.getsize(file_path) / 2 ** 20, write_time, sequential_wall, sequential_cpu, random_wall, random_cpu))
+            if args.out_dir is not None:
+                os.remove(file_path)
+
+    print("Wrote and read [{}] images of size [{}x{}] with [{}] masks each".format(
+        args.num_images, args.target_dim, args.target_dim, args.num_segments))
+    for layout, size, write_time, sequential_wall, sequential_cpu, random_wall, random_cpu in results:
+        print("Layout [{}] size [{:.1f} MB] write [{:.2f} s] sequential [{:.1f} samples/s] random [{:.1f} samples/s] cpu per sample sequential [{:.2f} ms] random [{:.2f} ms]".format(
+            layout, size, write_time,
+            args.num_images / sequential_wall, args.num_images / random_wall,
+            1000 * sequential_cpu / args.num_images, 1000 * random_cpu / args.num_images))
+
+
+def read_bytes():
+    '''
+    return: bytes this process read through read system calls, from the disk or the page cache
+    '''
+    with open('/proc/self/io', 'r') as f:
+        for line in f:
+            if line.startswith('rchar:'):
+                return int(line.split()[1])
+    return 0
+
+
+def benchmark_chunk_shuffle(args):
+    import chunk_sampler
+    import imat_dataset
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = args.h5_file
+        if file_path is None:
+            import h5py_dataset_writer
+            file_path = os.path.join(tmp_dir, 'chunk_shuffle.hdf5')
+            dataset = SyntheticDataset(args.num_images, args.target_dim, 5)
+            writer = h5py_dataset_writer.DatasetH5Writer(dataset, args.target_dim, file_path, chunk_size=args.chunk_rows, delete_existing=True,
+                                                         chunk_rows=args.chunk_rows, compression='gzip')
+            writer.process()
+            writer.close()
+
+        reader = imat_dataset.DatasetH5Reader(file_path, rdcc_nbytes=args.chunk_cache_mb * 2 ** 20)
+        num_samples = len(reader)
+        file_size = os.path.getsize(file_path)
+        samplers = [
+            ('uniform', torch.utils.data.RandomSampler(range(num_samples))),
+            ('chunk shuffle', chunk_sampler.ChunkShuffleSampler(num_samples, reader.chunk_rows, window_chunks=args.window_chunks)),
+        ]
+        results = []
+        for name, sampler in samplers:
+            order = list(sampler)
+            drop_page_cache(file_path)
+            reader = imat_dataset.DatasetH5Reader(file_path, rdcc_nbytes=args.chunk_cache_mb * 2 ** 20)
+            dataset = imat_dataset.IMATDatasetH5PY(reader, 46, reader.get_data_sets()['images'].shape[-1], 'effdet', gather_statistics=False)
+            bytes_start = read_bytes()
+            wall_start = time.time()
+            for batch_start in range(0, len(order), args.batch_size):
+                dataset.__getitems__(order[batch_start:batch_start + args.batch_size])
+            elapsed = time.time() - wall_start
+            measured = (read_bytes() - bytes_start) / float(file_size)
+            estimated = chunk_sampler.read_amplification(order, reader.chunk_rows, reader.get_cache_chunks(), args.batch_size)
+            results.append((name, measured, estimated, len(order) / elapsed))
+            reader.close()
+
+    print("Read [{}] samples in chunks of [{}] with a chunk cache of [{}] chunks".format(num_samples, reader.chunk_rows, reader.get_cache_chunks()))
+    for name, measured, estimated, throughput in results:
+        print("Sampler [{}] read amplification measured [{:.2f}x] estimated [{:.2f}x] throughput [{:.1f} samples/s]".format(
+            name, measured, estimated, throughput))
+
+
+def main():
+    args, args_text = parse_args()
+    print("Args: {}".format(args_text))
+    if args.benchmark == 'rle':
+        benchmark_rle(args)
+    elif args.benchmark == 'letterbox':
+        benchmark_letterbox(args)
+    elif args.benchmark == 'image-load':
+        benchmark_image_load(args)
+    elif args.benchmark == 'h5-layout':
+        benchmark_h5_layout(args)
+    elif args.benchmark == 'chunk-shuffle':
+        benchmark_chunk_shuffle(args)
+
+
+if __name__ == '__main__':
+    main()
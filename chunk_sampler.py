@@ -0,0 +1,84 @@
+from collections import OrderedDict
+import math
+import numpy as np
+from torch.utils.data.sampler import Sampler
+
+
+class ChunkShuffleSampler(Sampler):
+    '''
+    Shuffles the samples of a chunked dataset (e.g. an H5 file written by h5py_dataset_writer.py) so that every chunk
+    is read about once per epoch. The order of the chunks is shuffled and then the samples are shuffled within
+    windows of window_chunks consecutive chunks of that order.
+    As long as the chunk cache of the reader holds window_chunks chunks, a chunk is decompressed once per epoch instead
+    of once per sample it holds. Can be wrapped by group_by_aspect_ratio.GroupedBatchSampler like any other sampler.
+    num_samples - the length of the dataset
+    chunk_rows - number of samples in a chunk, sample i is in chunk i // chunk_rows
+    seed - when given, the order of every epoch is a function of the seed and the epoch set with set_epoch
+    '''
+    def __init__(self, num_samples, chunk_rows, window_chunks=4, seed=None):
+        assert chunk_rows > 0 and window_chunks > 0
+        self.num_samples = num_samples
+        self.chunk_rows = chunk_rows
+        self.window_chunks = window_chunks
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_order(self):
+        '''
+        return: numpy array of the sample indices of an epoch
+        '''
+        if self.seed is None:
+            rng = np.random.default_rng()
+        else:
+            rng = np.random.default_rng([self.seed, self.epoch])
+        num_chunks = math.ceil(self.num_samples / self.chunk_rows)
+        chunk_order = rng.permutation(num_chunks)
+        windows = []
+        for window_start in range(0, num_chunks, self.window_chunks):
+            chunks = chunk_order[window_start:window_start + self.window_chunks]
+            indices = (chunks[:, None] * self.chunk_rows + np.arange(self.chunk_rows)).reshape(-1)
+            windows.append(rng.permutation(indices[indices < self.num_samples]))
+        if len(windows) == 0:
+            return np.zeros((0,), dtype=np.int64)
+        return np.concatenate(windows)
+
+    def __iter__(self):
+        return iter(self.get_order().tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+def simulate_chunk_reads(order, chunk_rows, cache_chunks, batch_size=1, num_workers=1):
+    '''
+    Replays a sampling order against an LRU cache of cache_chunks chunks in every data loader worker. The batches
+    are handed to the workers round robin like the DataLoader does and a batch reads each of its chunks once,
+    like DatasetH5Reader.get_batch. HDF5 does not evict exactly in LRU order, so this is an estimate.
+    return: the number of chunks read from the file
+    '''
+    caches = [OrderedDict() for _ in range(max(num_workers, 1))]
+    chunk_reads = 0
+    for batch_idx, batch_start in enumerate(range(0, len(order), batch_size)):
+        cache = caches[batch_idx % len(caches)]
+        for chunk in np.unique(np.asarray(order[batch_start:batch_start + batch_size]) // chunk_rows):
+            if chunk in cache:
+                cache.move_to_end(chunk)
+                continue
+            chunk_reads += 1
+            cache[chunk] = True
+            if len(cache) > cache_chunks:
+                cache.popitem(last=False)
+    return chunk_reads
+
+
+def read_amplification(order, chunk_rows, cache_chunks, batch_size=1, num_workers=1):
+    '''
+    return: bytes read from the file divided by the bytes of the samples that were used, 1.0 means every chunk is
+            read once
+    '''
+    if len(order) == 0:
+        return 0.0
+    return simulate_chunk_reads(order, chunk_rows, cache_chunks, batch_size, num_workers) * chunk_rows / float(len(order))
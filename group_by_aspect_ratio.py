@@ -1,7 +1,3 @@
-import bisect
-from collections import defaultdict
-import copy
-from itertools import repeat, chain
 import math
 import numpy as np
 
@@ -14,74 +10,141 @@ import torchvision
 from PIL import Image
 
 
-def _repeat_to_at_least(iterable, n):
-    repeat_times = math.ceil(n / len(iterable))
-    repeated = chain.from_iterable(repeat(iterable, repeat_times))
-    return list(repeated)
-
-
 class GroupedBatchSampler(BatchSampler):
     """
     Wraps another sampler to yield a mini-batch of indices.
     It enforces that the batch only contain elements from the same group.
     It also tries to provide mini-batches which follows an ordering which is
     as close as possible to the ordering from the original sampler.
+    The batches of a whole epoch are planned at once with numpy: the full batches
+    of every group in the order they are completed by the sampler, then the
+    remaining elements of the largest groups padded with elements of their group,
+    so that the number of batches is len(sampler) // batch_size.
+    With num_replicas > 1 the plan is split between the ranks round robin, padded
+    with its first batches so that every rank gets the same number of batches.
+    Every rank must then see the same order, so use sampler=None with a seed or a
+    sampler that is seeded the same on every rank.
     Arguments:
-        sampler (Sampler): Base sampler.
+        sampler (Sampler): Base sampler, None to shuffle all the elements of group_ids
+            with a generator seeded by (seed, epoch).
         group_ids (list[int]): If the sampler produces indices in range [0, N),
             `group_ids` must be a list of `N` ints which contains the group id of each sample.
             The group ids must be a continuous set of integers starting from
             0, i.e. they must be in the range [0, num_groups).
         batch_size (int): Size of mini-batch.
+        num_replicas (int): Number of distributed processes.
+        rank (int): Rank of this process, in the range [0, num_replicas).
+        seed (int): Seed of the shuffle when sampler is None, None draws one that
+            state_dict records.
     """
-    def __init__(self, sampler, group_ids, batch_size):
-        if not isinstance(sampler, Sampler):
+    def __init__(self, sampler, group_ids, batch_size, num_replicas=1, rank=0, seed=None):
+        if sampler is not None and not isinstance(sampler, Sampler):
             raise ValueError(
                 "sampler should be an instance of "
                 "torch.utils.data.Sampler, but got sampler={}".format(sampler)
             )
+        assert 0 <= rank < num_replicas, "Rank [{}] is not in the range [0, {})".format(rank, num_replicas)
+        assert sampler is not None or seed is not None or num_replicas == 1, "The ranks must share the seed of the shuffle"
         self.sampler = sampler
-        self.group_ids = group_ids
+        self.group_ids = np.asarray(group_ids, dtype=np.int64)
         self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        if seed is None:
+            seed = int(np.random.SeedSequence().generate_state(1)[0])
+        self.seed = seed
+        self.epoch = 0
+        # batches of the current epoch that were already yielded, so an epoch can be resumed
+        self.position = 0
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.position = 0
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def get_order(self):
+        '''
+        return: numpy array of the indices of an epoch, as given by the sampler
+        '''
+        if self.sampler is None:
+            return np.random.default_rng([self.seed, self.epoch]).permutation(len(self.group_ids))
+        return np.fromiter(iter(self.sampler), dtype=np.int64, count=len(self.sampler))
+
+    def get_plan(self):
+        '''
+        return: (num_batches, batch_size) numpy array of the batches of all the ranks for an epoch
+        '''
+        order = self.get_order()
+        num_batches = len(order) // self.batch_size
+        groups = self.group_ids[order]
+        # the stable sort keeps the order of the sampler within every group
+        by_group = np.argsort(groups, kind='stable')
+        sorted_groups = groups[by_group]
+        group_starts = np.flatnonzero(np.concatenate([[True], sorted_groups[1:] != sorted_groups[:-1]]))
+        group_sizes = np.diff(np.concatenate([group_starts, [len(order)]]))
+        full_sizes = group_sizes // self.batch_size * self.batch_size
+        in_full_batch = np.arange(len(order)) - np.repeat(group_starts, group_sizes) < np.repeat(full_sizes, group_sizes)
+        # every group contributes a multiple of batch_size, so no row mixes groups
+        full_batches = by_group[in_full_batch].reshape(-1, self.batch_size)
+        # a batch is completed by its last element in the order of the sampler
+        full_batches = full_batches[np.argsort(full_batches[:, -1], kind='stable')]
+
+        num_remaining = num_batches - len(full_batches)
+        if num_remaining > 0:
+            # the largest remainders are completed first, ties by the position where the remainder started, which
+            # is the end of the last full batch of the group or its first element
+            remainders = group_sizes - full_sizes
+            candidates = np.flatnonzero(remainders > 0)
+            start_positions = by_group[group_starts[candidates] + np.maximum(full_sizes[candidates] - 1, 0)]
+            candidates = candidates[np.lexsort((start_positions, -remainders[candidates]))][:num_remaining]
+            # the remainder of the group followed by the first elements of the group, repeated when it is small
+            columns = np.arange(self.batch_size)
+            remainder = remainders[candidates][:, None]
+            in_group = np.where(columns < remainder, full_sizes[candidates][:, None] + columns, (columns - remainder) % group_sizes[candidates][:, None])
+            full_batches = np.concatenate([full_batches, by_group[group_starts[candidates][:, None] + in_group]])
+        return order[full_batches]
+
+    def get_batches(self):
+        '''
+        return: (len(self), batch_size) numpy array of the batches of this rank for an epoch
+        '''
+        plan = self.get_plan()
+        if len(plan) == 0:
+            return plan
+        plan = np.resize(plan, (self.__len__() * self.num_replicas, self.batch_size))
+        return plan[self.rank::self.num_replicas]
 
     def __iter__(self):
-        buffer_per_group = defaultdict(list)
-        samples_per_group = defaultdict(list)
-
-        num_batches = 0
-        for idx in self.sampler:
-            group_id = self.group_ids[idx]
-            buffer_per_group[group_id].append(idx)
-            samples_per_group[group_id].append(idx)
-            if len(buffer_per_group[group_id]) == self.batch_size:
-                yield buffer_per_group[group_id]
-                num_batches += 1
-                del buffer_per_group[group_id]
-            assert len(buffer_per_group[group_id]) < self.batch_size
-
-        # now we have run out of elements that satisfy
-        # the group criteria, let's return the remaining
-        # elements so that the size of the sampler is
-        # deterministic
-        expected_num_batches = len(self)
-        num_remaining = expected_num_batches - num_batches
-        if num_remaining > 0:
-            # for the remaining batches, take first the buffers with largest number
-            # of elements
-            for group_id, _ in sorted(buffer_per_group.items(),
-                                      key=lambda x: len(x[1]), reverse=True):
-                remaining = self.batch_size - len(buffer_per_group[group_id])
-                samples_from_group_id = _repeat_to_at_least(samples_per_group[group_id], remaining)
-                buffer_per_group[group_id].extend(samples_from_group_id[:remaining])
-                assert len(buffer_per_group[group_id]) == self.batch_size
-                yield buffer_per_group[group_id]
-                num_remaining -= 1
-                if num_remaining == 0:
-                    break
-        assert num_remaining == 0
+        batches = self.get_batches().tolist()
+        if self.position >= len(batches):
+            self.position = 0
+        for position in range(self.position, len(batches)):
+            self.position = position + 1
+            yield batches[position]
+
+    def state_dict(self):
+        '''
+        The DataLoader takes batches ahead of the training, when the number of batches the training consumed
+        is known it should replace position
+        '''
+        return {'seed': self.seed, 'epoch': self.epoch, 'position': self.position,
+                'batch_size': self.batch_size, 'num_replicas': self.num_replicas}
+
+    def load_state_dict(self, state_dict):
+        '''
+        The next iteration continues the epoch of state_dict after its first position batches
+        '''
+        assert state_dict['batch_size'] == self.batch_size and state_dict['num_replicas'] == self.num_replicas, \
+            "The batches were planned for batch size [{}] and [{}] replicas".format(state_dict['batch_size'], state_dict['num_replicas'])
+        self.seed = state_dict['seed']
+        self.set_epoch(state_dict['epoch'])
+        self.position = state_dict['position']
 
     def __len__(self):
-        return len(self.sampler) // self.batch_size
+        num_samples = len(self.group_ids) if self.sampler is None else len(self.sampler)
+        return math.ceil(num_samples // self.batch_size / self.num_replicas)
 
 
 def _compute_aspect_ratios_slow(dataset, indices=None):
@@ -128,6 +191,15 @@ def _compute_aspect_ratios_custom_dataset(dataset, indices=None):
     return aspect_ratios
 
 
+def _compute_aspect_ratios_sized_dataset(dataset, indices=None):
+    # the sizes of all the images are arrays of the dataset, no image is read
+    heights, widths = dataset.get_image_sizes()
+    aspect_ratios = np.asarray(widths, dtype=np.float64) / np.asarray(heights, dtype=np.float64)
+    if indices is not None:
+        aspect_ratios = aspect_ratios[np.asarray(indices, dtype=np.int64)]
+    return aspect_ratios.tolist()
+
+
 def _compute_aspect_ratios_coco_dataset(dataset, indices=None):
     if indices is None:
         indices = range(len(dataset))
@@ -160,6 +232,9 @@ def _compute_aspect_ratios_subset_dataset(dataset, indices=None):
 
 
 def compute_aspect_ratios(dataset, indices=None):
+    if hasattr(dataset, "get_image_sizes"):
+        return _compute_aspect_ratios_sized_dataset(dataset, indices)
+
     if hasattr(dataset, "get_height_and_width"):
         return _compute_aspect_ratios_custom_dataset(dataset, indices)
 
@@ -177,10 +252,8 @@ def compute_aspect_ratios(dataset, indices=None):
 
 
 def _quantize(x, bins):
-    bins = copy.deepcopy(bins)
-    bins = sorted(bins)
-    quantized = list(map(lambda y: bisect.bisect_right(bins, y), x))
-    return quantized
+    # same as bisect.bisect_right of every element into the sorted bins
+    return np.searchsorted(np.sort(bins), np.asarray(x, dtype=np.float64), side='right')
 
 
 def create_aspect_ratio_groups(dataset, k=0):
@@ -21,6 +21,7 @@ import joblib
 import os
 import random
 import time
+import threading
 import multiprocessing
 from multiprocessing import Process, Pool, Queue, Lock, Value
 import itertools
@@ -28,6 +29,7 @@ import importlib
 from PIL import Image
 import h5py
 import imat_dataset
+import annotations
 import argparse
 
 # imports for segmentation
@@ -45,6 +47,19 @@ import train
 import yaml
 
 
+# uint8 stores the 0-255 pixel values and is 8x smaller than float64, the reader scales it back to [0, 1]
+IMAGE_DTYPES = ['uint8', 'float16', 'float64']
+# ragged stores only the real instances of every image, each mask cropped to its box and bit packed,
+# dense is the older layout of MAX_DENSE_INSTANCES full size masks per image
+MASK_LAYOUTS = ['ragged', 'dense']
+MAX_DENSE_INSTANCES = 75
+# rows per HDF5 chunk of the per instance datasets of the ragged layout
+INSTANCE_CHUNK_SIZE = 256
+COMPRESSIONS = ['none', 'gzip', 'lzf']
+# bump when the content of the manifest changes
+MANIFEST_VERSION = 1
+
+
 parser = argparse.ArgumentParser(description='Training Config')
 
 parser.add_argument('--chunk-size', type=int, default=20, metavar='CHUNK_SIZE',
@@ -55,6 +70,26 @@ parser.add_argument('--target-dim', type=int, default=512, metavar='DIM',
                     help='Dimention of the images. It is vital that the image size will be devisiable by 2 at least 6 times (default=512)')
 parser.add_argument('--delete-existing', type=bool, default=False, metavar='BOOL',
                     help='Delete existing H5PY files, if False will only add more data to the file (default=False)')
+parser.add_argument('--image-dtype', type=str, default='uint8', choices=IMAGE_DTYPES, metavar='DTYPE',
+                    help='Storage type of the images, one of {} (default=uint8)'.format(IMAGE_DTYPES))
+parser.add_argument('--num-workers', type=int, default=None, metavar='NUM_WORKERS',
+                    help='Number of processes that prepare the chunks, None for the CPU count minus one (default=None)')
+parser.add_argument('--max-pending-chunks', type=int, default=None, metavar='CHUNKS',
+                    help='Maximal number of chunks that are prepared or wait to be written at once, bounds the memory of the writer, None for twice the workers (default=None)')
+parser.add_argument('--num-shards', type=int, default=0, metavar='NUM_SHARDS',
+                    help='Write the dataset as this many shard files in parallel, one process per shard, plus an index file that is read like a single file. 0 writes a single file (default=0)')
+parser.add_argument('--chunk-rows', type=int, default=None, metavar='ROWS',
+                    help='Images per HDF5 chunk of the per image datasets, 1 makes every sample a chunk of its own so a random read does not pull its neighbours, None to use the chunk size (default=None)')
+parser.add_argument('--instance-chunk-rows', type=int, default=INSTANCE_CHUNK_SIZE, metavar='ROWS',
+                    help='Instances per HDF5 chunk of the per instance datasets of the ragged mask layout (default={})'.format(INSTANCE_CHUNK_SIZE))
+parser.add_argument('--compression', type=str, default='none', choices=COMPRESSIONS, metavar='FILTER',
+                    help='HDF5 compression filter, one of {} (default=none)'.format(COMPRESSIONS))
+parser.add_argument('--compression-level', type=int, default=None, metavar='LEVEL',
+                    help='Level of the gzip filter 0-9, None for the h5py default (default=None)')
+parser.add_argument('--shuffle-filter', type=train.str2bool, default=False, metavar='BOOL',
+                    help='Apply the HDF5 byte shuffle filter before compression (default=False)')
+parser.add_argument('--mask-layout', type=str, default='ragged', choices=MASK_LAYOUTS, metavar='LAYOUT',
+                    help='Storage layout of the instance masks and boxes, one of {} (default=ragged)'.format(MASK_LAYOUTS))
 
 
 def parse_args():
@@ -67,157 +102,505 @@ def parse_args():
 
 
 class DatasetH5Writer(torch.utils.data.Dataset):
-    def __init__(self, dataset, target_dim, out_file, chunk_size, delete_existing):
+    def __init__(self, dataset, target_dim, out_file, chunk_size, delete_existing, image_dtype='uint8', mask_layout='ragged',
+                 chunk_rows=None, instance_chunk_rows=INSTANCE_CHUNK_SIZE, compression='none', compression_level=None, shuffle_filter=False,
+                 index_range=None):
+        '''
+        index_range - (start, stop) range of the dataset indices to write, the whole dataset if None
+        The images that are written are recorded by their ImageId in the image_keys dataset and in a manifest next
+        to the file (out_file + '.manifest.json') that is updated after every chunk is flushed. Opening an existing
+        file truncates whatever was written after the last manifest update and only the images that are not in the
+        file yet are written, so an interrupted build resumes where it stopped and a grown train.csv only adds its
+        new images. Images that could not be processed are listed in the manifest as skipped and are tried again
+        every time the writer runs, since the failure may have been transient.
+        A file that holds images that are no longer in the dataset, or no longer in the position they were written
+        from, is not appended to. This is the test file after a grown train.csv moved the split between the training
+        and the test set, appending would keep training images in it.
+        '''
         super(DatasetH5Writer, self).__init__()
         self.dataset = dataset
-        self.dataset_len = self.dataset.__len__()
+        self.first_idx, self.dataset_len = (0, self.dataset.__len__()) if index_range is None else index_range
         self.chunk_size = chunk_size
         self.target_dim = target_dim
         self.file_name = out_file
         self.cpu_count = multiprocessing.cpu_count()
         self.delete_existing = delete_existing
+        # chunk_size is the number of images a worker processes at once, chunk_rows is the HDF5 chunk shape
+        self.chunk_rows = chunk_size if chunk_rows is None else chunk_rows
+        self.instance_chunk_rows = instance_chunk_rows
+        assert compression in COMPRESSIONS, "Unsupported compression [{}]".format(compression)
+        self.filters = {
+            'compression': None if compression == 'none' else compression,
+            'compression_opts': compression_level if compression == 'gzip' else None,
+            'shuffle': shuffle_filter,
+        }
+        self.manifest_file = self.file_name + '.manifest.json'
         requires_init = False
         if os.path.exists(self.file_name):
             if self.delete_existing:
                 os.remove(self.file_name)
-                requires_init
+                requires_init = True
         else:
-            requires_init
+            requires_init = True
+        if requires_init and os.path.exists(self.manifest_file):
+            os.remove(self.manifest_file)
         
         self.h5py_file = h5py.File(self.file_name, "a")
         if requires_init:
-            self.image_ids_data_set = self.h5py_file.create_dataset("image_ids", shape=(0,), dtype=np.uint64, maxshape=(None,), chunks=(self.chunk_size,))
-            self.images_data_set = self.h5py_file.create_dataset("images", shape=(0,3,self.target_dim,self.target_dim), dtype=np.float64, maxshape=(None,3,self.target_dim,self.target_dim), chunks=(self.chunk_size,3,self.target_dim,self.target_dim))
-            dt = h5py.vlen_dtype(np.dtype('int64'))
-            self.labels_data_set = self.h5py_file.create_dataset("labels", shape=(0,), maxshape=(None,), dtype=dt, chunks=(self.chunk_size,))
-            self.masks_data_set = self.h5py_file.create_dataset("masks", shape=(0,75,self.target_dim,self.target_dim), maxshape=(None,75,512,512), dtype=np.uint8, chunks=(self.chunk_size,75,self.target_dim,self.target_dim))
-            self.boxes_data_set = self.h5py_file.create_dataset("boxes", shape=(0,75,4), maxshape=(None,75,4), dtype=np.float64, chunks=(self.chunk_size,75,4))
+            self.image_ids_data_set = self.create_data_set("image_ids", (), np.uint64, self.chunk_rows)
+            self.create_data_set("image_keys", (), h5py.string_dtype(), self.chunk_rows)
+            assert image_dtype in IMAGE_DTYPES, "Unsupported image dtype [{}]".format(image_dtype)
+            self.images_data_set = self.create_data_set("images", (3,self.target_dim,self.target_dim), np.dtype(image_dtype), self.chunk_rows)
+            self.labels_data_set = self.create_data_set("labels", (), h5py.vlen_dtype(np.dtype('int64')), self.chunk_rows)
+            # the size of the original image, so the readers have the aspect ratios without decoding any image
+            self.create_data_set("heights", (), np.int32, self.chunk_rows)
+            self.create_data_set("widths", (), np.int32, self.chunk_rows)
+            self.create_data_set("instance_counts", (), np.int32, self.chunk_rows)
+            assert mask_layout in MASK_LAYOUTS, "Unsupported mask layout [{}]".format(mask_layout)
+            self.h5py_file.attrs['mask_layout'] = mask_layout
+            if mask_layout == 'ragged':
+                # the instances of image i are rows instance_starts[i]:instance_starts[i] + instance_counts[i]
+                self.create_data_set("instance_starts", (), np.int64, self.chunk_rows)
+                self.create_data_set("instance_boxes", (4,), np.float32, self.instance_chunk_rows)
+                self.create_data_set("mask_crops", (4,), np.int32, self.instance_chunk_rows)
+                self.create_data_set("mask_bits", (), h5py.vlen_dtype(np.dtype('uint8')), self.instance_chunk_rows)
+            else:
+                self.create_data_set("masks", (MAX_DENSE_INSTANCES,self.target_dim,self.target_dim), np.uint8, self.chunk_rows)
+                self.create_data_set("boxes", (MAX_DENSE_INSTANCES,4), np.float64, self.chunk_rows)
         else:
             self.image_ids_data_set = self.h5py_file['image_ids']
             self.images_data_set = self.h5py_file['images']
             self.labels_data_set = self.h5py_file['labels']
-            self.masks_data_set = self.h5py_file['masks']
-            self.boxes_data_set = self.h5py_file['boxes']
 
-        self.start_idx = self.images_data_set.shape[0]
-        if self.start_idx != 0:
+        # appending to an existing file keeps the layout it was created with, files without the attribute are dense
+        self.mask_layout = self.h5py_file.attrs.get('mask_layout', 'dense')
+        if self.mask_layout != mask_layout:
+            print("File [{}] stores masks as [{}], ignoring the requested [{}]".format(self.file_name, self.mask_layout, mask_layout))
+
+        # appending to an existing file keeps the type it was created with
+        self.image_dtype = self.images_data_set.dtype
+        if self.image_dtype != np.dtype(image_dtype):
+            print("File [{}] stores images as [{}], ignoring the requested [{}]".format(self.file_name, self.image_dtype, image_dtype))
+
+        if self.images_data_set.shape[0] != 0:
             assert self.target_dim == self.images_data_set.shape[-2]
 
-        assert self.start_idx not in self.image_ids_data_set
+        self.manifest = self.repair()
+        # only the written images are done, the skipped ones are retried
+        file_keys = [key.decode() for key in self.h5py_file['image_keys'][:]]
+        self.done_keys = set(file_keys)
+        dataset_positions = {self.get_image_key(idx): idx for idx in range(self.first_idx, self.dataset_len)}
+        stale_keys = [key for key, idx in zip(file_keys, self.image_ids_data_set[:]) if dataset_positions.get(key) != int(idx)]
+        assert len(stale_keys) == 0, "File [{}] has [{}] images that are no longer in the dataset in the position they were written from, e.g. [{}], the data or its split changed, write it again with --delete-existing".format(
+            self.file_name, len(stale_keys), stale_keys[0])
+        self.todo_indices = [idx for idx in range(self.first_idx, self.dataset_len) if self.get_image_key(idx) not in self.done_keys]
+        if len(self.done_keys) > 0:
+            print("File [{}] has [{}] images, [{}] images left to write of which [{}] were skipped before".format(
+                self.file_name, self.images_data_set.shape[0], len(self.todo_indices), len(self.manifest['skipped'])))
+
+    def get_image_key(self, idx):
+        '''
+        return: the ImageId of the sample in index idx, or the index itself for datasets without image ids
+        '''
+        image_ids = getattr(self.dataset, 'image_ids', None)
+        if image_ids is None:
+            return str(idx)
+        return str(image_ids[idx])
+
+    def get_image_sizes(self, indices):
+        '''
+        return: (heights, widths) of the original images in the given dataset indices, the letterboxed size for
+                datasets that do not know the original size
+        '''
+        sizes = np.full((len(indices), 2), self.target_dim, dtype=np.int32)
+        if hasattr(self.dataset, 'get_height_and_width'):
+            for i, idx in enumerate(indices):
+                sizes[i] = self.dataset.get_height_and_width(int(idx))
+        return sizes[:, 0], sizes[:, 1]
+
+    def get_data_set_names(self):
+        '''
+        return: (names of the datasets with a row per image, names of the datasets with a row per instance)
+        '''
+        image_names = ['image_ids', 'image_keys', 'images', 'labels', 'heights', 'widths', 'instance_counts']
+        if self.mask_layout == 'ragged':
+            return image_names + ['instance_starts'], ['instance_boxes', 'mask_crops', 'mask_bits']
+        return image_names + ['masks', 'boxes'], []
+
+    def repair(self):
+        '''
+        Truncates the datasets to the images and instances the manifest committed, rows past them are the partial
+        tail of an interrupted append. Files without a manifest are trusted up to their shortest dataset.
+        return: the manifest
+        '''
+        image_names, instance_names = self.get_data_set_names()
+        if 'image_keys' not in self.h5py_file:
+            # files written before the image keys were recorded identify their images by dataset index
+            image_keys = self.create_data_set("image_keys", (), h5py.string_dtype(), self.chunk_rows)
+            image_keys.resize(self.image_ids_data_set.shape[0], axis=0)
+            image_keys[:] = [self.get_image_key(idx) for idx in self.image_ids_data_set[:]]
+        if 'heights' not in self.h5py_file:
+            # files written before the image sizes were recorded get them from the annotations
+            heights, widths = self.get_image_sizes(self.image_ids_data_set[:])
+            for name, values in [('heights', heights), ('widths', widths)]:
+                data_set = self.create_data_set(name, (), np.int32, self.chunk_rows)
+                data_set.resize(len(values), axis=0)
+                data_set[:] = values
+        if 'instance_counts' not in self.h5py_file:
+            # only the ragged layout recorded the instance counts, the labels of the dense layout have one per instance
+            instance_counts = self.create_data_set("instance_counts", (), np.int32, self.chunk_rows)
+            instance_counts.resize(self.labels_data_set.shape[0], axis=0)
+            instance_counts[:] = [len(labels) for labels in self.labels_data_set[:]]
+
+        manifest = None
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('version') != MANIFEST_VERSION:
+                manifest = None
+        if manifest is None:
+            committed_images = min(self.h5py_file[name].shape[0] for name in image_names)
+            committed_instances = 0
+            if len(instance_names) > 0 and committed_images > 0:
+                committed_instances = int(self.h5py_file['instance_starts'][committed_images - 1] + self.h5py_file['instance_counts'][committed_images - 1])
+            manifest = {
+                'version': MANIFEST_VERSION,
+                'committed_images': committed_images,
+                'committed_instances': committed_instances,
+                'chunks': [[0, committed_images]] if committed_images > 0 else [],
+                'skipped': [],
+            }
+
+        for names, committed in [(image_names, manifest['committed_images']), (instance_names, manifest['committed_instances'])]:
+            for name in names:
+                data_set = self.h5py_file[name]
+                assert data_set.shape[0] >= committed, "Dataset [{}] is shorter than the manifest of [{}]".format(name, self.file_name)
+                if data_set.shape[0] > committed:
+                    print("Truncating [{}] of [{}] from [{}] to the [{}] committed rows".format(name, self.file_name, data_set.shape[0], committed))
+                    data_set.resize(committed, axis=0)
+        self.h5py_file.flush()
+        annotations.write_json_atomic(self.manifest_file, manifest)
+        return manifest
+
+    def commit(self, row_start, row_stop, image_keys, skipped_keys):
+        '''
+        Records the rows that were just appended in the manifest, after they are flushed to the file
+        image_keys - the keys of the images of the rows, they are no longer skipped when they were before
+        skipped_keys - the keys of the images of the chunk that could not be processed
+        '''
+        self.h5py_file.flush()
+        self.manifest['committed_images'] = row_stop
+        if self.mask_layout == 'ragged':
+            self.manifest['committed_instances'] = self.h5py_file['instance_boxes'].shape[0]
+        if row_stop > row_start:
+            self.manifest['chunks'].append([row_start, row_stop])
+        written = set(image_keys)
+        skipped = [key for key in self.manifest['skipped'] if key not in written and key not in skipped_keys]
+        self.manifest['skipped'] = skipped + skipped_keys
+        annotations.write_json_atomic(self.manifest_file, self.manifest)
+
+    def create_data_set(self, name, row_shape, dtype, chunk_rows):
+        '''
+        Creates an empty resizable dataset of rows of shape row_shape, chunked chunk_rows rows at a time
+        '''
+        filters = self.filters
+        if h5py.check_vlen_dtype(np.dtype(dtype)) is not None:
+            # the filters would only apply to the references of variable length rows and not to their data
+            filters = {}
+        return self.h5py_file.create_dataset(name, shape=(0,) + row_shape, maxshape=(None,) + row_shape, dtype=dtype,
+                                             chunks=(chunk_rows,) + row_shape, **filters)
 
     def append_to_h5py(self, result):
-        chunk_size, images_np, image_ids_np, labels_numpy_list, masks_numpy_fixed_size, boxes_numpy_fixed_size = result
+        chunk_size, images_np, image_ids_np, labels_numpy_list, instances, skipped_ids = result
         assert images_np.shape[0] == chunk_size
-        assert len(masks_numpy_fixed_size) == chunk_size
+        assert len(labels_numpy_list) == chunk_size
         assert len(image_ids_np) == chunk_size
-
-        self.h5py_file = h5py.File(self.file_name, "a")
-
+        image_keys = [self.get_image_key(idx) for idx in image_ids_np]
+        skipped_keys = [self.get_image_key(idx) for idx in skipped_ids]
+        assert self.done_keys.isdisjoint(image_keys), "Some image was written twice"
+        self.done_keys.update(image_keys)
         curr_len = self.images_data_set.shape[0]
+        if chunk_size == 0:
+            # every image of the chunk was skipped
+            self.commit(curr_len, curr_len, image_keys, skipped_keys)
+            return
+
         self.images_data_set.resize(curr_len + chunk_size, axis=0)
         self.images_data_set[-chunk_size:] = images_np
 
         self.image_ids_data_set.resize(curr_len + chunk_size, axis=0)
         self.image_ids_data_set[-chunk_size:] = image_ids_np
 
+        image_keys_data_set = self.h5py_file['image_keys']
+        image_keys_data_set.resize(curr_len + chunk_size, axis=0)
+        image_keys_data_set[-chunk_size:] = image_keys
+
         self.labels_data_set.resize(curr_len + chunk_size, axis=0)
         for i, labels_numpy in enumerate(labels_numpy_list):
             self.labels_data_set[curr_len + i] = labels_numpy
 
-        self.masks_data_set.resize(curr_len + chunk_size, axis=0)
-        self.masks_data_set[-chunk_size:] = masks_numpy_fixed_size
+        heights, widths = self.get_image_sizes(image_ids_np)
+        instance_counts = np.array([len(labels_numpy) for labels_numpy in labels_numpy_list], dtype=np.int32)
+        for name, values in [('heights', heights), ('widths', widths), ('instance_counts', instance_counts)]:
+            data_set = self.h5py_file[name]
+            data_set.resize(curr_len + chunk_size, axis=0)
+            data_set[-chunk_size:] = values
 
-        self.boxes_data_set.resize(curr_len + chunk_size, axis=0)
-        self.boxes_data_set[-chunk_size:] = boxes_numpy_fixed_size
+        if self.mask_layout == 'ragged':
+            self.append_ragged_instances(curr_len, chunk_size, *instances)
+        else:
+            self.append_dense_instances(curr_len, chunk_size, *instances)
+        self.commit(curr_len, curr_len + chunk_size, image_keys, skipped_keys)
         print("Dataset [{}] size is [{}]".format(self.file_name, self.images_data_set.shape[0]))
 
+    def append_dense_instances(self, curr_len, chunk_size, masks_numpy_fixed_size, boxes_numpy_fixed_size):
+        masks_data_set = self.h5py_file['masks']
+        masks_data_set.resize(curr_len + chunk_size, axis=0)
+        masks_data_set[-chunk_size:] = masks_numpy_fixed_size
+
+        boxes_data_set = self.h5py_file['boxes']
+        boxes_data_set.resize(curr_len + chunk_size, axis=0)
+        boxes_data_set[-chunk_size:] = boxes_numpy_fixed_size
+
+    def append_ragged_instances(self, curr_len, chunk_size, instance_counts, boxes, crops, bits):
+        num_instances = self.h5py_file['instance_boxes'].shape[0]
+        instance_starts = num_instances + np.concatenate([[0], np.cumsum(instance_counts)[:-1]])
+        # the instance counts are appended with the other per image datasets
+        starts_data_set = self.h5py_file['instance_starts']
+        starts_data_set.resize(curr_len + chunk_size, axis=0)
+        starts_data_set[-chunk_size:] = instance_starts
+
+        chunk_instances = len(crops)
+        if chunk_instances == 0:
+            return
+        for name, values in [('instance_boxes', boxes), ('mask_crops', crops)]:
+            data_set = self.h5py_file[name]
+            data_set.resize(num_instances + chunk_instances, axis=0)
+            data_set[-chunk_instances:] = values
+        bits_data_set = self.h5py_file['mask_bits']
+        bits_data_set.resize(num_instances + chunk_instances, axis=0)
+        if len(set(len(instance_bits) for instance_bits in bits)) == 1:
+            # h5py takes arrays of a single length as one 2D array that does not fit the rows, they are written one by one
+            for i, instance_bits in enumerate(bits):
+                bits_data_set[num_instances + i] = instance_bits
+            return
+        packed = np.empty((chunk_instances,), dtype=object)
+        packed[:] = bits
+        bits_data_set[-chunk_instances:] = packed
+
     @staticmethod
-    def tensor_list_to_numpy(tensor_list):
-        num_of_tensors = len(tensor_list)
-        if num_of_tensors == 0:
-            return np.array([])
-        tensor_shape = tensor_list[0].shape
-        for i, _ in enumerate(tensor_list):
-            tensor_list[i] = tensor_list[i].unsqueeze(0)
-
-        res_tensor = torch.Tensor(num_of_tensors, *tensor_shape)
-        torch.cat(tensor_list, out=res_tensor)
-        return res_tensor.numpy()
-    
+    def images_to_storage(images_numpy, image_dtype):
+        '''
+        images_numpy - float images in the range [0, 1] as returned by IMATDataset
+        '''
+        if image_dtype == np.uint8:
+            # the images are decoded from 8 bit pixels, so this is lossless
+            return np.rint(images_numpy * 255).astype(np.uint8)
+        return images_numpy.astype(image_dtype)
+
     @staticmethod
-    def process_chunk(dataset, start_idx, chunk_size, target_dim):
-        dataset_len = dataset.__len__()
-        curr_chunk_size = 0
+    def process_chunk(dataset, chunk_indices, target_dim, image_dtype, mask_layout):
+        '''
+        chunk_indices - the dataset indices of the images of the chunk
+        '''
         images = []
         image_ids = []
+        skipped_ids = []
         labels_numpy_list = []
         masks_numpy_list = []
         boxes_numpy_list = []
-        for _ in range(chunk_size):
-            idx = start_idx + curr_chunk_size
-            image, target = dataset.__getitem__(idx)
+        for idx in chunk_indices:
+            sample = dataset.__getitem__(idx)
+            if sample is None:
+                print("Skipping image on index [{}] since it could not be processed".format(idx))
+                skipped_ids.append(idx)
+                continue
+            image, target = sample
             if len(target["labels"]) == 0:
                 print("Skipping image on index [{}] since it has empty labels".format(idx))
+                skipped_ids.append(idx)
                 continue
             images.append(image)
             image_ids.append(idx)
             labels_numpy_list.append(target["labels"].numpy())
             masks_numpy_list.append(target["masks"].numpy())
             boxes_numpy_list.append(target["boxes"].numpy())
-            curr_chunk_size += 1
-            if start_idx + curr_chunk_size == dataset_len:
-                break
-        images_numpy = DatasetH5Writer.tensor_list_to_numpy(images)
-        image_ids_numpy = np.array(image_ids)
-        masks_numpy_fixed_size = np.zeros((curr_chunk_size, 75, target_dim, target_dim), dtype=np.uint8)
-        for i, masks_numpy in enumerate(masks_numpy_list):
-            for j, mask in enumerate(masks_numpy):
-                masks_numpy_fixed_size[i, j, :, :] = mask
-        boxes_numpy_fixed_size = np.zeros((curr_chunk_size, 75, 4), dtype=np.float64)
-        for i, boxes_numpy in enumerate(boxes_numpy_list):
-            for j, box in enumerate(boxes_numpy):
-                boxes_numpy_fixed_size[i, j, :] = box
-        return (curr_chunk_size, images_numpy, image_ids_numpy, labels_numpy_list, masks_numpy_fixed_size, boxes_numpy_fixed_size)
-
-    def process(self, debug=False):
-        print("CPU count is [{}]".format(self.cpu_count))
+        curr_chunk_size = len(images)
+        if curr_chunk_size == 0:
+            images_numpy = np.zeros((0, 3, target_dim, target_dim), dtype=image_dtype)
+        else:
+            images_numpy = DatasetH5Writer.images_to_storage(torch.stack(images).numpy(), image_dtype)
+        image_ids_numpy = np.array(image_ids, dtype=np.uint64)
+        instance_counts = np.array([len(labels_numpy) for labels_numpy in labels_numpy_list], dtype=np.int32)
+        if mask_layout == 'ragged':
+            boxes = np.zeros((0, 4), dtype=np.float32)
+            crops = np.zeros((0, 4), dtype=np.int32)
+            bits = []
+            if curr_chunk_size > 0:
+                boxes = np.concatenate(boxes_numpy_list).astype(np.float32)
+                crops, bits = helpers.pack_masks(np.concatenate(masks_numpy_list))
+            instances = (instance_counts, boxes, crops, bits)
+        else:
+            assert curr_chunk_size == 0 or instance_counts.max() <= MAX_DENSE_INSTANCES, "Image has [{}] instances, use the ragged mask layout".format(instance_counts.max())
+            masks_numpy_fixed_size = np.zeros((curr_chunk_size, MAX_DENSE_INSTANCES, target_dim, target_dim), dtype=np.uint8)
+            boxes_numpy_fixed_size = np.zeros((curr_chunk_size, MAX_DENSE_INSTANCES, 4), dtype=np.float64)
+            for i, (masks_numpy, boxes_numpy) in enumerate(zip(masks_numpy_list, boxes_numpy_list)):
+                masks_numpy_fixed_size[i, :len(masks_numpy)] = masks_numpy
+                boxes_numpy_fixed_size[i, :len(boxes_numpy)] = boxes_numpy
+            instances = (masks_numpy_fixed_size, boxes_numpy_fixed_size)
+        return (curr_chunk_size, images_numpy, image_ids_numpy, labels_numpy_list, instances, skipped_ids)
+
+    def get_chunks(self):
+        '''
+        return: the dataset indices of the images of every chunk that is left to write
+        '''
+        return [self.todo_indices[i:i + self.chunk_size] for i in range(0, len(self.todo_indices), self.chunk_size)]
+
+    def generate_chunks(self, pending_chunks, stop):
+        '''
+        Generates the indices of every chunk, blocking while max_pending_chunks chunks are processed or waiting
+        to be written, so that finished chunks do not pile up in memory when the workers are faster than the writes
+        '''
+        for chunk_indices in self.get_chunks():
+            pending_chunks.acquire()
+            if stop.is_set():
+                return
+            yield chunk_indices
+
+    def process(self, debug=False, num_workers=None, max_pending_chunks=None):
+        '''
+        num_workers - number of processes that prepare the chunks, defaults to the number of CPUs minus one for this process,
+                      0 prepares the chunks in this process
+        max_pending_chunks - maximal number of chunks that are processed or wait to be written, defaults to twice the workers
+        '''
+        if num_workers is None:
+            num_workers = max(self.cpu_count - 1, 1)
+        if max_pending_chunks is None:
+            max_pending_chunks = 2 * num_workers
+        count_chunks = len(self.get_chunks())
+        if num_workers == 0:
+            print("Started writing [{}]...".format(self.file_name))
+            for count_chunks_done, chunk_indices in enumerate(self.get_chunks()):
+                self.append_to_h5py(DatasetH5Writer.process_chunk(self.dataset, chunk_indices, self.target_dim, self.image_dtype, self.mask_layout))
+                print("Processed chunks [{}/{}]".format(count_chunks_done + 1, count_chunks))
+            self.h5py_file.flush()
+            print("File [{}] completed.".format(self.file_name))
+            return
+
+        print("CPU count is [{}], using [{}] workers".format(self.cpu_count, num_workers))
         print("Started writing [{}]...".format(self.file_name))
-        pool = multiprocessing.Pool(self.cpu_count - 1)
-        queue = multiprocessing.Queue()
-        idx = self.start_idx
-        results = []
-        count_chunks = 0
-        while idx < self.dataset_len:
-            res = pool.apply_async(DatasetH5Writer.process_chunk, (self.dataset, idx, self.chunk_size, self.target_dim), callback=queue.put)
-            idx += self.chunk_size
-            count_chunks += 1
-            if debug:
-                results.append(res)
-        if debug:
-            for res in results:
-                res.wait()
-                print(res)
-                print(res.get())
-        pool.close()
-    
-        count_chunks_done = 0
-        while count_chunks > 0 and True:
-            if not queue.empty():
-                print("Approx. queue size [{}]".format(queue.qsize()))
+
+        # the dataset is handed to every worker once, the tasks are only the indices of the chunks
+        pending_chunks = threading.BoundedSemaphore(max_pending_chunks)
+        stop = threading.Event()
+        pool = multiprocessing.Pool(num_workers, initializer=init_worker,
+                                    initargs=(self.dataset, self.target_dim, self.image_dtype, self.mask_layout))
+        try:
+            count_chunks_done = 0
+            # the pool feeds the tasks from a thread of its own, so the generator blocking on the semaphore does not block this loop
+            for result in pool.imap_unordered(process_chunk_in_worker, self.generate_chunks(pending_chunks, stop)):
+                self.append_to_h5py(result)
+                pending_chunks.release()
                 count_chunks_done += 1
-                self.append_to_h5py(queue.get())
+                if debug:
+                    print("Chunk of [{}] images with image ids {}".format(result[0], result[2]))
                 print("Processed chunks [{}/{}]".format(count_chunks_done, count_chunks))
-                if count_chunks_done == count_chunks:
+            pool.close()
+        except BaseException:
+            # let the task generator return so the pool can shut down
+            stop.set()
+            for _ in range(max_pending_chunks):
+                try:
+                    pending_chunks.release()
+                except ValueError:
                     break
-                    
-        pool.join()
-        assert len(self.image_ids_data_set) == len(np.unique(self.image_ids_data_set)), "Some index was written twice"
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        self.h5py_file.flush()
         print("File [{}] completed.".format(self.file_name))
             
     def close(self):
         self.h5py_file.close()
 
 
+# state of a writer worker process, set once by init_worker instead of sending the dataset with every task
+worker_state = None
+
+
+def init_worker(dataset, target_dim, image_dtype, mask_layout):
+    global worker_state
+    worker_state = (dataset, target_dim, image_dtype, mask_layout)
+
+
+def process_chunk_in_worker(chunk_indices):
+    dataset, target_dim, image_dtype, mask_layout = worker_state
+    return DatasetH5Writer.process_chunk(dataset, chunk_indices, target_dim, image_dtype, mask_layout)
+
+
+def shard_file_name(out_file, shard, num_shards):
+    base, ext = os.path.splitext(out_file)
+    return "{}.shard-{:03d}-of-{:03d}{}".format(base, shard, num_shards, ext)
+
+
+def shard_ranges(dataset_len, chunk_size, num_shards):
+    '''
+    return: a list of (start, stop) index ranges that split the dataset to num_shards contiguous parts of whole chunks
+    '''
+    num_chunks = math.ceil(dataset_len / chunk_size)
+    bounds = [min(math.ceil(num_chunks * shard / num_shards) * chunk_size, dataset_len) for shard in range(num_shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# state of a shard writer process, set once by init_shard_worker
+shard_worker_state = None
+
+
+def init_shard_worker(dataset, target_dim, chunk_size, delete_existing, writer_kwargs):
+    global shard_worker_state
+    shard_worker_state = (dataset, target_dim, chunk_size, delete_existing, writer_kwargs)
+
+
+def write_shard(shard_file, index_range):
+    dataset, target_dim, chunk_size, delete_existing, writer_kwargs = shard_worker_state
+    writer = DatasetH5Writer(dataset, target_dim, shard_file, chunk_size, delete_existing, index_range=index_range, **writer_kwargs)
+    writer.process(num_workers=0)
+    length = writer.images_data_set.shape[0]
+    writer.close()
+    return length
+
+
+def write_shards(dataset, target_dim, out_file, chunk_size, num_shards, delete_existing, **writer_kwargs):
+    '''
+    Writes the dataset as num_shards files that are written in parallel, every process prepares and appends the
+    chunks of its own shard, so no single process writes the whole dataset.
+    out_file is then written as a small index of the shards that DatasetH5Reader reads like a single file.
+    writer_kwargs - arguments of DatasetH5Writer such as image_dtype and compression
+    '''
+    ranges = shard_ranges(dataset.__len__(), chunk_size, num_shards)
+    shard_files = [shard_file_name(out_file, shard, num_shards) for shard in range(num_shards)]
+    print("Started writing [{}] shards of [{}]...".format(num_shards, out_file))
+    with multiprocessing.Pool(num_shards, initializer=init_shard_worker, initargs=(dataset, target_dim, chunk_size, delete_existing, writer_kwargs)) as pool:
+        shard_lengths = pool.starmap(write_shard, zip(shard_files, ranges))
+    write_shard_index(out_file, shard_files, shard_lengths)
+    print("File [{}] completed with [{}] images in [{}] shards.".format(out_file, sum(shard_lengths), num_shards))
+
+
+def write_shard_index(out_file, shard_files, shard_lengths):
+    '''
+    The index holds the names of the shards relative to its folder and their lengths, it is written to a temporary
+    file and moved in place so a reader never sees a partial index
+    '''
+    tmp_file = out_file + '.tmp.' + str(os.getpid())
+    with h5py.File(tmp_file, "w") as h5py_file:
+        h5py_file.attrs['layout'] = 'sharded'
+        h5py_file.create_dataset("shard_files", data=[os.path.basename(shard_file) for shard_file in shard_files], dtype=h5py.string_dtype())
+        h5py_file.create_dataset("shard_lengths", data=np.array(shard_lengths, dtype=np.int64))
+    os.replace(tmp_file, out_file)
+
+
 def main():
     args, args_text = parse_args()
     print("Args: {}".format(args_text))
@@ -225,15 +608,24 @@ def main():
     main_folder_path = '../'
     num_classes, train_df, test_df, categories_df = train.process_data(main_folder_path, args.data_limit)
 
+    writer_kwargs = dict(
+        image_dtype=args.image_dtype,
+        mask_layout=args.mask_layout,
+        chunk_rows=args.chunk_rows,
+        instance_chunk_rows=args.instance_chunk_rows,
+        compression=args.compression,
+        compression_level=args.compression_level,
+        shuffle_filter=args.shuffle_filter)
+
     dataset_test = imat_dataset.IMATDataset(main_folder_path, test_df, num_classes, args.target_dim, "effdet", False, T.get_transform(train=False), gather_statistics=False)
-    h5_test_writer = DatasetH5Writer(dataset_test, args.target_dim, "../imaterialist_test_" + str(args.target_dim) + ".hdf5", chunk_size=args.chunk_size, delete_existing=args.delete_existing)
-    h5_test_writer.process()
-    h5_test_writer.close()
-
-    dataset = imat_dataset.IMATDataset(main_folder_path, train_df, num_classes, args.target_dim, False, "effdet", T.get_transform(train=False), gather_statistics=False)
-    h5_writer = DatasetH5Writer(dataset, args.target_dim, "../imaterialist_" + str(args.target_dim) + ".hdf5", chunk_size=args.chunk_size, delete_existing=args.delete_existing)
-    h5_writer.process()
-    h5_writer.close()
+    dataset = imat_dataset.IMATDataset(main_folder_path, train_df, num_classes, args.target_dim, "effdet", False, T.get_transform(train=False), gather_statistics=False)
+    for data_set, out_file in [(dataset_test, "../imaterialist_test_" + str(args.target_dim) + ".hdf5"), (dataset, "../imaterialist_" + str(args.target_dim) + ".hdf5")]:
+        if args.num_shards > 0:
+            write_shards(data_set, args.target_dim, out_file, args.chunk_size, args.num_shards, args.delete_existing, **writer_kwargs)
+            continue
+        h5_writer = DatasetH5Writer(data_set, args.target_dim, out_file, chunk_size=args.chunk_size, delete_existing=args.delete_existing, **writer_kwargs)
+        h5_writer.process(num_workers=args.num_workers, max_pending_chunks=args.max_pending_chunks)
+        h5_writer.close()
 
     print("All done.")
 
@@ -1,90 +1,290 @@
 import time 
+import math
+from collections import namedtuple
 import pandas as pd
 import numpy as np
 import cv2
 import torch
 from PIL import Image
-import torchvision.transforms as transforms
 
 
-def rescale(matrix, target_dim, pad_color=0, interpolation=Image.NEAREST):
-    mode = None
+def rescale(matrix, target_dim, pad_color=0, interpolation=Image.NEAREST, geometry=None):
+    '''
+    given: an RGB PIL image or a uint8 mask tensor of shape (H, W)
+    geometry - optional letterbox geometry to use instead of the one computed from the size of matrix,
+               refer to letterbox_geometry
+    return: the letterboxed image as a float tensor of shape (3, target_dim, target_dim) in the range [0, 1],
+            or the letterboxed mask as a float tensor of shape (1, target_dim, target_dim)
+    '''
     if isinstance(matrix, Image.Image):
-        mode = 'RGB'
-        matrix_img = matrix.copy()
+        matrix_img = matrix if matrix.mode == 'RGB' else matrix.convert('RGB')
+        if target_dim:
+            # resizing before the conversion to a tensor avoids copying the full resolution pixels out of PIL,
+            # the rest of the letterbox (padding and placement) is done on the small tensor
+            if geometry is None:
+                geometry = letterbox_geometry(matrix_img.height, matrix_img.width, target_dim)
+            matrix_img = matrix_img.resize((geometry[1], geometry[0]), resample=interpolation, reducing_gap=2.0)
+        matrix_tensor = torch.from_numpy(np.array(matrix_img)).permute(2, 0, 1)
     else:
-        mode = 'L'
-        matrix_img = transforms.ToPILImage(mode=mode)(matrix.clone())
+        matrix_tensor = matrix.unsqueeze(0)
 
     if target_dim:
-        orig_shape = matrix_img.size  # old_size[0] is in (width, height) format
-
-        ratio = float(target_dim)/max(orig_shape)
-        new_size = tuple([int(x*ratio) for x in orig_shape])
-        # thumbnail is a in-place operation
-        matrix_img.thumbnail(new_size, resample=interpolation)
+        matrix_tensor = letterbox(matrix_tensor, target_dim, pad_color=pad_color, interpolation=interpolation, geometry=geometry)
 
-        # create a new image and paste the resized image on it
-        new_im = Image.new(mode, (target_dim, target_dim))
-        new_im.paste(matrix_img, ((target_dim-new_size[0])//2, (target_dim-new_size[1])//2))
-    else:
-        new_im = matrix_img
-    
-    trans = transforms.ToTensor()
     if isinstance(matrix, Image.Image):
-        return trans(new_im)
+        return matrix_tensor.contiguous().float().div(255)  # same as transforms.ToTensor
     else:
-        return trans(new_im) * 255  # TODO(ofekp): note that masks will get this
+        return matrix_tensor.float()  # TODO(ofekp): note that masks will get this
+
+
+def load_image(image_path, target_dim, reduced_decode=False, interpolation=Image.NEAREST):
+    '''
+    Loads an image and letterboxes it to target_dim
+    reduced_decode - for JPEG images, let libjpeg decode the image at 1/2, 1/4 or 1/8 scale (DCT scaling) using
+                     the largest reduction that keeps the image at least as large as its letterboxed size, the final
+                     resize and the offsets are still computed from the original size. The result is not identical
+                     to a full decode since the reduced decode averages pixels instead of sampling them
+    return: (image, orig_size) where image is a float tensor of shape (3, target_dim, target_dim) and orig_size is
+            the (width, height) of the original image
+    '''
+    image = Image.open(image_path)
+    orig_size = image.size
+    geometry = None
+    if target_dim and reduced_decode and image.format == 'JPEG':
+        geometry = letterbox_geometry(image.height, image.width, target_dim)
+        image.draft('RGB', (geometry[1], geometry[0]))
+    return rescale(image.convert('RGB'), target_dim, interpolation=interpolation, geometry=geometry), orig_size
 
 
 def get_labels(image_df):
     return torch.as_tensor(list(image_df['ClassId']), dtype=torch.int64)
 
 
-def get_masks(image_df, target_dim=None):
+def parse_rle(segments):
+    '''
+    given: a list of Kaggle RLE strings, each in the format "start length start length ..." with 1-based starts
+    return: (mask_ids, starts, lengths) flat int64 arrays holding the runs of all the segments,
+            starts are converted to 0-based indices
+    '''
+    runs = [np.fromstring(segment, dtype=np.int64, sep=' ') for segment in segments]
+    mask_ids = np.repeat(np.arange(len(runs)), [len(run) // 2 for run in runs])
+    runs = np.concatenate(runs) if len(runs) > 0 else np.zeros((0,), dtype=np.int64)
+    return mask_ids, runs[0::2] - 1, runs[1::2]
+
+
+def expand_runs(starts, lengths):
+    '''
+    given: flat arrays of run starts and run lengths
+    return: the flat indices covered by the runs, expanded with a cumulative sum instead of a python loop per run
+    '''
+    run_ends = np.cumsum(lengths)
+    return np.arange(run_ends[-1] if len(run_ends) > 0 else 0) + np.repeat(starts - run_ends + lengths, lengths)
+
+
+def _round_aspect(number, key):
+    return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+
+def letterbox_geometry(height, width, target_dim):
+    '''
+    Mirrors the thumbnail and paste calls done by rescale
+    return: (resized_height, resized_width, top, left) the size of the resized content and its offset in the
+            (target_dim, target_dim) canvas
+    '''
+    ratio = float(target_dim) / max(width, height)
+    new_width, new_height = int(width * ratio), int(height * ratio)
+    top, left = (target_dim - new_height) // 2, (target_dim - new_width) // 2
+    if new_width >= width and new_height >= height:
+        # thumbnail never enlarges an image, the offsets are still computed from the enlarged size
+        return height, width, top, left
+    # thumbnail rounds the size so that it best preserves the aspect ratio, this is the same computation PIL does
+    aspect = width / height
+    if new_width / new_height >= aspect:
+        new_width = _round_aspect(new_height * aspect, key=lambda n: abs(aspect - n / new_height))
+    else:
+        new_height = _round_aspect(new_width / aspect, key=lambda n: 0 if n == 0 else abs(aspect - new_width / n))
+    return new_height, new_width, top, left
+
+
+def nearest_indices(src_len, dst_len):
+    '''
+    return: for each of the dst_len output pixels, the index of the source pixel sampled by a PIL NEAREST resize,
+            the coordinate is accumulated in double precision the same way PIL does it so the result is identical
+    '''
+    scale = src_len / dst_len
+    steps = np.full((dst_len,), scale)
+    steps[0] = scale * 0.5
+    return np.add.accumulate(steps).astype(np.int64)
+
+
+INTERPOLATION_MODES = {
+    Image.NEAREST: 'nearest',
+    Image.BILINEAR: 'bilinear',
+    Image.BICUBIC: 'bicubic',
+}
+
+
+def letterbox(matrix, target_dim, pad_color=0, interpolation=Image.NEAREST, geometry=None):
+    '''
+    Resizes a uint8 tensor of shape (..., H, W), e.g. a (N, H, W) mask stack or a (3, H, W) image, in one call
+    and pastes it in the middle of a (target_dim, target_dim) canvas filled with pad_color.
+    With the default NEAREST interpolation the result is identical to the PIL thumbnail and paste rescale used to do.
+    geometry - optional (resized_height, resized_width, top, left) to use instead of the one computed from the
+               size of matrix, refer to letterbox_geometry
+    return: uint8 tensor of shape (..., target_dim, target_dim)
+    '''
+    matrix = torch.as_tensor(matrix)
+    height, width = matrix.shape[-2:]
+    if geometry is None:
+        geometry = letterbox_geometry(height, width, target_dim)
+    resized_height, resized_width, top, left = geometry
+
+    if (resized_height, resized_width) == (height, width):
+        resized = matrix
+    elif interpolation == Image.NEAREST:
+        rows = nearest_indices(height, resized_height)
+        cols = nearest_indices(width, resized_width)
+        resized = torch.from_numpy(np.take(np.take(matrix.numpy(), rows, axis=-2), cols, axis=-1))
+    else:
+        assert interpolation in INTERPOLATION_MODES, "Unsupported interpolation [{}]".format(interpolation)
+        resized = torch.nn.functional.interpolate(
+            matrix.reshape(-1, 1, height, width).float(),
+            size=(resized_height, resized_width),
+            mode=INTERPOLATION_MODES[interpolation],
+            align_corners=False,
+            antialias=True)
+        resized = resized.round().clamp(0, 255).type(matrix.dtype).reshape(*matrix.shape[:-2], resized_height, resized_width)
+
+    canvas = torch.full((*matrix.shape[:-2], target_dim, target_dim), pad_color, dtype=matrix.dtype)
+    canvas[..., top:top + resized_height, left:left + resized_width] = resized[..., :target_dim - top, :target_dim - left]
+    return canvas
+
+
+Runs = namedtuple('Runs', ['mask_ids', 'starts', 'lengths', 'num_masks', 'height', 'width', 'top', 'left', 'canvas_dim'])
+Runs.__doc__ = '''
+Runs of all the masks of an image, numbered top to bottom and then left to right in a (height, width) grid
+that is placed at (top, left) in a canvas of shape canvas_dim
+'''
+
+
+def get_runs(segments, height, width, target_dim=None):
+    '''
+    given: a list of Kaggle RLE strings of a single image and the image height and width
+    return: Runs of the masks, if target_dim is given the runs are mapped onto the letterboxed (target_dim, target_dim)
+            grid with the same nearest neighbour sampling rescale uses, without materializing the full resolution masks
+    '''
+    mask_ids, starts, lengths = parse_rle(segments)
+    return build_runs(mask_ids, starts, lengths, len(segments), height, width, target_dim)
+
+
+def build_runs(mask_ids, starts, lengths, num_masks, height, width, target_dim=None):
+    '''
+    Same as get_runs for runs that were already parsed, refer to parse_rle
+    '''
+    num_pixels = height * width
+    assert len(starts) == 0 or np.max(starts) < num_pixels
+    # a run can not spill over to the next mask
+    lengths = np.clip(lengths, 0, num_pixels - starts)
+    if not target_dim:
+        return Runs(mask_ids, starts, lengths, num_masks, height, width, 0, 0, (height, width))
+
+    resized_height, resized_width, top, left = letterbox_geometry(height, width, target_dim)
+    rows = nearest_indices(height, resized_height)
+    cols = nearest_indices(width, resized_width)
+    # the source pixels sampled by the resize, in the order they appear in the resized mask
+    sampled = (cols[:, None] * height + rows[None, :]).reshape(-1)
+    resized_starts = np.searchsorted(sampled, starts)
+    resized_lengths = np.searchsorted(sampled, starts + lengths) - resized_starts
+    return Runs(mask_ids, resized_starts, resized_lengths, num_masks, resized_height, resized_width, top, left, (target_dim, target_dim))
+
+
+def decode_runs(runs):
+    '''
+    given: Runs as returned by get_runs
+    return: numpy uint8 array of shape (N, *canvas_dim) with all the binary masks, decoded in one pass
+    '''
+    num_pixels = runs.height * runs.width
+    # pixels are numbered top to bottom and then left to right, so each mask is decoded transposed (Fortran order)
+    masks = np.zeros((runs.num_masks, runs.width, runs.height), dtype=np.uint8)
+    masks.reshape(-1)[expand_runs(runs.mask_ids * num_pixels + runs.starts, runs.lengths)] = 1
+    masks = masks.transpose(0, 2, 1)
+    if runs.canvas_dim == (runs.height, runs.width):
+        return np.ascontiguousarray(masks)
+    canvas = np.zeros((runs.num_masks, *runs.canvas_dim), dtype=np.uint8)
+    canvas_height, canvas_width = runs.canvas_dim
+    canvas[:, runs.top:runs.top + runs.height, runs.left:runs.left + runs.width] = masks[:, :canvas_height - runs.top, :canvas_width - runs.left]
+    return canvas
+
+
+def decode_rle(segments, height, width, target_dim=None):
+    '''
+    given: a list of Kaggle RLE strings of a single image and the image height and width
+    return: numpy uint8 array of shape (N, height, width), or (N, target_dim, target_dim) if target_dim is given
+    '''
+    return decode_runs(get_runs(segments, height, width, target_dim))
+
+
+def get_image_runs(image_df, target_dim=None):
     '''
     given: the image df from the train_df or test_df
-    return: binary masks as a list
+    return: Runs of all the segments of the image, refer to get_runs
     '''
-    segments = list(image_df['EncodedPixels'])
-    class_ids = list(image_df['ClassId'])
-    
     height = image_df['Height'][0]
     width = image_df['Width'][0]
-    masks = []
-
-    for segment, class_id in zip(segments, class_ids):
-        # initialize empty mask
-        mask = torch.zeros((height, width), dtype=torch.uint8).reshape(-1)
-
-        # iterate over encoded pixels to create the mask for this segment
-        splitted_pixels = list(map(int, segment.split()))
-        pixel_starts = splitted_pixels[::2]
-        run_lengths = splitted_pixels[1::2]
-        assert max(pixel_starts) < mask.shape[0]
-        for pixel_start, run_length in zip(pixel_starts, run_lengths):
-            pixel_start = int(pixel_start) - 1
-            run_length = int(run_length)
-            mask[pixel_start:pixel_start + run_length] = 1
-
-        # TODO(ofekp): try to find how to do this without first converting to numpy
-        mask = torch.tensor(mask.numpy().reshape(height, width, order='F'), dtype=torch.uint8)
-        mask = rescale(mask, target_dim).type(torch.ByteTensor)  # masks should have dtype=torch.uint8
-        mask = mask.squeeze()
-        masks.append(mask)
+    return get_runs(list(image_df['EncodedPixels']), height, width, target_dim)
+
+
+def get_masks(image_df, target_dim=None):
+    '''
+    given: the image df from the train_df or test_df
+    return: binary masks as a tensor of shape (N, H, W), decoded directly at target_dim
+    '''
+    masks = torch.from_numpy(decode_runs(get_image_runs(image_df, target_dim)))
 
     # there is a chance that the mask will be all zeros after the rescale if the object was too small
     # do not skip inserting bad masks, they will be filtered lated by remove_empty_masks
-    count_bad = 0
-    for mask in masks:
-        assert torch.min(mask) >= 0
-        assert torch.max(mask) <= 1
-        if torch.max(mask) != 1.0:
-            count_bad += 1
+    count_bad = int(torch.sum(torch.amax(masks, dim=(1, 2)) != 1))
     if count_bad > 0:
         image_id = image_df['ImageId'].iloc[0]
         #print('ERROR: Image [{}] contains [{}] segments that were erased due to rescaling with target_dim [{}]'.format(image_id, count_bad, target_dim))
-    return torch.stack(masks)
+    return masks
+
+
+def get_boxes_from_runs(runs):
+    '''
+    Computes the same boxes get_bounding_boxes computes on the decoded masks, from the runs of all the masks at once
+    given: Runs as returned by get_runs
+    return: (boxes, area, keep) boxes in (x_left, y_top, x_right, y_bottom) format with zeros for empty masks,
+            the area of each box and a boolean tensor of the instances remove_empty_masks should keep
+    '''
+    boxes = np.zeros((runs.num_masks, 4), dtype=np.float32)
+    non_empty = runs.lengths > 0
+    mask_ids = runs.mask_ids[non_empty]
+    run_firsts = runs.starts[non_empty]
+    run_lasts = run_firsts + runs.lengths[non_empty] - 1
+    col_firsts = run_firsts // runs.height
+    col_lasts = run_lasts // runs.height
+    # a run that wraps to the next column covers the bottom of its first column and the top of its last one
+    wraps = col_firsts != col_lasts
+    row_firsts = np.where(wraps, 0, run_firsts % runs.height)
+    row_lasts = np.where(wraps, runs.height - 1, run_lasts % runs.height)
+
+    has_runs = np.zeros((runs.num_masks,), dtype=bool)
+    has_runs[mask_ids] = True
+    x_left = np.full((runs.num_masks,), np.iinfo(np.int64).max)
+    y_top = np.full((runs.num_masks,), np.iinfo(np.int64).max)
+    x_right = np.zeros((runs.num_masks,), dtype=np.int64)
+    y_bottom = np.zeros((runs.num_masks,), dtype=np.int64)
+    np.minimum.at(x_left, mask_ids, col_firsts)
+    np.minimum.at(y_top, mask_ids, row_firsts)
+    np.maximum.at(x_right, mask_ids, col_lasts)
+    np.maximum.at(y_bottom, mask_ids, row_lasts)
+    boxes[has_runs] = np.stack([x_left + runs.left, y_top + runs.top, x_right + runs.left, y_bottom + runs.top], axis=1)[has_runs]
+
+    boxes = torch.from_numpy(boxes)
+    area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
+    keep = torch.from_numpy(has_runs) & (boxes[:, 3] > boxes[:, 1]) & (boxes[:, 2] > boxes[:, 0])
+    return boxes, area, keep
 
 
 def get_bounding_boxes(image_df, masks):
@@ -115,7 +315,14 @@ def get_bounding_boxes(image_df, masks):
     return torch.as_tensor(bounding_boxes, dtype=torch.float32)
 
 
-def remove_empty_masks(labels, masks, bounding_boxes):
+def remove_empty_masks(labels, masks, bounding_boxes, keep=None):
+    '''
+    keep - optional boolean tensor of the instances to keep, as returned by get_boxes_from_runs,
+           when given the masks and boxes are not scanned again
+    '''
+    if keep is not None:
+        return labels[keep], masks[keep], bounding_boxes[keep]
+
     indices_to_keep_masks = []  # empty array with 1 dim
     idx = 0
     for mask in masks:
@@ -136,6 +343,67 @@ def remove_empty_masks(labels, masks, bounding_boxes):
     return labels[indices_to_keep], masks[indices_to_keep], bounding_boxes[indices_to_keep]
 
 
+def pack_masks(masks):
+    '''
+    Crops every binary mask to the rows and columns it covers and bit packs the crop
+    given: masks - numpy array of shape (num_masks, height, width)
+    return: (crops, bits) crops is an int32 array of (y_top, x_left, crop_height, crop_width) per mask and bits is
+            a list with the packed crop of each mask (row major, as np.packbits), empty masks get an empty crop
+    '''
+    num_masks = masks.shape[0]
+    rows = masks.any(axis=2)
+    cols = masks.any(axis=1)
+    non_empty = rows.any(axis=1)
+    y_top = np.argmax(rows, axis=1)
+    x_left = np.argmax(cols, axis=1)
+    crop_height = np.where(non_empty, masks.shape[1] - np.argmax(rows[:, ::-1], axis=1) - y_top, 0)
+    crop_width = np.where(non_empty, masks.shape[2] - np.argmax(cols[:, ::-1], axis=1) - x_left, 0)
+    crops = np.stack([y_top, x_left, crop_height, crop_width], axis=1).astype(np.int32)
+    bits = []
+    for i in range(num_masks):
+        y, x, h, w = crops[i]
+        bits.append(np.packbits(masks[i, y:y + h, x:x + w] != 0))
+    return crops, bits
+
+
+def unpack_masks(crops, bits, height, width):
+    '''
+    Inverse of pack_masks
+    return: uint8 numpy array of shape (num_masks, height, width)
+    '''
+    masks = np.zeros((len(crops), height, width), dtype=np.uint8)
+    for i, (y, x, h, w) in enumerate(crops):
+        if h > 0 and w > 0:
+            masks[i, y:y + h, x:x + w] = np.unpackbits(bits[i], count=h * w).reshape(h, w)
+    return masks
+
+
+ENCODED_IMAGE_FORMATS = {'jpeg': '.jpg', 'png': '.png'}
+
+
+def encode_image(image, image_format, jpeg_quality=95):
+    '''
+    Compresses a letterboxed image so it can be stored as a few tens of KB instead of the decoded pixels
+    given: image - uint8 numpy array of shape (3, height, width) in RGB order
+    return: uint8 numpy array with the bytes of the encoded image
+    '''
+    params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality] if image_format == 'jpeg' else []
+    # cv2 expects height x width x channels in BGR order
+    success, encoded = cv2.imencode(ENCODED_IMAGE_FORMATS[image_format], np.ascontiguousarray(image[::-1].transpose(1, 2, 0)), params)
+    assert success, "Could not encode image as [{}]".format(image_format)
+    return encoded.reshape(-1)
+
+
+def decode_image(encoded):
+    '''
+    Inverse of encode_image
+    return: uint8 numpy array of shape (3, height, width) in RGB order
+    '''
+    image = cv2.imdecode(np.asarray(encoded), cv2.IMREAD_COLOR)
+    assert image is not None, "Could not decode image"
+    return np.ascontiguousarray(image.transpose(2, 0, 1)[::-1])
+
+
 # def worker(q, lock, counter, x):
 #     time.sleep(3.0 / x)
 #     q.put(x*x)
@@ -1,117 +1,174 @@
+import hashlib
+import io
+import itertools
+import json
+import os
+import tarfile
 import time
-import multiprocessing
-from multiprocessing import Process, Pool, Queue, Lock, Value
 import helpers
+import numpy as np
 import torch
 import h5py
 from torch.utils.data import Dataset as BaseDataset
-from PIL import Image
 import common
+import annotations
+import stage_timer
+
+
+# bump when a change of IMATDataset changes the samples it returns, so cached samples are not reused
+PREPROCESSING_VERSION = 1
 
 
 class IMATDataset(BaseDataset):
-    def __init__(self, main_folder_path, data_df, num_classes, target_dim, model_name, is_colab, transforms=None, gather_statistics=True):
+    def __init__(self, main_folder_path, data_df, num_classes, target_dim, model_name, is_colab, transforms=None, gather_statistics=True, reduced_decode=False, sample_cache=None, shared_store=None, skip_list=None, debug=False):
+        '''
+        data_df - DataFrame in the format of train.csv, or an annotations.AnnotationIndex built from it
+        skip_list - ImageIds to exclude, e.g. annotations.load_skip_list of the output of validate.py
+        debug - check every sample (binary masks, no NaN boxes, label range), validate.py runs these checks once
+                on the whole dataset instead
+        reduced_decode - decode JPEG images at a reduced scale when possible, refer to helpers.load_image
+        sample_cache - a sample_cache.DiskSampleCache for the decoded samples, so only the first epoch decodes them
+        shared_store - a sample_cache.SharedSampleStore that shares the decoded samples with the other processes of
+                       the machine, it is consulted before the sample cache
+        '''
         self.main_folder_path = main_folder_path
-        self.data_df = data_df
+        self.annotations = annotations.as_annotation_index(data_df)
+        if skip_list is not None:
+            num_images = len(self.annotations)
+            self.annotations = self.annotations.exclude(skip_list)
+            print("Excluded [{}] of [{}] images that are in the skip list".format(num_images - len(self.annotations), num_images))
+        self.debug = debug
         self.num_classes = num_classes
         self.target_dim = target_dim
         self.is_colab = is_colab
         self.transforms = transforms
         self.model_name = model_name
-        self.image_ids = data_df['ImageId'].unique()
+        self.reduced_decode = reduced_decode
+        self.sample_cache = sample_cache
+        self.shared_store = shared_store
+        self.image_ids = self.annotations.image_ids
         # TODO: indices = torch.randperm(len(dataset)).tolist()
         self.skipped_images = []
         self.gather_statistics = gather_statistics
         if self.gather_statistics:
-            self.lock = Lock()
-            self.images_processed = Value('i', 0)
-            self.total_transform_time = Value('f', 0.0)
-            self.total_mask_time = Value('f', 0.0)
-            self.total_box_time = Value('f', 0.0)
-            self.total_process_time = Value('f', 0.0)
-            self.total_image_load_time = Value('f', 0.0)
-
-    def inc_by(self, lock, counter, val):
-        lock.acquire()
-        try:
-            counter.value += val
-        finally:
-            lock.release()
-        
+            self.stats = stage_timer.StageTimer(['process', 'shared', 'cache', 'image_load', 'mask', 'box', 'transform'])
+
     def show_stats(self):
-        images_processed = self.images_processed.value
-        total_process_time = self.total_process_time.value
-        avg_time_per_image = 0 if images_processed == 0 else total_process_time / images_processed
-        avg_image_load_time = 0 if images_processed == 0 else self.total_image_load_time.value / images_processed
-        avg_transform_time = 0 if images_processed == 0 else self.total_transform_time.value / images_processed
-        avg_mask_time = 0 if images_processed == 0 else self.total_mask_time.value / images_processed
-        avg_box_time = 0 if images_processed == 0 else self.total_box_time.value / images_processed
-        print("Processed [{}] images in [{}] seconds"
-              " Avg per image [{}]"
-              " Avg image load time [{}]"
-              " Avg transform time [{}]"
-              " Avg mask time [{}]"
-              " Avg box time [{}]"
-              .format(
-            images_processed,
-            total_process_time,
-            avg_time_per_image,
-            avg_image_load_time,
-            avg_transform_time,
-            avg_mask_time,
-            avg_box_time))
-    
-    def __getitem__(self, idx):
         if self.gather_statistics:
-            start = time.time()
+            self.stats.show_stats('process')
+
+    def get_cache_key(self, image_id):
+        return (image_id, self.target_dim, 'v' + str(PREPROCESSING_VERSION), 'reduced' if self.reduced_decode else 'full')
+
+    @staticmethod
+    def sample_to_arrays(sample):
+        image, image_orig_size, labels, masks, boxes, area = sample
+        # the image was decoded from 8 bit pixels, so storing it as 8 bit is lossless
+        return dict(image=np.rint(image.numpy() * 255).astype(np.uint8), image_orig_size=np.array(image_orig_size), labels=labels.numpy(),
+                    masks=masks.numpy(), boxes=boxes.numpy(), area=area.numpy())
+
+    @staticmethod
+    def sample_from_arrays(arrays):
+        image = torch.from_numpy(arrays['image']).float().div(255)  # same as transforms.ToTensor
+        return (image, tuple(arrays['image_orig_size'].tolist()), torch.from_numpy(arrays['labels']), torch.from_numpy(arrays['masks']),
+                torch.from_numpy(arrays['boxes']), torch.from_numpy(arrays['area']))
+
+    def load_sample(self, idx):
+        '''
+        Returns the decoded image and annotations of a sample, none of which depends on the transforms, from the
+        shared store or the sample cache when they hold it, otherwise decodes it and adds it to both
+        return: (image, image_orig_size, labels, masks, boxes, area) or None when the sample could not be processed
+        '''
+        key = self.get_cache_key(self.image_ids[idx])
+        for store, stage in [(self.shared_store, 'shared'), (self.sample_cache, 'cache')]:
+            if store is None:
+                continue
+            store_start_ts = time.time()
+            arrays = store.get(key)
+            if arrays is None:
+                continue
+            if store is self.sample_cache and self.shared_store is not None:
+                self.shared_store.put(key, **arrays)
+            if self.gather_statistics:
+                self.stats.record(stage, time.time() - store_start_ts)
+            return IMATDataset.sample_from_arrays(arrays)
+
+        sample = self.decode_sample(idx)
+        stores = [store for store in [self.shared_store, self.sample_cache] if store is not None]
+        if sample is not None and len(stores) > 0:
+            arrays = IMATDataset.sample_to_arrays(sample)
+            for store in stores:
+                store.put(key, **arrays)
+        return sample
+
+    def decode_sample(self, idx):
+        '''
+        return: (image, image_orig_size, labels, masks, boxes, area) or None when the sample could not be processed
+        '''
         image_id = self.image_ids[idx]
-        vis_df = self.data_df[self.data_df['ImageId'] == image_id]
-        vis_df = vis_df.reset_index(drop=True)
-        labels = helpers.get_labels(vis_df)
+        labels = self.annotations.get_labels(idx)
         mask_start_ts = time.time()
         try:
-            masks = helpers.get_masks(vis_df, target_dim=self.target_dim)
-            for mask in masks:
-                assert not torch.any(torch.isnan(mask))
-                assert torch.where(mask > 0)[0].shape[0] == torch.sum(mask)  # check only ones and zeros
+            runs = self.annotations.get_runs(idx, target_dim=self.target_dim)
+            masks = torch.from_numpy(helpers.decode_runs(runs))
+            if self.debug:
+                for mask in masks:
+                    assert not torch.any(torch.isnan(mask))
+                    assert torch.where(mask > 0)[0].shape[0] == torch.sum(mask)  # check only ones and zeros
         except Exception as e:
             self.skipped_images.append(image_id)
             print("ERROR: Skipped image with id [{}] due to a mask exception [{}]".format(image_id, e))
             return
         if self.gather_statistics:
-            self.inc_by(self.lock, self.total_mask_time, time.time() - mask_start_ts)
+            self.stats.record('mask', time.time() - mask_start_ts)
         
         box_start_ts = time.time()
-        boxes = helpers.get_bounding_boxes(vis_df, masks)
-        try:
-            for box in boxes:
-                assert not torch.any(torch.isnan(box))
-        except Exception as e:
-            self.skipped_images.append(image_id)
-            print("ERROR: Skipped image with id [{}] due to a BB exception [{}]".format(image_id, e))
-            return
+        boxes, area, keep = helpers.get_boxes_from_runs(runs)
+        if self.debug:
+            try:
+                for box in boxes:
+                    assert not torch.any(torch.isnan(box))
+            except Exception as e:
+                self.skipped_images.append(image_id)
+                print("ERROR: Skipped image with id [{}] due to a BB exception [{}]".format(image_id, e))
+                return
         if self.gather_statistics:
-            self.inc_by(self.lock, self.total_box_time, time.time() - box_start_ts)
+            self.stats.record('box', time.time() - box_start_ts)
         
+        labels, masks, boxes = helpers.remove_empty_masks(labels, masks, boxes, keep)
+        area = area[keep]
+
+        image_load_start_ts = time.time()
+        image, image_orig_size = helpers.load_image(common.get_image_path(self.main_folder_path, image_id, self.is_colab), self.target_dim, reduced_decode=self.reduced_decode)
+        if self.gather_statistics:
+            self.stats.record('image_load', time.time() - image_load_start_ts)
+        return image, image_orig_size, labels, masks, boxes, area
+
+    def __getitem__(self, idx):
+        if self.gather_statistics:
+            start = time.time()
+        sample = self.load_sample(idx)
+        if sample is None:
+            return
+        image, image_orig_size, labels, masks, boxes, area = sample
         num_objs = len(labels)
 
         image_id_idx = idx
-        area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
         # suppose all instances are not crowd
         iscrowd = torch.zeros((num_objs,), dtype=torch.int64)
 
-        labels, masks, boxes = helpers.remove_empty_masks(labels, masks, boxes)
-
         target = {}
         if "faster" in self.model_name:
             target["labels"] = labels
-            assert torch.min(target["labels"]) >= 0
-            assert torch.max(target["labels"]) <= self.num_classes - 1
+            if self.debug:
+                assert torch.min(target["labels"]) >= 0
+                assert torch.max(target["labels"]) <= self.num_classes - 1
         else:
             # we only need the correction for the modified model
             target["labels"] = torch.add(labels, 1)  # refer to fast_collate, this is needed for efficient det
-            assert torch.min(target["labels"]) >= 1
-            assert torch.max(target["labels"]) <= self.num_classes
+            if self.debug:
+                assert torch.min(target["labels"]) >= 1
+                assert torch.max(target["labels"]) <= self.num_classes
         target["masks"] = masks
         target["boxes"] = boxes
         target["image_id"] = image_id_idx
@@ -120,15 +177,9 @@ class IMATDataset(BaseDataset):
 #         target["image_id"] = torch.tensor(image_id_idx)
 #         target["area"] = torch.tensor(area)
 #         target["iscrowd"] = torch.tensor(iscrowd)
-
-        image_load_start_ts = time.time()
-        image_orig = Image.open(common.get_image_path(self.main_folder_path, image_id, self.is_colab)).convert("RGB")
-        image = helpers.rescale(image_orig, target_dim=self.target_dim)
-        if self.gather_statistics:
-            self.inc_by(self.lock, self.total_image_load_time, time.time() - image_load_start_ts)
         
         # TODO(ofekp): check what happens here when the image is < self.target_dim. What will helpers.py scale method do to the image in this case?
-        target["img_size"] = image_orig.size[-2:] if self.target_dim is None else (self.target_dim, self.target_dim)
+        target["img_size"] = image_orig_size if self.target_dim is None else (self.target_dim, self.target_dim)
         image_orig_max_dim = max(target["img_size"])
         img_scale = self.target_dim / image_orig_max_dim
         target["img_scale"] = 1. / img_scale  # back to original size
@@ -139,90 +190,388 @@ class IMATDataset(BaseDataset):
             image, target = self.transforms(image, target)
         
         if self.gather_statistics:
-            self.inc_by(self.lock, self.total_transform_time, time.time() - transform_start_ts)
-            self.inc_by(self.lock, self.images_processed, 1)
-            self.inc_by(self.lock, self.total_process_time, time.time() - start)
+            self.stats.record('transform', time.time() - transform_start_ts)
+            self.stats.record('process', time.time() - start)
         
         assert image.shape[0] <= self.target_dim and image.shape[1] <= self.target_dim and image.shape[2] <= self.target_dim
         return image, target
 
+    def get_height_and_width(self, idx):
+        '''
+        return: (height, width) of the original image as given in the annotations, without reading the image
+        '''
+        return self.annotations.get_height_and_width(idx)
+
+    def get_num_instances(self, idx):
+        '''
+        return: the number of segments of the image in the annotations, masks that are empty at target_dim are
+                dropped by __getitem__ so the sample may have fewer instances
+        '''
+        return self.annotations.get_num_segments(idx)
+
+    def get_image_sizes(self):
+        '''
+        return: (heights, widths) arrays of the original sizes of all the images, refer to group_by_aspect_ratio
+        '''
+        return np.asarray(self.annotations.heights), np.asarray(self.annotations.widths)
+
     def __len__(self):
         return len(self.image_ids)
 
 
+# default size of the HDF5 raw chunk cache of every reader handle, large enough to hold a chunk of 20 uint8 images
+H5_CHUNK_CACHE_BYTES = 64 * 2 ** 20
+
+
 class DatasetH5Reader(torch.utils.data.Dataset):
-    def __init__(self, in_file):
+    def __init__(self, in_file, rdcc_nbytes=H5_CHUNK_CACHE_BYTES, rdcc_nslots=None):
+        '''
+        The file is opened lazily once per process, so every DataLoader worker gets a handle of its own
+        in_file - an H5 file written by h5py_dataset_writer.py, or the index of a sharded dataset written by
+                  h5py_dataset_writer.write_shards, in which case the shards are read as one dataset
+        rdcc_nbytes, rdcc_nslots - size and number of hash slots of the raw chunk cache of the handle (of every shard),
+                                   refer to h5py.File
+        '''
         super(DatasetH5Reader, self).__init__()
         self.in_file = in_file
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+        self.h5py_file = None
+        self.data_sets = None
+        self.pid = None
+        self.shards = None
+        # the metadata is read with a short lived handle, so that no handle is inherited by forked workers
+        with h5py.File(self.in_file, "r", swmr=True) as h5py_file:
+            if h5py_file.attrs.get('layout') == 'sharded':
+                shard_files = [os.path.join(os.path.dirname(self.in_file), shard_file.decode()) for shard_file in h5py_file['shard_files'][:]]
+                self.init_shards(shard_files)
+                return
+            images = h5py_file['images']
+            self.length = images.shape[0]
+            self.image_ids = h5py_file['image_ids'][:]
+            # the ImageId of every image, files written before the keys were recorded only have image_ids
+            self.image_keys = h5py_file['image_keys'][:].astype(str) if 'image_keys' in h5py_file else None
+            self.mask_layout = h5py_file.attrs.get('mask_layout', 'dense')
+            # the size of the original images and the number of instances of every image, kept in memory so the
+            # metadata of a sample is known without reading it
+            self.heights = h5py_file['heights'][:] if 'heights' in h5py_file else None
+            self.widths = h5py_file['widths'][:] if 'widths' in h5py_file else None
+            self.instance_counts = h5py_file['instance_counts'][:] if 'instance_counts' in h5py_file else None
+            if self.heights is None:
+                print("File [{}] has no image sizes, the letterboxed size is used instead, write it again to record them".format(self.in_file))
+            # images per chunk and the size of a decompressed chunk in the chunk cache
+            self.chunk_rows = images.chunks[0] if images.chunks is not None else 1
+            self.chunk_bytes = int(np.prod(images.chunks if images.chunks is not None else images.shape[1:])) * images.dtype.itemsize
+
+    def init_shards(self, shard_files):
+        self.shards = [DatasetH5Reader(shard_file, self.rdcc_nbytes, self.rdcc_nslots) for shard_file in shard_files]
+        # index idx is sample idx - shard_offsets[i] of shard i, where shard_offsets[i] <= idx < shard_offsets[i + 1]
+        self.shard_offsets = np.concatenate([[0], np.cumsum([len(shard) for shard in self.shards])])
+        self.length = int(self.shard_offsets[-1])
+        self.image_ids = np.concatenate([shard.image_ids for shard in self.shards])
+        self.image_keys = None
+        if all(shard.image_keys is not None for shard in self.shards):
+            self.image_keys = np.concatenate([shard.image_keys for shard in self.shards])
+        self.heights = None
+        self.widths = None
+        if all(shard.heights is not None for shard in self.shards):
+            self.heights = np.concatenate([shard.heights for shard in self.shards])
+            self.widths = np.concatenate([shard.widths for shard in self.shards])
+        self.instance_counts = None
+        if all(shard.instance_counts is not None for shard in self.shards):
+            self.instance_counts = np.concatenate([shard.instance_counts for shard in self.shards])
+        self.mask_layout = self.shards[0].mask_layout
+        self.chunk_rows = self.shards[0].chunk_rows
+        self.chunk_bytes = self.shards[0].chunk_bytes
+
+    def get_shard(self, index):
+        '''
+        return: (shard, index in the shard) of the sample in the given index
+        '''
+        if index < 0:
+            index += self.length
+        shard = int(np.searchsorted(self.shard_offsets, index, side='right')) - 1
+        return self.shards[shard], index - int(self.shard_offsets[shard])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # a spawned worker opens the file on its first read
+        state['h5py_file'] = None
+        state['data_sets'] = None
+        state['pid'] = None
+        return state
+
+    def get_data_sets(self):
+        '''
+        return: the datasets of the file by name, as opened by the current process
+        '''
+        if self.pid != os.getpid():
+            # a handle created before a fork belongs to the parent process, it is dropped and not closed
+            self.h5py_file = h5py.File(self.in_file, "r", swmr=True, rdcc_nbytes=self.rdcc_nbytes, rdcc_nslots=self.rdcc_nslots)  # swmr=True allows concurrent reads
+            self.data_sets = {name: self.h5py_file[name] for name in self.h5py_file}
+            self.pid = os.getpid()
+        return self.data_sets
+
+    def get_cache_chunks(self):
+        '''
+        return: the number of image chunks the chunk cache of a handle holds
+        '''
+        return self.rdcc_nbytes // self.chunk_bytes
+
+    def close(self):
+        if self.shards is not None:
+            for shard in self.shards:
+                shard.close()
+        if self.h5py_file is not None and self.pid == os.getpid():
+            self.h5py_file.close()
+        self.h5py_file = None
+        self.data_sets = None
+        self.pid = None
 
     def __getitem__(self, index):
-        h5py_file = h5py.File(self.in_file, "r", swmr=True)  # swmr=True allows concurrent reads
-        image = h5py_file['images'][index]
-        labels = h5py_file['labels'][index]
-        masks_fixed_size = h5py_file['masks'][index]
-        boxes_fixed_size = h5py_file['boxes'][index]
+        '''
+        return: (image, labels, masks, boxes) files with the dense mask layout return all the 75 mask planes and boxes
+                of the image, only the first len(labels) of them are real instances
+        '''
+        if self.shards is not None:
+            shard, shard_index = self.get_shard(index)
+            return shard[shard_index]
+        data_sets = self.get_data_sets()
+        image = data_sets['images'][index]
+        labels = data_sets['labels'][index]
+        if self.mask_layout == 'ragged':
+            start = data_sets['instance_starts'][index]
+            instances = slice(start, start + data_sets['instance_counts'][index])
+            crops = data_sets['mask_crops'][instances]
+            bits = data_sets['mask_bits'][instances]
+            masks = helpers.unpack_masks(crops, bits, image.shape[-2], image.shape[-1])
+            boxes = data_sets['instance_boxes'][instances]
+            return image, labels, masks, boxes
+        masks_fixed_size = data_sets['masks'][index]
+        boxes_fixed_size = data_sets['boxes'][index]
         return image, labels, masks_fixed_size, boxes_fixed_size
+
+    @staticmethod
+    def read_rows(data_set, rows):
+        '''
+        Reads the given rows of a dataset, every run of consecutive rows is read as one slice since HDF5 reads
+        a selection of scattered rows (h5py fancy indexing) many times slower than the same rows as slices
+        rows - sorted and unique row numbers
+        '''
+        out = np.empty((len(rows),) + data_set.shape[1:], dtype=data_set.dtype)
+        if len(rows) == 0:
+            return out
+        run_bounds = np.concatenate([[0], np.flatnonzero(np.diff(rows) != 1) + 1, [len(rows)]])
+        for run_start, run_stop in zip(run_bounds[:-1], run_bounds[1:]):
+            out[run_start:run_stop] = data_set[rows[run_start]:rows[run_start] + run_stop - run_start]
+        return out
+
+    def get_batch(self, indices):
+        '''
+        Reads the samples of all the indices at once, sorted (and repeated indices read once) so that every run of
+        neighbouring samples is a single read per dataset and a chunk shared by samples of the batch is read once
+        return: a list with the result of __getitem__ for every index, in the order of indices
+        '''
+        if self.shards is not None:
+            return self.get_sharded_batch(indices)
+        data_sets = self.get_data_sets()
+        unique_indices, inverse = np.unique(np.asarray(indices, dtype=np.int64), return_inverse=True)
+        images = DatasetH5Reader.read_rows(data_sets['images'], unique_indices)
+        labels = DatasetH5Reader.read_rows(data_sets['labels'], unique_indices)
+        if self.mask_layout == 'ragged':
+            starts = DatasetH5Reader.read_rows(data_sets['instance_starts'], unique_indices)
+            counts = DatasetH5Reader.read_rows(data_sets['instance_counts'], unique_indices).astype(np.int64)
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            # rows of all the instances of the batch, increasing since the images are sorted
+            rows = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+            crops = DatasetH5Reader.read_rows(data_sets['mask_crops'], rows)
+            bits = DatasetH5Reader.read_rows(data_sets['mask_bits'], rows)
+            boxes = DatasetH5Reader.read_rows(data_sets['instance_boxes'], rows)
+            samples = []
+            for i in range(len(unique_indices)):
+                instances = slice(offsets[i], offsets[i + 1])
+                masks = helpers.unpack_masks(crops[instances], bits[instances], images.shape[-2], images.shape[-1])
+                samples.append((images[i], labels[i], masks, boxes[instances]))
+        else:
+            masks_fixed_size = DatasetH5Reader.read_rows(data_sets['masks'], unique_indices)
+            boxes_fixed_size = DatasetH5Reader.read_rows(data_sets['boxes'], unique_indices)
+            samples = [(images[i], labels[i], masks_fixed_size[i], boxes_fixed_size[i]) for i in range(len(unique_indices))]
+        return [samples[i] for i in inverse]
     
+    def get_sharded_batch(self, indices):
+        '''
+        Splits the batch by shard and reads the indices of every shard with its get_batch
+        '''
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_ids = np.searchsorted(self.shard_offsets, indices, side='right') - 1
+        samples = [None] * len(indices)
+        for shard_id in np.unique(shard_ids):
+            positions = np.flatnonzero(shard_ids == shard_id)
+            shard_samples = self.shards[shard_id].get_batch(indices[positions] - self.shard_offsets[shard_id])
+            for position, sample in zip(positions, shard_samples):
+                samples[position] = sample
+        return samples
+
     def get_image_id(self, idx):
         '''
         Images in the h5py dataset are not inserted in their order according to how they appear in dataframe
         this is why a translation has to be made to grab the correct image
         '''
-        h5py_file = h5py.File(self.in_file, "r", swmr=True)  # swmr=True allows concurrent reads
-        image_idxes = h5py_file['image_ids'][:]
-        h5py_file.close()
-        print(image_idxes[0:50])
-        return image_idxes[idx]
+        return self.image_ids[idx]
+
+    def get_num_instances(self, index):
+        if self.instance_counts is not None:
+            return int(self.instance_counts[index])
+        if self.shards is not None:
+            shard, shard_index = self.get_shard(index)
+            return shard.get_num_instances(shard_index)
+        # files of the dense layout written before the counts were recorded, the labels have one entry per instance
+        return len(self.get_data_sets()['labels'][index])
 
     def __len__(self):
-        h5py_file = h5py.File(self.in_file, "r", swmr=True)  # swmr=True allows concurrent reads
-        return h5py_file['images'].shape[0]
+        return self.length
+
+
+# bump when the layout of the memory-mapped arrays changes
+MEMMAP_VERSION = 1
+MEMMAP_COLUMNS = ['image_ids', 'image_keys', 'instance_offsets', 'labels', 'boxes', 'mask_crops', 'mask_bit_offsets', 'mask_bits']
+# the size of the original images, missing in folders converted from files that did not record it
+MEMMAP_SIZE_COLUMNS = ['heights', 'widths']
+# raw images are one (num_images, 3, H, W) array, encoded images are a blob of JPEG or PNG files with an offset index
+MEMMAP_IMAGE_FORMATS = ['raw'] + list(helpers.ENCODED_IMAGE_FORMATS.keys())
+MEMMAP_IMAGE_COLUMNS = {'raw': ['images'], 'jpeg': ['image_bytes', 'image_offsets'], 'png': ['image_bytes', 'image_offsets']}
+
+
+class DatasetMemmapReader(torch.utils.data.Dataset):
+    '''
+    Reads a dataset converted by memmap_dataset_writer.py, a folder of flat .npy arrays that are memory-mapped. The
+    pages of the arrays are shared through the page cache by all the DataLoader workers and by every training process
+    on the machine, and reading a sample is slicing the arrays, without chunk lookups, decompression or locks.
+    The instances of image i are rows instance_offsets[i]:instance_offsets[i + 1] of labels, boxes and mask_crops, the
+    packed mask of instance j is mask_bits[mask_bit_offsets[j]:mask_bit_offsets[j + 1]], refer to helpers.pack_masks
+    With an encoded image format image i is the file image_bytes[image_offsets[i]:image_offsets[i + 1]], which is
+    decoded by the worker that reads it, refer to helpers.encode_image
+    Has the same interface as DatasetH5Reader
+    '''
+    def __init__(self, in_dir):
+        super(DatasetMemmapReader, self).__init__()
+        self.in_dir = in_dir
+        with open(os.path.join(self.in_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        assert meta['version'] == MEMMAP_VERSION, "[{}] was converted with version [{}], convert it again".format(self.in_dir, meta['version'])
+        self.image_format = meta.get('image_format', 'raw')
+        assert self.image_format in MEMMAP_IMAGE_FORMATS, "Unsupported image format [{}]".format(self.image_format)
+        self.arrays = None
+        arrays = self.get_arrays()
+        self.length = len(arrays['image_ids'])
+        self.image_ids = np.array(arrays['image_ids'])
+        self.image_keys = np.array(arrays['image_keys'])
+        self.instance_counts = np.diff(arrays['instance_offsets'])
+        self.heights = None
+        self.widths = None
+        if all(os.path.exists(os.path.join(self.in_dir, column + '.npy')) for column in MEMMAP_SIZE_COLUMNS):
+            self.heights = np.load(os.path.join(self.in_dir, 'heights.npy'))
+            self.widths = np.load(os.path.join(self.in_dir, 'widths.npy'))
+        self.mask_layout = 'ragged'
+        # every sample is read on its own, there are no chunks to read together
+        self.chunk_rows = 1
+        if self.length == 0:
+            self.chunk_bytes = 0
+        elif self.image_format == 'raw':
+            self.chunk_bytes = arrays['images'][0].nbytes
+        else:
+            self.chunk_bytes = len(arrays['image_bytes']) // self.length
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the arrays are mapped again by a spawned worker instead of being pickled
+        state['arrays'] = None
+        return state
+
+    def get_arrays(self):
+        if self.arrays is None:
+            # copy on write mappings give writable arrays that torch.from_numpy accepts without a copy,
+            # the pages are shared as long as they are not written
+            columns = MEMMAP_COLUMNS + MEMMAP_IMAGE_COLUMNS[self.image_format]
+            self.arrays = {column: np.load(os.path.join(self.in_dir, column + '.npy'), mmap_mode='c') for column in columns}
+        return self.arrays
 
+    def get_cache_chunks(self):
+        return self.length
 
-class IMATDatasetH5PY(BaseDataset):
-    def __init__(self, dataset_h5py_reader, num_classes, target_dim, model_name, transforms=None):
+    def close(self):
+        self.arrays = None
+
+    def __getitem__(self, index):
+        '''
+        return: (image, labels, masks, boxes) the labels and boxes, and raw images, are views of the mapped arrays
+        '''
+        if index < 0:
+            index += self.length
+        arrays = self.get_arrays()
+        instance_start, instance_stop = arrays['instance_offsets'][index], arrays['instance_offsets'][index + 1]
+        if self.image_format == 'raw':
+            image = arrays['images'][index]
+        else:
+            image = helpers.decode_image(arrays['image_bytes'][arrays['image_offsets'][index]:arrays['image_offsets'][index + 1]])
+        crops = arrays['mask_crops'][instance_start:instance_stop]
+        bit_offsets = arrays['mask_bit_offsets'][instance_start:instance_stop + 1]
+        bits = [arrays['mask_bits'][bit_offsets[j]:bit_offsets[j + 1]] for j in range(len(crops))]
+        masks = helpers.unpack_masks(crops, bits, image.shape[-2], image.shape[-1])
+        return image, arrays['labels'][instance_start:instance_stop], masks, arrays['boxes'][instance_start:instance_stop]
+
+    def get_batch(self, indices):
+        # reads are slices of the mapped arrays, there is nothing to share between the samples of a batch
+        return [self.__getitem__(index) for index in indices]
+
+    def get_image_id(self, idx):
+        return self.image_ids[idx]
+
+    def get_num_instances(self, index):
+        return int(self.instance_counts[index])
+
+    def __len__(self):
+        return self.length
+
+
+class PreprocessedSampleMixin:
+    '''
+    Builds the samples of the datasets that read preprocessed samples (IMATDatasetH5PY, IMATTarShardDataset), so both
+    return exactly the same tensors and target, and gathers their statistics
+    '''
+    def init_samples(self, num_classes, target_dim, model_name, transforms=None, gather_statistics=True, debug=False):
         self.transforms = transforms
         self.num_classes = num_classes
         self.target_dim = target_dim
         self.model_name = model_name
-        self.lock = Lock()
-        self.dataset_h5py_reader = dataset_h5py_reader
-        self.images_processed = Value('i', 0)
-        self.total_process_time = Value('f', 0.0)
-        # TODO: indices = torch.randperm(len(dataset)).tolist()
+        self.debug = debug
+        self.gather_statistics = gather_statistics
+        if self.gather_statistics:
+            self.stats = stage_timer.StageTimer(['process', 'read', 'transform'])
 
-    def inc_by(self, lock, counter, val):
-        lock.acquire()
-        try:
-            counter.value += val
-        finally:
-            lock.release()
-        
     def show_stats(self):
-        images_processed = self.images_processed.value
-        total_process_time = self.total_process_time.value
-        avg_time_per_image = 0 if images_processed == 0 else total_process_time / images_processed
-        print("Processed [{}] images in [{}] seconds"
-              " Avg per image [{}]"
-              .format(
-            images_processed,
-            total_process_time,
-            avg_time_per_image))
-    
-    def __getitem__(self, idx):
-        start = time.time()
-        
-        # it is critical to open the file here and not in the CTOR, to avoid errors on multiple access of threads
-        # the error I got was: "OSError: Can't read some data (inflate() failed) & (wrong B-tree signature)"
-        image, labels, masks, boxes = self.dataset_h5py_reader.__getitem__(idx)
-        image = torch.from_numpy(image).float()
+        if self.gather_statistics:
+            self.stats.show_stats('process')
+
+    def make_sample(self, idx, image, labels, masks, boxes, start):
+        '''
+        Builds the image tensor and the target of a preprocessed sample
+        start - the time the processing of the sample started, for the statistics
+        '''
+        image = torch.from_numpy(image)
+        if image.dtype == torch.uint8:
+            image = image.float().div(255)  # same as transforms.ToTensor
+        else:
+            # older files store float images that are already in the range [0, 1]
+            image = image.float()
         target = {}
         if len(labels) == 0:
             print("idx [{}] had an image with 0 labels".format(idx))
         assert len(labels) > 0
         target["labels"] = torch.from_numpy(labels)
-        assert torch.min(target["labels"]) >= 1
-        assert torch.max(target["labels"]) <= self.num_classes
+        if self.debug:
+            assert torch.min(target["labels"]) >= 1
+            assert torch.max(target["labels"]) <= self.num_classes
         if "faster" in self.model_name:
             # in case of the conventional model, we need to have the classes start from 0
             target["labels"] = torch.sub(target["labels"], 1)
@@ -242,13 +591,309 @@ class IMATDatasetH5PY(BaseDataset):
         img_scale = self.target_dim / image_orig_max_dim
         target["img_scale"] = 1. / img_scale  # back to original size
         
+        if self.gather_statistics:
+            transform_start_ts = time.time()
         if self.transforms is not None:
             image, target = self.transforms(image, target)
         
-        self.inc_by(self.lock, self.images_processed, 1)
-        self.inc_by(self.lock, self.total_process_time, time.time() - start)
+        if self.gather_statistics:
+            self.stats.record('transform', time.time() - transform_start_ts)
+            self.stats.record('process', time.time() - start)
         return image, target
+
+
+class IMATDatasetH5PY(PreprocessedSampleMixin, BaseDataset):
+    def __init__(self, dataset_h5py_reader, num_classes, target_dim, model_name, transforms=None, gather_statistics=True, shared_store=None, skip_list=None, debug=False):
+        '''
+        dataset_h5py_reader - a DatasetH5Reader or a DatasetMemmapReader
+        shared_store - a sample_cache.SharedSampleStore that shares the samples read from the file with the other
+                       processes of the machine
+        skip_list - ImageIds to exclude, e.g. annotations.load_skip_list of the output of validate.py, the file must
+                    hold the ImageIds of its images (image_keys)
+        debug - check the labels of every sample
+        '''
+        self.init_samples(num_classes, target_dim, model_name, transforms, gather_statistics, debug)
+        self.dataset_h5py_reader = dataset_h5py_reader
+        # the rows of the file that are in the dataset, None for all of them
+        self.rows = None
+        if skip_list is not None:
+            image_keys = dataset_h5py_reader.image_keys
+            assert image_keys is not None, "The file has no ImageIds to match the skip list with, write it again"
+            self.rows = np.flatnonzero(~np.isin(image_keys, np.array(list(skip_list), dtype=str)))
+            print("Excluded [{}] of [{}] images that are in the skip list".format(len(image_keys) - len(self.rows), len(image_keys)))
+        self.shared_store = shared_store
+        if self.shared_store is not None:
+            reader_path = getattr(dataset_h5py_reader, 'in_file', None) or dataset_h5py_reader.in_dir
+            # the samples of different files, or of a file that was written again, must not collide in the store
+            source = "{}:{}".format(os.path.abspath(reader_path), os.path.getmtime(reader_path))
+            self.store_prefix = hashlib.md5(source.encode('utf-8')).hexdigest()[:16]
+        # TODO: indices = torch.randperm(len(dataset)).tolist()
+
+    def __getitem__(self, idx):
+        start = time.time()
         
+        # the reader opens the file once in every worker process and not in the CTOR, sharing a handle between processes
+        # causes errors such as: "OSError: Can't read some data (inflate() failed) & (wrong B-tree signature)"
+        if self.shared_store is None:
+            image, labels, masks, boxes = self.dataset_h5py_reader.__getitem__(self.get_row(idx))
+        else:
+            image, labels, masks, boxes = self.read_batch([self.get_row(idx)])[0]
+        if self.gather_statistics:
+            self.stats.record('read', time.time() - start)
+        return self.make_sample(idx, image, labels, masks, boxes, start)
+
+    def get_row(self, idx):
+        '''
+        return: the row of the file of sample idx
+        '''
+        if self.rows is None:
+            return idx
+        return int(self.rows[idx])
+
+    def get_image_id(self, idx):
+        '''
+        return: the position of the image of sample idx in the annotations the file was written from
+        '''
+        return self.dataset_h5py_reader.get_image_id(self.get_row(idx))
+
+    def get_height_and_width(self, idx):
+        '''
+        return: (height, width) of the original image, recorded in the file by the writer, or the letterboxed size
+                for files that did not record it
+        '''
+        reader = self.dataset_h5py_reader
+        if reader.heights is None:
+            return self.target_dim, self.target_dim
+        row = self.get_row(idx)
+        return int(reader.heights[row]), int(reader.widths[row])
+
+    def get_num_instances(self, idx):
+        return self.dataset_h5py_reader.get_num_instances(self.get_row(idx))
+
+    def get_image_sizes(self):
+        '''
+        return: (heights, widths) arrays of the original sizes of all the samples, refer to group_by_aspect_ratio
+        '''
+        reader = self.dataset_h5py_reader
+        if reader.heights is None:
+            sizes = np.full((self.__len__(),), self.target_dim, dtype=np.int32)
+            return sizes, sizes
+        if self.rows is None:
+            return reader.heights, reader.widths
+        return reader.heights[self.rows], reader.widths[self.rows]
+
+    def get_cache_key(self, row):
+        return (self.store_prefix, row)
+
+    def read_batch(self, indices):
+        '''
+        Reads the samples that the shared store holds from it and the rest from the file, adding them to the store
+        indices - rows of the file
+        return: a list of (image, labels, masks, boxes) like the get_batch of the reader
+        '''
+        if self.shared_store is None:
+            return self.dataset_h5py_reader.get_batch(indices)
+        samples = [None] * len(indices)
+        missing = []
+        for i, idx in enumerate(indices):
+            arrays = self.shared_store.get(self.get_cache_key(idx))
+            if arrays is None:
+                missing.append(i)
+                continue
+            samples[i] = (arrays['image'], arrays['labels'], arrays['masks'], arrays['boxes'])
+        if len(missing) > 0:
+            batch = self.dataset_h5py_reader.get_batch([indices[i] for i in missing])
+            for i, (image, labels, masks, boxes) in zip(missing, batch):
+                # files of the dense layout pad the instances, only the real ones are stored
+                num_objs = len(labels)
+                self.shared_store.put(self.get_cache_key(indices[i]), image=image, labels=labels, masks=masks[:num_objs], boxes=boxes[:num_objs])
+                samples[i] = (image, labels, masks, boxes)
+        return samples
+
+    def __getitems__(self, indices):
+        '''
+        Used by the DataLoader to fetch a whole batch at once, the batch is read from the file with one selection
+        per dataset instead of one read per sample
+        '''
+        start = time.time()
+        batch = self.read_batch([self.get_row(idx) for idx in indices])
+        # the read of the batch is split evenly between its samples
+        read_time = (time.time() - start) / max(len(indices), 1)
+        samples = []
+        for idx, (image, labels, masks, boxes) in zip(indices, batch):
+            if self.gather_statistics:
+                self.stats.record('read', read_time)
+            samples.append(self.make_sample(idx, image, labels, masks, boxes, time.time() - read_time))
+        return samples
 
     def __len__(self):
-        return self.dataset_h5py_reader.__len__()
\ No newline at end of file
+        if self.rows is not None:
+            return len(self.rows)
+        return self.dataset_h5py_reader.__len__()
+
+
+# bump when the content of the tar shards changes
+TAR_SHARD_VERSION = 2
+TAR_SHARD_INDEX = 'index.json'
+
+
+def read_tar_shard(shard_file):
+    '''
+    Reads a shard written by tar_shard_writer.py from start to end without seeking
+    return: a generator of (image_bytes, target_bytes) per sample, the encoded image and the .npz of its target
+    '''
+    key = None
+    parts = {}
+    with tarfile.open(shard_file, 'r|') as tar:
+        for member in tar:
+            member_key, ext = member.name.split('.', 1)
+            if member_key != key:
+                key = member_key
+                parts = {}
+            parts['target' if ext == 'npz' else 'image'] = tar.extractfile(member).read()
+            if len(parts) == 2:
+                yield parts['image'], parts['target']
+
+
+class IMATTarShardDataset(PreprocessedSampleMixin, torch.utils.data.IterableDataset):
+    '''
+    Streams the samples of the tar shards written by tar_shard_writer.py, every shard is read sequentially from start
+    to end, so a slow disk sees large sequential reads instead of random ones.
+    Every epoch the order of the shards is shuffled, the samples of the shards in that order are one stream that is
+    split into equal contiguous ranges, one per process of a distributed run, and the range of every process is split
+    evenly between its DataLoader workers. Each worker shuffles its samples in a buffer of shuffle_buffer samples.
+    Like DistributedSampler the stream is padded with its first samples to a multiple of the number of processes, so
+    every process yields ceil(samples / processes) samples per epoch and all the processes run the same number of
+    steps, whatever the lengths of the shards. A worker whose range starts within a shard reads the start of the
+    shard without decoding it.
+    The order is a function of seed and the epoch set with set_epoch
+    '''
+    def __init__(self, index_file, num_classes, target_dim, model_name, transforms=None, gather_statistics=True, shuffle=True, shuffle_buffer=256, seed=0, skip_list=None, debug=False):
+        '''
+        skip_list - ImageIds to exclude, e.g. annotations.load_skip_list of the output of validate.py, the samples of
+                    these images are read from the shards but not decoded, and are not counted in the stream
+        debug - check the labels of every sample
+        '''
+        super(IMATTarShardDataset, self).__init__()
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+        assert index['version'] == TAR_SHARD_VERSION, "[{}] was written with version [{}], write it again".format(index_file, index['version'])
+        in_dir = os.path.dirname(index_file)
+        self.shard_files = [os.path.join(in_dir, shard_file) for shard_file in index['shard_files']]
+        self.shard_lengths = np.array(index['shard_lengths'], dtype=np.int64)
+        # a mask per shard of its samples that are in the stream, None for all of them
+        self.shard_masks = None
+        if skip_list is not None:
+            skip_keys = np.array(list(skip_list), dtype=str)
+            self.shard_masks = [~np.isin(np.array(image_keys, dtype=str), skip_keys) for image_keys in index['shard_image_keys']]
+            num_images = int(np.sum(self.shard_lengths))
+            self.shard_lengths = np.array([np.sum(mask) for mask in self.shard_masks], dtype=np.int64)
+            print("Excluded [{}] of [{}] images that are in the skip list".format(num_images - int(np.sum(self.shard_lengths)), num_images))
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.init_samples(num_classes, target_dim, model_name, transforms, gather_statistics, debug)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @staticmethod
+    def get_rank():
+        '''
+        return: (rank, world_size) of the process in a distributed run, (0, 1) otherwise
+        '''
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        return 0, 1
+
+    def get_shard_order(self):
+        '''
+        return: the indices of the shards in the order they are streamed in the current epoch
+        '''
+        if self.shuffle:
+            return np.random.default_rng([self.seed, self.epoch]).permutation(len(self.shard_files))
+        return np.arange(len(self.shard_files))
+
+    def get_worker_range(self):
+        '''
+        return: (start, stop) positions of the samples of this DataLoader worker in the stream of the current epoch
+        '''
+        rank, _ = IMATTarShardDataset.get_rank()
+        num_samples = self.__len__()
+        start = rank * num_samples
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            return start, start + num_samples
+        return start + worker_info.id * num_samples // worker_info.num_workers, start + (worker_info.id + 1) * num_samples // worker_info.num_workers
+
+    def read_samples(self, start, stop):
+        '''
+        return: a generator of the (image_bytes, target_bytes) of the samples in positions start to stop of the stream
+                of the current epoch, the stream repeats from its start past its end
+        '''
+        if stop <= start:
+            return
+        assert np.sum(self.shard_lengths) > 0, "The shards are empty"
+        order = self.get_shard_order()
+        offset = 0
+        for shard in itertools.cycle(order):
+            if offset >= stop:
+                return
+            length = int(self.shard_lengths[shard])
+            if offset + length > start:
+                samples = read_tar_shard(self.shard_files[shard])
+                if self.shard_masks is not None:
+                    samples = (sample for sample, in_stream in zip(samples, self.shard_masks[shard]) if in_stream)
+                for position, sample in enumerate(samples, offset):
+                    if position >= stop:
+                        break
+                    if position >= start:
+                        yield sample
+            offset += length
+
+    def get_samples(self, start, stop):
+        '''
+        return: a generator of the (image_bytes, target_bytes) of the samples in positions start to stop of the
+                stream, shuffled within the buffer
+        '''
+        samples = self.read_samples(start, stop)
+        if not self.shuffle or self.shuffle_buffer <= 1:
+            yield from samples
+            return
+        worker_info = torch.utils.data.get_worker_info()
+        rng = np.random.default_rng([self.seed, self.epoch, IMATTarShardDataset.get_rank()[0], 0 if worker_info is None else worker_info.id])
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.integers(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        for image_bytes, target_bytes in self.get_samples(*self.get_worker_range()):
+            start = time.time()
+            image = helpers.decode_image(np.frombuffer(image_bytes, dtype=np.uint8))
+            with np.load(io.BytesIO(target_bytes)) as target:
+                image_id = int(target['image_id'])
+                labels = target['labels']
+                crops = target['mask_crops']
+                bit_offsets = target['mask_bit_offsets']
+                mask_bits = target['mask_bits']  # every access of an npz key reads the array again
+                bits = [mask_bits[bit_offsets[j]:bit_offsets[j + 1]] for j in range(len(crops))]
+                masks = helpers.unpack_masks(crops, bits, image.shape[-2], image.shape[-1])
+                boxes = target['boxes']
+            if self.gather_statistics:
+                self.stats.record('read', time.time() - start)
+            yield self.make_sample(image_id, image, labels, masks, boxes, start)
+
+    def __len__(self):
+        '''
+        return: the number of samples every process yields in an epoch
+        '''
+        _, world_size = IMATTarShardDataset.get_rank()
+        return -(-int(np.sum(self.shard_lengths)) // world_size)
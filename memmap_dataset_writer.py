@@ -0,0 +1,149 @@
+import argparse
+import os
+import shutil
+import numpy as np
+import yaml
+
+import annotations
+import helpers
+import imat_dataset
+
+
+parser = argparse.ArgumentParser(description='Converts an H5PY dataset to flat memory-mapped arrays')
+
+parser.add_argument('--in-file', type=str, required=True, metavar='FILE',
+                    help='H5PY dataset written by h5py_dataset_writer.py, a single file or the index of a sharded dataset')
+parser.add_argument('--out-dir', type=str, default=None, metavar='DIR',
+                    help='Folder of the converted dataset, None for the name of the input file with a _memmap suffix (default=None)')
+parser.add_argument('--block-size', type=int, default=64, metavar='BLOCK_SIZE',
+                    help='Number of images read from the H5PY file at once (default=64)')
+parser.add_argument('--image-format', type=str, default='raw', choices=imat_dataset.MEMMAP_IMAGE_FORMATS, metavar='FORMAT',
+                    help='Storage of the images, raw pixels or re-encoded files decoded by the data loader workers, one of {} (default=raw)'.format(imat_dataset.MEMMAP_IMAGE_FORMATS))
+parser.add_argument('--jpeg-quality', type=int, default=95, metavar='QUALITY',
+                    help='Quality of the re-encoded images, only used with --image-format jpeg (default=95)')
+
+
+def parse_args():
+    # parse the args that are passed to this script
+    args = parser.parse_args()
+
+    # save the args as a text string so we can log them later
+    args_text = yaml.safe_dump(args.__dict__, default_flow_style=False)
+    return args, args_text
+
+
+def copy_raw_to_npy(raw_path, npy_path, num_bytes):
+    '''
+    Copies the bytes streamed to raw_path to a uint8 .npy file and removes raw_path
+    '''
+    array = np.lib.format.open_memmap(npy_path, mode='w+', dtype=np.uint8, shape=(num_bytes,))
+    if num_bytes > 0:
+        array[:] = np.memmap(raw_path, dtype=np.uint8, mode='r')
+    array.flush()
+    del array
+    os.remove(raw_path)
+
+
+def convert_h5_to_memmap(in_file, out_dir, block_size=64, image_format='raw', jpeg_quality=95):
+    '''
+    Writes the samples of the H5PY dataset in_file as the arrays DatasetMemmapReader reads, masks of files with
+    the dense mask layout are converted to packed crops.
+    image_format - 'raw' keeps the pixels as stored in in_file, 'jpeg' and 'png' re-encode the letterboxed images into
+                   one blob, jpeg is lossy and float images are rounded to 8 bit before they are encoded
+    The arrays are written to a temporary folder that is moved in place, so a reader never sees a partial dataset
+    '''
+    assert image_format in imat_dataset.MEMMAP_IMAGE_FORMATS, "Unsupported image format [{}]".format(image_format)
+    reader = imat_dataset.DatasetH5Reader(in_file)
+    num_images = len(reader)
+    assert num_images > 0, "[{}] is empty".format(in_file)
+    tmp_dir = out_dir + '.tmp.' + str(os.getpid())
+    os.makedirs(tmp_dir)
+    print("Converting [{}] images of [{}] to [{}]...".format(num_images, in_file, out_dir))
+
+    if image_format == 'raw':
+        image = reader[0][0]
+        images = np.lib.format.open_memmap(os.path.join(tmp_dir, 'images.npy'), mode='w+', dtype=image.dtype, shape=(num_images,) + image.shape)
+    else:
+        image_sizes = np.zeros((num_images,), dtype=np.int64)
+        # the encoded images are streamed like the packed masks
+        image_bytes_path = os.path.join(tmp_dir, 'image_bytes.raw')
+        image_bytes_file = open(image_bytes_path, 'wb')
+    instance_counts = np.zeros((num_images,), dtype=np.int64)
+    labels_list = []
+    boxes_list = []
+    crops_list = []
+    bit_counts_list = []
+    # the packed masks are streamed to a raw file since their total size is only known at the end
+    bits_path = os.path.join(tmp_dir, 'mask_bits.raw')
+    with open(bits_path, 'wb') as bits_file:
+        for start in range(0, num_images, block_size):
+            batch = reader.get_batch(range(start, min(start + block_size, num_images)))
+            for i, (image, labels, masks, boxes) in enumerate(batch, start):
+                num_instances = len(labels)
+                if image_format == 'raw':
+                    images[i] = image
+                else:
+                    if image.dtype != np.uint8:
+                        image = np.rint(np.clip(image, 0, 1) * 255).astype(np.uint8)
+                    encoded = helpers.encode_image(image, image_format, jpeg_quality)
+                    image_sizes[i] = len(encoded)
+                    image_bytes_file.write(encoded.tobytes())
+                instance_counts[i] = num_instances
+                labels_list.append(np.asarray(labels, dtype=np.int64))
+                boxes_list.append(np.asarray(boxes[:num_instances], dtype=np.float32))
+                crops, bits = helpers.pack_masks(masks[:num_instances])
+                crops_list.append(crops)
+                bit_counts_list.append(np.array([len(b) for b in bits], dtype=np.int64))
+                for b in bits:
+                    bits_file.write(b.tobytes())
+            print("Converted images [{}/{}]".format(min(start + block_size, num_images), num_images))
+    if image_format == 'raw':
+        images.flush()
+        del images
+    else:
+        image_bytes_file.close()
+        copy_raw_to_npy(image_bytes_path, os.path.join(tmp_dir, 'image_bytes.npy'), int(np.sum(image_sizes)))
+        np.save(os.path.join(tmp_dir, 'image_offsets.npy'), np.concatenate([[0], np.cumsum(image_sizes)]).astype(np.int64))
+        print("Encoded images as [{}] avg size [{:.1f}] KB".format(image_format, np.mean(image_sizes) / 1024))
+
+    bit_counts = np.concatenate(bit_counts_list)
+    columns = {
+        'image_ids': reader.image_ids.astype(np.int64),
+        'image_keys': reader.image_keys if reader.image_keys is not None else reader.image_ids.astype(str),
+        'instance_offsets': np.concatenate([[0], np.cumsum(instance_counts)]).astype(np.int64),
+        'labels': np.concatenate(labels_list),
+        'boxes': np.concatenate(boxes_list).reshape(-1, 4),
+        'mask_crops': np.concatenate(crops_list).reshape(-1, 4),
+        'mask_bit_offsets': np.concatenate([[0], np.cumsum(bit_counts)]).astype(np.int64),
+    }
+    if reader.heights is not None:
+        columns['heights'] = reader.heights.astype(np.int32)
+        columns['widths'] = reader.widths.astype(np.int32)
+    for column, values in columns.items():
+        np.save(os.path.join(tmp_dir, column + '.npy'), values)
+    copy_raw_to_npy(bits_path, os.path.join(tmp_dir, 'mask_bits.npy'), int(np.sum(bit_counts)))
+    reader.close()
+
+    annotations.write_json_atomic(os.path.join(tmp_dir, 'meta.json'), {
+        'version': imat_dataset.MEMMAP_VERSION,
+        'source': os.path.abspath(in_file),
+        'image_format': image_format,
+    })
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+    print("Dataset [{}] completed.".format(out_dir))
+
+
+def main():
+    args, args_text = parse_args()
+    print("Args: {}".format(args_text))
+    out_dir = args.out_dir
+    if out_dir is None:
+        out_dir = os.path.splitext(args.in_file)[0] + '_memmap'
+    convert_h5_to_memmap(args.in_file, out_dir, args.block_size, args.image_format, args.jpeg_quality)
+    print("All done.")
+
+
+if __name__ == '__main__':
+    main()
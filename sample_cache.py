@@ -0,0 +1,257 @@
+import fcntl
+import io
+import json
+import mmap
+import os
+import struct
+import time
+import uuid
+import weakref
+import numpy as np
+
+import helpers
+
+
+# remove files down to this fraction of the size cap, so an eviction is not needed on every write
+EVICT_TO_FRACTION = 0.9
+# temporary files older than this were left by a process that died while writing
+STALE_TMP_SECONDS = 3600
+# arrays of a shared sample file start at multiples of this, so every view is aligned for its dtype
+SHARED_ALIGNMENT = 64
+DEFAULT_SHARED_DIR = '/dev/shm/imat_samples'
+
+
+class DiskSampleCache:
+    '''
+    Caches preprocessed samples on the local disk, one .npz file per sample, keyed by the image id, the target dim
+    and the version of the preprocessing, so a change of any of them never reads a stale sample.
+    The image is stored as PNG and the masks as bit packed crops (refer to helpers.pack_masks), which is lossless
+    and a small fraction of the decoded arrays.
+    Safe to share between DataLoader workers and processes: a sample is written to a temporary file that is moved in
+    place, a reader either sees the whole file or no file, and a read of a file that was just evicted is a miss.
+    The size is capped at max_bytes by evicting the least recently used files, every hit updates the modification
+    time of its file. Only one process evicts at a time, guarded by an flock on a lock file in the folder
+    '''
+    FILE_SUFFIX = '.npz'
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock_file = os.path.join(self.cache_dir, '.lock')
+        # bytes written by this process since the size of the folder was last checked
+        self.bytes_since_check = max_bytes
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, '_'.join(str(k) for k in key) + self.FILE_SUFFIX)
+
+    def get(self, key):
+        '''
+        key - tuple of the values that identify the sample, e.g. (image_id, target_dim, version)
+        return: the dict of arrays given to put or None on a miss
+        '''
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        try:
+            with np.load(io.BytesIO(data)) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+        except Exception as e:
+            print("WARNING: Removing corrupted cache file [{}] [{}]".format(path, e))
+            self.remove(path)
+            return None
+        image = helpers.decode_image(arrays.pop('image_png'))
+        crops = arrays.pop('mask_crops')
+        bit_offsets = arrays.pop('mask_bit_offsets')
+        mask_bits = arrays.pop('mask_bits')
+        bits = [mask_bits[bit_offsets[j]:bit_offsets[j + 1]] for j in range(len(crops))]
+        arrays['image'] = image
+        arrays['masks'] = helpers.unpack_masks(crops, bits, image.shape[-2], image.shape[-1])
+        return arrays
+
+    def put(self, key, image, masks, **arrays):
+        '''
+        image - uint8 numpy array of shape (3, height, width)
+        masks - numpy array of shape (num_masks, height, width)
+        arrays - the other arrays of the sample, e.g. labels and boxes
+        '''
+        crops, bits = helpers.pack_masks(masks)
+        buffer = io.BytesIO()
+        np.savez(buffer,
+                 image_png=helpers.encode_image(image, 'png'),
+                 mask_crops=crops,
+                 mask_bit_offsets=np.concatenate([[0], np.cumsum([len(b) for b in bits])]).astype(np.int64),
+                 mask_bits=np.concatenate(bits) if len(bits) > 0 else np.zeros((0,), dtype=np.uint8),
+                 **arrays)
+        path = self.get_path(key)
+        tmp_path = "{}.tmp.{}.{}".format(path, os.getpid(), uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(buffer.getvalue())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # a full disk must not fail the training, the sample is just not cached
+            print("WARNING: Could not write cache file [{}] [{}]".format(path, e))
+            self.remove(tmp_path)
+            return
+        self.written(buffer.tell())
+
+    def written(self, num_bytes):
+        self.bytes_since_check += num_bytes
+        # every process checks the size after writing a small fraction of the cap, so the cap is exceeded by at
+        # most that fraction times the number of processes
+        if self.bytes_since_check >= self.max_bytes * (1 - EVICT_TO_FRACTION):
+            self.bytes_since_check = 0
+            self.evict()
+
+    def can_evict(self, path):
+        return True
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        '''
+        Removes the least recently used files until the folder is below EVICT_TO_FRACTION of max_bytes
+        return: the number of files removed, 0 when another process is already evicting
+        '''
+        with open(self.lock_file, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            try:
+                now = time.time()
+                files = []
+                total_bytes = 0
+                for entry in os.scandir(self.cache_dir):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    if '.tmp.' in entry.name:
+                        if now - stat.st_mtime > STALE_TMP_SECONDS:
+                            self.remove(entry.path)
+                        continue
+                    if not entry.name.endswith(self.FILE_SUFFIX):
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_bytes += stat.st_size
+                if total_bytes <= self.max_bytes:
+                    return 0
+                files.sort()
+                removed = 0
+                for _, size, path in files:
+                    if total_bytes <= self.max_bytes * EVICT_TO_FRACTION:
+                        break
+                    if not self.can_evict(path):
+                        continue
+                    self.remove(path)
+                    total_bytes -= size
+                    removed += 1
+                return removed
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class SharedSampleStore(DiskSampleCache):
+    '''
+    Shares decoded samples between all the DataLoader workers and all the training and evaluation processes of a
+    machine, a sample decoded by one of them is mapped by the others instead of being decoded again.
+    Every sample is an uncompressed file in a RAM backed folder (/dev/shm), the arrays returned by get are copy on
+    write views of the mapped file, so all the consumers share the same pages.
+    A consumer holds a shared flock on the file for as long as an array of the sample is alive, which is its
+    reference, and the eviction of the least recently used files beyond max_bytes skips referenced files.
+    Like DiskSampleCache writes are atomic and the store is safe to use from any number of processes
+    '''
+    FILE_SUFFIX = '.sample'
+
+    def __init__(self, max_bytes, store_dir=DEFAULT_SHARED_DIR):
+        super(SharedSampleStore, self).__init__(store_dir, max_bytes)
+
+    def get(self, key):
+        '''
+        return: dict of the arrays given to put or None on a miss, the arrays keep the sample referenced
+        '''
+        path = self.get_path(key)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_COPY)
+            os.utime(path)
+        except (OSError, ValueError):
+            os.close(fd)
+            return None
+        # the reference is released when the last array of the sample is garbage collected
+        weakref.finalize(mapped, os.close, fd)
+        try:
+            header_size, = struct.unpack_from('<Q', mapped, 0)
+            header = json.loads(bytes(mapped[8:8 + header_size]).decode('utf-8'))
+            return {name: np.frombuffer(mapped, dtype=np.dtype(dtype), count=int(np.prod(shape)), offset=offset).reshape(shape)
+                    for name, (dtype, shape, offset) in header.items()}
+        except Exception as e:
+            print("WARNING: Removing corrupted shared sample [{}] [{}]".format(path, e))
+            self.remove(path)
+            return None
+
+    def put(self, key, **arrays):
+        '''
+        arrays - numpy arrays of the sample, stored as they are
+        '''
+        arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+        header = {}
+        offset = 0
+        for name, array in arrays.items():
+            header[name] = (array.dtype.str, array.shape, offset)
+            offset += -(-array.nbytes // SHARED_ALIGNMENT) * SHARED_ALIGNMENT
+        # the offsets are relative to the data, which starts after the header, so the header is encoded twice
+        header_size = len(json.dumps(header).encode('utf-8')) + 64
+        data_start = -(-(8 + header_size) // SHARED_ALIGNMENT) * SHARED_ALIGNMENT
+        header = {name: (dtype, shape, data_start + array_offset) for name, (dtype, shape, array_offset) in header.items()}
+        header_bytes = json.dumps(header).encode('utf-8').ljust(header_size)
+        assert len(header_bytes) == header_size
+        path = self.get_path(key)
+        tmp_path = "{}.tmp.{}.{}".format(path, os.getpid(), uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(struct.pack('<Q', header_size))
+                f.write(header_bytes)
+                for name, array in arrays.items():
+                    f.seek(header[name][2])
+                    f.write(array.tobytes())
+                # empty arrays at the end must still be within the mapped file
+                f.truncate(data_start + offset)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # a full store must not fail the training, the sample is just not shared
+            print("WARNING: Could not write shared sample [{}] [{}]".format(path, e))
+            self.remove(tmp_path)
+            return
+        self.written(data_start + offset)
+
+    def can_evict(self, path):
+        '''
+        return: False when a consumer still references the sample
+        '''
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+        finally:
+            os.close(fd)
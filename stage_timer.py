@@ -0,0 +1,155 @@
+import math
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import uuid
+from multiprocessing import util
+import numpy as np
+
+
+# histogram of latencies with 20 log spaced bins per decade between 1us and 100s, plus underflow and overflow bins
+MIN_LATENCY = 1e-6
+BINS_PER_DECADE = 20
+NUM_BINS = 8 * BINS_PER_DECADE + 2
+STATS_DIR_PREFIX = 'imat_stats_'
+
+
+def remove_stale_stats_dirs():
+    '''
+    Removes the folders left behind by runs that were killed before their exit handlers ran,
+    the pid of the process that created a folder is part of its name
+    '''
+    temp_dir = tempfile.gettempdir()
+    for dir_name in os.listdir(temp_dir):
+        if not dir_name.startswith(STATS_DIR_PREFIX):
+            continue
+        try:
+            pid = int(dir_name[len(STATS_DIR_PREFIX):].split('_')[0])
+        except ValueError:
+            continue
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            shutil.rmtree(os.path.join(temp_dir, dir_name), ignore_errors=True)
+        except OSError:
+            pass  # the process is alive but owned by another user
+
+
+class StageTimer:
+    '''
+    Collects the latency of pipeline stages (e.g. image load, mask decode) from all the DataLoader workers.
+    Every process accumulates counts, sums and a latency histogram per stage locally and flushes them to a file
+    of its own every flush_every seconds (and when the process exits), so there is no cross process locking
+    on the hot path. show_stats merges the files of all the processes.
+    '''
+    def __init__(self, stages, flush_every=5.0):
+        self.stages = list(stages)
+        self.stage_index = {stage: i for i, stage in enumerate(self.stages)}
+        self.flush_every = flush_every
+        remove_stale_stats_dirs()
+        self.stats_dir = tempfile.mkdtemp(prefix='{}{}_'.format(STATS_DIR_PREFIX, os.getpid()))
+        # only the process that created the timer removes the folder, when the interpreter exits (also on an
+        # uncaught exception) and after the last flush, which has a higher exitpriority
+        util.Finalize(None, shutil.rmtree, args=(self.stats_dir,), kwargs={'ignore_errors': True}, exitpriority=0)
+        self.pid = None
+        self.reset()
+
+    def reset(self):
+        '''
+        Starts accumulating for the current process, a forked worker must not report what its parent already did
+        '''
+        self.pid = os.getpid()
+        self.stats_file = os.path.join(self.stats_dir, '{}-{}.pkl'.format(self.pid, uuid.uuid4().hex))
+        self.counts = np.zeros((len(self.stages),), dtype=np.int64)
+        self.sums = np.zeros((len(self.stages),), dtype=np.float64)
+        self.histograms = np.zeros((len(self.stages), NUM_BINS), dtype=np.int64)
+        self.last_flush = time.time()
+        self.dirty = False
+        util.Finalize(None, self.flush, exitpriority=10)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pid'] = None  # a spawned worker starts with empty accumulators
+        return state
+
+    def record(self, stage, seconds):
+        if self.pid != os.getpid():
+            self.reset()
+        i = self.stage_index[stage]
+        self.counts[i] += 1
+        self.sums[i] += seconds
+        if seconds <= MIN_LATENCY:
+            self.histograms[i, 0] += 1
+        else:
+            self.histograms[i, min(int(math.log10(seconds / MIN_LATENCY) * BINS_PER_DECADE) + 1, NUM_BINS - 1)] += 1
+        self.dirty = True
+        if time.time() - self.last_flush > self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.dirty or self.pid != os.getpid():
+            return
+        tmp_file = self.stats_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump((self.stages, self.counts, self.sums, self.histograms), f)
+            os.replace(tmp_file, self.stats_file)
+            self.dirty = False
+        except OSError as e:
+            # the folder is gone when the process that created the timer has already exited
+            print("WARNING: Could not flush stage stats [{}]".format(e))
+
+    def merged(self):
+        '''
+        return: (counts, sums, histograms) of all the processes
+        '''
+        self.flush()
+        counts = np.zeros_like(self.counts)
+        sums = np.zeros_like(self.sums)
+        histograms = np.zeros_like(self.histograms)
+        for file_name in os.listdir(self.stats_dir):
+            if not file_name.endswith('.pkl'):
+                continue
+            try:
+                with open(os.path.join(self.stats_dir, file_name), 'rb') as f:
+                    stages, file_counts, file_sums, file_histograms = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue
+            assert stages == self.stages
+            counts += file_counts
+            sums += file_sums
+            histograms += file_histograms
+        return counts, sums, histograms
+
+    @staticmethod
+    def percentile(histogram, q):
+        '''
+        return: the upper edge of the histogram bin that holds the q-th percentile
+        '''
+        total = np.sum(histogram)
+        if total == 0:
+            return 0.0
+        b = int(np.searchsorted(np.cumsum(histogram), q / 100.0 * total))
+        return MIN_LATENCY * 10 ** (b / BINS_PER_DECADE)
+
+    def show_stats(self, total_stage):
+        '''
+        total_stage - the stage that times a whole sample, its count is the number of processed samples
+        '''
+        counts, sums, histograms = self.merged()
+        i = self.stage_index[total_stage]
+        images_processed = counts[i]
+        avg_time_per_image = 0 if images_processed == 0 else sums[i] / images_processed
+        print("Processed [{}] images in [{:.3f}] seconds Avg per image [{:.6f}]".format(images_processed, sums[i], avg_time_per_image))
+        for i, stage in enumerate(self.stages):
+            avg = 0 if counts[i] == 0 else sums[i] / counts[i]
+            print("  Stage [{}] count [{}] avg [{:.6f}] p50 [{:.6f}] p95 [{:.6f}] p99 [{:.6f}]".format(
+                stage,
+                counts[i],
+                avg,
+                StageTimer.percentile(histograms[i], 50),
+                StageTimer.percentile(histograms[i], 95),
+                StageTimer.percentile(histograms[i], 99)))
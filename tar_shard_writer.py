@@ -0,0 +1,199 @@
+import argparse
+import io
+import json
+import math
+import multiprocessing
+import os
+import tarfile
+import numpy as np
+import yaml
+
+import annotations
+import helpers
+import imat_dataset
+import train
+import transforms as T
+from h5py_dataset_writer import DatasetH5Writer
+
+
+parser = argparse.ArgumentParser(description='Writes the dataset as tar shards that are streamed sequentially')
+
+parser.add_argument('--data-limit', type=int, default=12500, metavar='DATA_LIMIT',
+                    help='Specify data limit, None to use all the data (default=12500)')
+parser.add_argument('--target-dim', type=int, default=512, metavar='DIM',
+                    help='Dimention of the images. It is vital that the image size will be devisiable by 2 at least 6 times (default=512)')
+parser.add_argument('--out-dir', type=str, default=None, metavar='DIR',
+                    help='Folder of the shards and their index, None for ../imaterialist_<target dim>_tar (default=None)')
+parser.add_argument('--samples-per-shard', type=int, default=1000, metavar='SAMPLES',
+                    help='Number of images in every shard, use at least as many shards as data loader workers (default=1000)')
+parser.add_argument('--chunk-size', type=int, default=20, metavar='CHUNK_SIZE',
+                    help='Number of images a worker processes and writes at once, bounds the memory of every worker (default=20)')
+parser.add_argument('--image-format', type=str, default='jpeg', choices=list(helpers.ENCODED_IMAGE_FORMATS.keys()), metavar='FORMAT',
+                    help='Encoding of the images, one of {} (default=jpeg)'.format(list(helpers.ENCODED_IMAGE_FORMATS.keys())))
+parser.add_argument('--jpeg-quality', type=int, default=95, metavar='QUALITY',
+                    help='Quality of the encoded images, only used with --image-format jpeg (default=95)')
+parser.add_argument('--num-workers', type=int, default=None, metavar='NUM_WORKERS',
+                    help='Number of processes that write shards, None for the CPU count (default=None)')
+parser.add_argument('--delete-existing', type=train.str2bool, default=False, metavar='BOOL',
+                    help='Write again shards that already exist, if False only the missing shards and the shards written from other images or parameters are written (default=False)')
+
+
+def parse_args():
+    # parse the args that are passed to this script
+    args = parser.parse_args()
+
+    # save the args as a text string so we can log them later
+    args_text = yaml.safe_dump(args.__dict__, default_flow_style=False)
+    return args, args_text
+
+
+def shard_file_name(shard, num_shards):
+    return "shard-{:05d}-of-{:05d}.tar".format(shard, num_shards)
+
+
+def add_to_tar(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def get_image_key(dataset, idx):
+    '''
+    return: the ImageId of the sample in index idx, or the index itself for datasets without image ids
+    '''
+    image_ids = getattr(dataset, 'image_ids', None)
+    if image_ids is None:
+        return str(idx)
+    return str(image_ids[idx])
+
+
+def read_shard_meta(shard_file):
+    '''
+    return: the metadata written next to a complete shard (shard_file + '.json'), None if there is no such shard
+    '''
+    meta_file = shard_file + '.json'
+    if not os.path.exists(shard_file) or not os.path.exists(meta_file):
+        return None
+    with open(meta_file, 'r') as f:
+        return json.load(f)
+
+
+# state of a shard writer process, set once by init_worker
+worker_state = None
+
+
+def init_worker(dataset, target_dim, chunk_size, image_format, jpeg_quality, delete_existing):
+    global worker_state
+    worker_state = (dataset, target_dim, chunk_size, image_format, jpeg_quality, delete_existing)
+
+
+def add_chunk_to_tar(tar, chunk, image_format, jpeg_quality):
+    '''
+    Adds the samples of a chunk returned by DatasetH5Writer.process_chunk with the ragged mask layout
+    '''
+    chunk_size, images, image_ids, labels_list, instances, _ = chunk
+    instance_counts, boxes, crops, bits = instances
+    instance_offsets = np.concatenate([[0], np.cumsum(instance_counts)]).astype(np.int64)
+    for i in range(chunk_size):
+        key = "{:08d}".format(image_ids[i])
+        sample_bits = bits[instance_offsets[i]:instance_offsets[i + 1]]
+        target = io.BytesIO()
+        np.savez(target,
+                 image_id=np.int64(image_ids[i]),
+                 labels=np.asarray(labels_list[i], dtype=np.int64),
+                 boxes=boxes[instance_offsets[i]:instance_offsets[i + 1]],
+                 mask_crops=crops[instance_offsets[i]:instance_offsets[i + 1]],
+                 mask_bit_offsets=np.concatenate([[0], np.cumsum([len(b) for b in sample_bits])]).astype(np.int64),
+                 mask_bits=np.concatenate(sample_bits) if len(sample_bits) > 0 else np.zeros((0,), dtype=np.uint8))
+        add_to_tar(tar, key + helpers.ENCODED_IMAGE_FORMATS[image_format], helpers.encode_image(images[i], image_format, jpeg_quality).tobytes())
+        add_to_tar(tar, key + '.npz', target.getvalue())
+
+
+def write_shard(shard_file, index_range):
+    '''
+    Writes the images of index_range as one tar, an image is the members <key>.jpg (or .png) and <key>.npz that
+    follow each other, where key is the index of the image in the dataset.
+    The shard is processed chunk_size images at a time and every chunk is added to the tar once it is ready, so a
+    worker holds one chunk of decoded images and not the whole shard.
+    The tar is written to a temporary file that is moved in place, so an existing shard is always complete. The
+    ImageIds the shard was written from and the parameters it was written with are recorded next to it, an existing
+    shard is only kept when both match, so a changed train.csv, data limit or split writes the shard again.
+    return: the ImageIds of the images in the shard, images that could not be processed are skipped
+    '''
+    dataset, target_dim, chunk_size, image_format, jpeg_quality, delete_existing = worker_state
+    params = {
+        'version': imat_dataset.TAR_SHARD_VERSION,
+        'target_dim': target_dim,
+        'image_format': image_format,
+        'jpeg_quality': jpeg_quality,
+    }
+    sources = [get_image_key(dataset, idx) for idx in range(index_range[0], index_range[1])]
+    meta_file = shard_file + '.json'
+    if not delete_existing:
+        meta = read_shard_meta(shard_file)
+        if meta is not None and meta['params'] == params and meta['sources'] == sources:
+            print("Shard [{}] exists, skipping it".format(shard_file))
+            return meta['image_keys']
+        if os.path.exists(shard_file):
+            print("Shard [{}] was written from other images or with other parameters, writing it again".format(shard_file))
+    image_keys = []
+    tmp_file = shard_file + '.tmp.' + str(os.getpid())
+    with tarfile.open(tmp_file, 'w') as tar:
+        for chunk_start in range(index_range[0], index_range[1], chunk_size):
+            chunk_indices = range(chunk_start, min(chunk_start + chunk_size, index_range[1]))
+            chunk = DatasetH5Writer.process_chunk(dataset, chunk_indices, target_dim, np.uint8, 'ragged')
+            add_chunk_to_tar(tar, chunk, image_format, jpeg_quality)
+            image_keys += [get_image_key(dataset, idx) for idx in chunk[2]]
+    if os.path.exists(meta_file):
+        # the metadata of the previous shard must not describe the new one if the process stops before it is replaced
+        os.remove(meta_file)
+    os.replace(tmp_file, shard_file)
+    annotations.write_json_atomic(meta_file, {'params': params, 'sources': sources, 'image_keys': image_keys})
+    print("Shard [{}] completed with [{}] images".format(shard_file, len(image_keys)))
+    return image_keys
+
+
+def write_tar_shards(dataset, target_dim, out_dir, samples_per_shard, image_format='jpeg', jpeg_quality=95, num_workers=None, delete_existing=False, chunk_size=20):
+    '''
+    Writes the dataset as tar shards of samples_per_shard images that are written in parallel, plus an index of the
+    shards, their lengths and the ImageIds of their images that IMATTarShardDataset reads
+    '''
+    dataset_len = dataset.__len__()
+    num_shards = math.ceil(dataset_len / samples_per_shard)
+    assert num_shards > 0, "The dataset is empty"
+    ranges = [(start, min(start + samples_per_shard, dataset_len)) for start in range(0, dataset_len, samples_per_shard)]
+    shard_files = [os.path.join(out_dir, shard_file_name(shard, num_shards)) for shard in range(num_shards)]
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    os.makedirs(out_dir, exist_ok=True)
+    print("Started writing [{}] images to [{}] shards in [{}]...".format(dataset_len, num_shards, out_dir))
+    with multiprocessing.Pool(max(min(num_workers, num_shards), 1), initializer=init_worker, initargs=(dataset, target_dim, chunk_size, image_format, jpeg_quality, delete_existing)) as pool:
+        shard_image_keys = pool.starmap(write_shard, zip(shard_files, ranges))
+    shard_lengths = [len(image_keys) for image_keys in shard_image_keys]
+    annotations.write_json_atomic(os.path.join(out_dir, imat_dataset.TAR_SHARD_INDEX), {
+        'version': imat_dataset.TAR_SHARD_VERSION,
+        'image_format': image_format,
+        'shard_files': [os.path.basename(shard_file) for shard_file in shard_files],
+        'shard_lengths': shard_lengths,
+        'shard_image_keys': shard_image_keys,
+    })
+    print("Folder [{}] completed with [{}] images in [{}] shards.".format(out_dir, sum(shard_lengths), num_shards))
+
+
+def main():
+    args, args_text = parse_args()
+    print("Args: {}".format(args_text))
+
+    main_folder_path = '../'
+    num_classes, train_df, test_df, categories_df = train.process_data(main_folder_path, args.data_limit)
+    # only the training set is streamed, evaluation reads the test set by index
+    dataset = imat_dataset.IMATDataset(main_folder_path, train_df, num_classes, args.target_dim, "effdet", False, T.get_transform(train=False), gather_statistics=False)
+    out_dir = args.out_dir
+    if out_dir is None:
+        out_dir = "../imaterialist_" + str(args.target_dim) + "_tar"
+    write_tar_shards(dataset, args.target_dim, out_dir, args.samples_per_shard, args.image_format, args.jpeg_quality, args.num_workers, args.delete_existing, args.chunk_size)
+    print("All done.")
+
+
+if __name__ == '__main__':
+    main()
@@ -31,6 +31,9 @@ import argparse
 import yaml
 import imat_dataset
 import visualize
+import annotations
+import chunk_sampler
+import sample_cache
 from datetime import datetime
 
 # imports for segmentation
@@ -125,6 +128,28 @@ parser.add_argument('--target-dim', type=int, default=512, metavar='DIM',
                     help='Dimention of the images. It is vital that the image size will be devisiable by 2 at least 6 times (default=512)')
 parser.add_argument('--h5py-dataset', type=str2bool, default=True, metavar='BOOL',
                     help='Use an H5PY dataset as created using h5py_dataset_writer.py (default=True)')
+parser.add_argument('--preprocessed-format', type=str, default='hdf5', choices=['hdf5', 'memmap', 'tar'], metavar='FORMAT',
+                    help='Format of the preprocessed dataset, hdf5, memmap as converted by memmap_dataset_writer.py or tar to stream the training set from the shards written by tar_shard_writer.py while the test set is read from hdf5, only used with --h5py-dataset true (default=hdf5)')
+parser.add_argument('--tar-shuffle-buffer', type=int, default=256, metavar='SAMPLES',
+                    help='Number of samples every data loader worker shuffles at once, on top of the shuffle of the shard order, only used with --preprocessed-format tar (default=256)')
+parser.add_argument('--h5py-chunk-cache-mb', type=int, default=64, metavar='MB',
+                    help='Size of the HDF5 chunk cache of every data loader worker, only used with --h5py-dataset true (default=64)')
+parser.add_argument('--chunk-shuffle-window', type=int, default=4, metavar='CHUNKS',
+                    help='Shuffle the H5PY dataset chunk by chunk, mixing the samples of this many chunks at a time, so that every chunk is read about once per epoch. 0 for a uniform shuffle, only used with --h5py-dataset true (default=4)')
+parser.add_argument('--reduced-jpeg-decode', type=str2bool, default=False, metavar='BOOL',
+                    help='Decode JPEG images at 1/2, 1/4 or 1/8 scale when still larger than target dim, only used with --h5py-dataset false (default=False)')
+parser.add_argument('--sample-cache-dir', type=str, default=None, metavar='DIR',
+                    help='Folder on a local disk that caches the decoded samples, so only the first epoch decodes the images and the masks, None to disable, only used with --h5py-dataset false (default=None)')
+parser.add_argument('--sample-cache-gb', type=float, default=20, metavar='GB',
+                    help='Size cap of the sample cache, the least recently used samples are evicted beyond it (default=20)')
+parser.add_argument('--shared-store-gb', type=float, default=0, metavar='GB',
+                    help='Size of a store of the decoded samples in shared memory, which every data loader worker and every training or evaluation process of the machine reads before decoding a sample, 0 to disable (default=0)')
+parser.add_argument('--shared-store-dir', type=str, default=sample_cache.DEFAULT_SHARED_DIR, metavar='DIR',
+                    help='RAM backed folder of the shared sample store, processes that use the same folder share the samples (default={})'.format(sample_cache.DEFAULT_SHARED_DIR))
+parser.add_argument('--skip-list', type=str, default=None, metavar='FILE',
+                    help='Skip list written by validate.py, its images are excluded from the datasets, None to use all the images (default=None)')
+parser.add_argument('--debug-samples', type=str2bool, default=False, metavar='BOOL',
+                    help='Check the masks, boxes and labels of every sample, validate.py runs these checks once instead (default=False)')
 parser.add_argument('--freeze-batch-norm-weights', type=str2bool, default=True, metavar='BOOL',
                     help='Freeze batch normalization weights (default=True)')
 
@@ -183,42 +208,43 @@ def print_nvidia_smi(device):
         print(stderr)
 
 
-def process_data(main_folder_path, data_limit):
+def process_data(main_folder_path, data_limit, use_annotation_cache=True):
+    '''
+    return: (num_classes, train_annotations, test_annotations, categories_df) where the annotations are
+            annotations.AnnotationIndex objects of the train and test images
+    '''
     allowed_classes = None  # np.array([0,1,6,9,10,20,23,24,31,32,33])
 
     with open(main_folder_path + '/Data/label_descriptions.json', 'r') as file:
         label_desc = json.load(file)
-    sample_sub_df = pd.read_csv(main_folder_path + '/Data/sample_submission.csv')
-    data_df = pd.read_csv(main_folder_path + '/Data/train.csv')
-    cut_data_df = data_df
-    if allowed_classes is not None:
-        print("Data is limited to segments for these class ids {} entires".format(allowed_classes))
-        cut_data_df = cut_data_df[cut_data_df['ClassId'].isin(allowed_classes)]
-        cut_data_df['ClassId'] = cut_data_df['ClassId'].apply(lambda x: np.where(allowed_classes == x)[0][0])
-
-    image_ids = cut_data_df['ImageId'].unique()
-    image_ids_cut = image_ids
+    if allowed_classes is None and use_annotation_cache:
+        # images are indexed in the order they appear in train.csv, so the splits below are contiguous slices
+        data_index = annotations.load_annotations(main_folder_path + '/Data/train.csv')
+        num_classes = len(np.unique(data_index.class_ids))
+    else:
+        data_df = pd.read_csv(main_folder_path + '/Data/train.csv')
+        cut_data_df = data_df
+        if allowed_classes is not None:
+            print("Data is limited to segments for these class ids {} entires".format(allowed_classes))
+            cut_data_df = cut_data_df[cut_data_df['ClassId'].isin(allowed_classes)]
+            cut_data_df['ClassId'] = cut_data_df['ClassId'].apply(lambda x: np.where(allowed_classes == x)[0][0])
+            num_classes = len(allowed_classes)
+        else:
+            num_classes = len(data_df['ClassId'].unique())
+        data_index = annotations.AnnotationIndex.from_df(cut_data_df)
 
+    image_count = len(data_index)
     if data_limit is not None:
         print("Data is limited to [{}] images".format(data_limit))
-        image_ids_cut = image_ids[:data_limit]
-
-    image_train_count = int(len(image_ids_cut) * 0.8)
-    image_ids_train = image_ids_cut[:image_train_count]
-    image_ids_test = image_ids_cut[image_train_count:]
-    assert len(image_ids_cut) == (len(image_ids_test) + len(image_ids_train))
-    cut_data_df = cut_data_df[cut_data_df['ImageId'].isin(image_ids_cut)]
-    train_df = cut_data_df[cut_data_df['ImageId'].isin(image_ids_train)]
-    test_df = cut_data_df[cut_data_df['ImageId'].isin(image_ids_test)]
-    assert len(cut_data_df) == (len(test_df) + len(train_df))
-
-    print("Train data size [{}] test data size [{}] (counting in segments)".format(len(train_df), len(test_df)))
+        image_count = min(image_count, data_limit)
+
+    image_train_count = int(image_count * 0.8)
+    train_annotations = data_index.slice(0, image_train_count)
+    test_annotations = data_index.slice(image_train_count, image_count)
+    assert image_count == (len(train_annotations) + len(test_annotations))
+
+    print("Train data size [{}] test data size [{}] (counting in segments)".format(train_annotations.num_segments(), test_annotations.num_segments()))
     print()
-    num_classes = None
-    if allowed_classes is None:
-        num_classes = len(data_df['ClassId'].unique())
-    else:
-        num_classes = len(allowed_classes)
     num_attributes = len(label_desc['attributes'])
     print_bold("Classes")
     categories_df = pd.DataFrame(label_desc['categories'])
@@ -236,8 +262,7 @@ def process_data(main_folder_path, data_limit):
     print(attributes_df.head())
     print(f'Total # of attributes: {num_attributes}')
     print()
-    train_df.head()
-    return num_classes, train_df, test_df, categories_df
+    return num_classes, train_annotations, test_annotations, categories_df
 
 
 # h5py
@@ -416,14 +441,33 @@ class Trainer:
         self.visualize = visualize.Visualize(self.main_folder_path, categories_df, self.target_dim, dest_folder='Images')
 
         # use our dataset and defined transformations
+        skip_list = None
+        if self.config.skip_list is not None:
+            skip_list = annotations.load_skip_list(self.config.skip_list, self.main_folder_path + '/Data/train.csv')
+        shared_store = None
+        if self.config.shared_store_gb > 0:
+            shared_store = sample_cache.SharedSampleStore(int(self.config.shared_store_gb * 2 ** 30), self.config.shared_store_dir)
         if self.config.h5py_dataset:
-            h5_reader = imat_dataset.DatasetH5Reader("../imaterialist_" + str(self.target_dim) + ".hdf5")
-            self.dataset = imat_dataset.IMATDatasetH5PY(h5_reader, self.num_classes, self.target_dim, self.config.model_name, T.get_transform(train=True))
-            h5_reader_test = imat_dataset.DatasetH5Reader("../imaterialist_test_" + str(self.target_dim) + ".hdf5")
-            self.dataset_test = imat_dataset.IMATDatasetH5PY(h5_reader_test, self.num_classes, self.target_dim, self.config.model_name, T.get_transform(train=False))
+            if self.config.preprocessed_format == 'tar':
+                index_file = os.path.join("../imaterialist_" + str(self.target_dim) + "_tar", imat_dataset.TAR_SHARD_INDEX)
+                self.dataset = imat_dataset.IMATTarShardDataset(index_file, self.num_classes, self.target_dim, self.config.model_name, T.get_transform(train=True), shuffle_buffer=self.config.tar_shuffle_buffer, skip_list=skip_list, debug=self.config.debug_samples)
+                if shared_store is not None:
+                    print("The training set is streamed from the tar shards, the shared store only holds the samples of the test set")
+            else:
+                h5_reader = self.get_preprocessed_reader("../imaterialist_" + str(self.target_dim))
+                self.dataset = imat_dataset.IMATDatasetH5PY(h5_reader, self.num_classes, self.target_dim, self.config.model_name, T.get_transform(train=True), shared_store=shared_store, skip_list=skip_list, debug=self.config.debug_samples)
+            h5_reader_test = self.get_preprocessed_reader("../imaterialist_test_" + str(self.target_dim))
+            self.dataset_test = imat_dataset.IMATDatasetH5PY(h5_reader_test, self.num_classes, self.target_dim, self.config.model_name, T.get_transform(train=False), shared_store=shared_store, skip_list=skip_list, debug=self.config.debug_samples)
+            if self.config.preprocessed_format != 'tar' and h5_reader.image_keys is not None and h5_reader_test.image_keys is not None:
+                # files that were appended to after the split of train.csv moved would evaluate on training images
+                overlap = np.intersect1d(h5_reader.image_keys, h5_reader_test.image_keys)
+                assert len(overlap) == 0, "[{}] images are in both the training and the test file, e.g. [{}], write both files again".format(len(overlap), overlap[0])
         else:
-            self.dataset = imat_dataset.IMATDataset(self.main_folder_path, self.train_df, self.num_classes, self.target_dim, self.config.model_name, False, T.get_transform(train=True))
-            self.dataset_test = imat_dataset.IMATDataset(self.main_folder_path, self.test_df, self.num_classes, self.target_dim, self.config.model_name, False, T.get_transform(train=False))
+            cache = None
+            if self.config.sample_cache_dir is not None:
+                cache = sample_cache.DiskSampleCache(self.config.sample_cache_dir, int(self.config.sample_cache_gb * 2 ** 30))
+            self.dataset = imat_dataset.IMATDataset(self.main_folder_path, self.train_df, self.num_classes, self.target_dim, self.config.model_name, False, T.get_transform(train=True), reduced_decode=self.config.reduced_jpeg_decode, sample_cache=cache, shared_store=shared_store, skip_list=skip_list, debug=self.config.debug_samples)
+            self.dataset_test = imat_dataset.IMATDataset(self.main_folder_path, self.test_df, self.num_classes, self.target_dim, self.config.model_name, False, T.get_transform(train=False), reduced_decode=self.config.reduced_jpeg_decode, sample_cache=cache, shared_store=shared_store, skip_list=skip_list, debug=self.config.debug_samples)
         
         # TODO(ofekp): do we need this?
         # split the dataset in train and test set
@@ -517,17 +561,61 @@ class Trainer:
         with open(self.log_file_path, 'a+') as logger:
             logger.write(f'{message}\n')
 
+    def get_preprocessed_reader(self, path_prefix):
+        '''
+        return: a reader of the preprocessed dataset at path_prefix in the format set by --preprocessed-format, the
+                tar shards are not read by index so they use the hdf5 reader
+        '''
+        if self.config.preprocessed_format == 'memmap':
+            return imat_dataset.DatasetMemmapReader(path_prefix + "_memmap")
+        return imat_dataset.DatasetH5Reader(path_prefix + ".hdf5", rdcc_nbytes=self.config.h5py_chunk_cache_mb * 2 ** 20)
+
+    def get_train_sampler(self):
+        '''
+        return: a ChunkShuffleSampler for the H5PY dataset or None for a uniform shuffle
+        '''
+        # memory-mapped samples are read on their own, a uniform shuffle reads every byte once
+        if not self.config.h5py_dataset or self.config.preprocessed_format != 'hdf5' or self.config.chunk_shuffle_window <= 0:
+            return None
+        reader = self.dataset.dataset_h5py_reader
+        sampler = chunk_sampler.ChunkShuffleSampler(len(self.dataset), reader.chunk_rows, window_chunks=self.config.chunk_shuffle_window)
+        cache_chunks = reader.get_cache_chunks()
+        if cache_chunks < self.config.chunk_shuffle_window:
+            self.log("WARNING: The chunk cache holds [{}] chunks, less than the shuffle window of [{}] chunks, consider a larger --h5py-chunk-cache-mb".format(
+                cache_chunks, self.config.chunk_shuffle_window))
+        uniform_order = np.random.permutation(len(self.dataset))
+        self.log("Chunk shuffle window [{}] chunks of [{}] images, estimated read amplification [{:.2f}x] (uniform shuffle [{:.2f}x])".format(
+            self.config.chunk_shuffle_window,
+            reader.chunk_rows,
+            chunk_sampler.read_amplification(sampler.get_order(), reader.chunk_rows, cache_chunks, self.config.batch_size, self.config.num_workers),
+            chunk_sampler.read_amplification(uniform_order, reader.chunk_rows, cache_chunks, self.config.batch_size, self.config.num_workers)))
+        return sampler
+
     def train(self):
         # define training and validation data loaders
-        data_loader = torch.utils.data.DataLoader(
-            self.dataset, batch_size=self.config.batch_size, shuffle=True, num_workers=self.config.num_workers,
-            collate_fn=utils.collate_fn)
+        if isinstance(self.dataset, torch.utils.data.IterableDataset):
+            # the dataset shuffles its shards and samples itself
+            _, world_size = imat_dataset.IMATTarShardDataset.get_rank()
+            num_readers = max(self.config.num_workers, 1) * world_size
+            if num_readers > len(self.dataset.shard_files):
+                self.log("WARNING: [{}] data loader workers share [{}] shards, the workers read parts of the same shards, write more shards".format(
+                    num_readers, len(self.dataset.shard_files)))
+            data_loader = torch.utils.data.DataLoader(
+                self.dataset, batch_size=self.config.batch_size, num_workers=self.config.num_workers,
+                collate_fn=utils.collate_fn)
+        else:
+            sampler = self.get_train_sampler()
+            data_loader = torch.utils.data.DataLoader(
+                self.dataset, batch_size=self.config.batch_size, shuffle=sampler is None, sampler=sampler, num_workers=self.config.num_workers,
+                collate_fn=utils.collate_fn)
 
         data_loader_test = torch.utils.data.DataLoader(
             self.dataset_test, batch_size=self.config.batch_size, shuffle=False, num_workers=self.config.num_workers,
             collate_fn=utils.collate_fn)
 
         for _ in range(self.config.num_epochs):
+            if hasattr(self.dataset, 'set_epoch'):
+                self.dataset.set_epoch(self.epoch)
             # tarin one epoch
             metric_logger = engine.train_one_epoch(
                 self.model,
@@ -571,6 +659,17 @@ class TrainConfig:
             self.model_file_suffix = args.model_file_suffix
         self.model_file_prefix = args.model_file_prefix
         self.h5py_dataset = args.h5py_dataset
+        self.preprocessed_format = args.preprocessed_format
+        self.tar_shuffle_buffer = args.tar_shuffle_buffer
+        self.h5py_chunk_cache_mb = args.h5py_chunk_cache_mb
+        self.chunk_shuffle_window = args.chunk_shuffle_window
+        self.reduced_jpeg_decode = args.reduced_jpeg_decode
+        self.sample_cache_dir = args.sample_cache_dir
+        self.sample_cache_gb = args.sample_cache_gb
+        self.shared_store_gb = args.shared_store_gb
+        self.skip_list = args.skip_list
+        self.debug_samples = args.debug_samples
+        self.shared_store_dir = args.shared_store_dir
         self.verbose = True
         self.save_every = args.save_every
         self.eval_every = args.eval_every
@@ -233,6 +233,11 @@ class MetricLogger(object):
 
 
 def collate_fn(batch):
+    # IMATDataset returns None for an image it could not process, run validate.py to exclude such images up front
+    batch = [sample for sample in batch if sample is not None]
+    if len(batch) == 0:
+        # an empty batch would only fail later when it is unpacked into images and targets
+        raise ValueError("None of the images of the batch could be processed, run validate.py and train with --skip-list")
     return tuple(zip(*batch))
 
 
@@ -0,0 +1,188 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+import torch
+import yaml
+from PIL import Image
+
+import annotations
+import common
+import helpers
+import train
+
+
+parser = argparse.ArgumentParser(description='Validates the annotations and the images of the dataset once, writing a skip list of the bad images')
+
+parser.add_argument('--main-folder-path', type=str, default='../', metavar='DIR',
+                    help='Folder that holds the Data folder (default=../)')
+parser.add_argument('--target-dim', type=int, default=512, metavar='DIM',
+                    help='Dimention the masks are decoded at, as in training (default=512)')
+parser.add_argument('--check-images', type=train.str2bool, default=True, metavar='BOOL',
+                    help='Also open every image and compare its size to the annotations (default=True)')
+parser.add_argument('--num-workers', type=int, default=None, metavar='NUM_WORKERS',
+                    help='Number of processes that validate the images, None for the CPU count (default=None)')
+parser.add_argument('--block-size', type=int, default=256, metavar='IMAGES',
+                    help='Number of images a worker validates at once (default=256)')
+parser.add_argument('--skip-list', type=str, default=None, metavar='FILE',
+                    help='Output skip list, None for Data/skip_list.json in the main folder (default=None)')
+parser.add_argument('--stats-file', type=str, default=None, metavar='FILE',
+                    help='Output statistics report, None for Data/validation_stats.json in the main folder (default=None)')
+
+
+def parse_args():
+    # parse the args that are passed to this script
+    args = parser.parse_args()
+
+    # save the args as a text string so we can log them later
+    args_text = yaml.safe_dump(args.__dict__, default_flow_style=False)
+    return args, args_text
+
+
+def validate_annotations(annotation_index, idx, target_dim, num_classes):
+    '''
+    Runs the checks IMATDataset runs on every sample in debug mode, on the masks and boxes it would train on
+    return: (reasons, num_segments, num_empty_masks) where reasons lists why the image must be skipped
+    '''
+    reasons = []
+    class_ids = annotation_index.get_labels(idx)
+    num_segments = len(class_ids)
+    if num_segments > 0 and (torch.min(class_ids) < 0 or torch.max(class_ids) >= num_classes):
+        reasons.append('label_out_of_range')
+    try:
+        runs = annotation_index.get_runs(idx, target_dim=target_dim)
+        masks = helpers.decode_runs(runs)
+    except Exception as e:
+        return reasons + ['mask_error: {!r}'.format(e)], num_segments, 0
+    if masks.size > 0 and masks.max() > 1:
+        reasons.append('mask_not_binary')
+    boxes, _, keep = helpers.get_boxes_from_runs(runs)
+    if torch.any(torch.isnan(boxes)):
+        reasons.append('box_nan')
+    num_empty_masks = int(len(keep) - torch.sum(keep))
+    if num_empty_masks == num_segments:
+        reasons.append('no_instances')
+    return reasons, num_segments, num_empty_masks
+
+
+def validate_image(image_path, height, width):
+    '''
+    Decodes the image at a reduced scale, which is enough to find missing, truncated and mislabeled files
+    return: the reasons the image must be skipped
+    '''
+    if not os.path.exists(image_path):
+        return ['image_missing']
+    try:
+        with Image.open(image_path) as image:
+            if image.size != (width, height):
+                return ['image_size_mismatch']
+            image.draft('RGB', (max(width // 8, 1), max(height // 8, 1)))
+            image.load()
+    except Exception as e:
+        return ['image_unreadable: {}'.format(e)]
+    return []
+
+
+# state of a validation process, set once by init_worker
+worker_state = None
+
+
+def init_worker(annotation_index, main_folder_path, target_dim, num_classes, check_images):
+    global worker_state
+    worker_state = (annotation_index, main_folder_path, target_dim, num_classes, check_images)
+
+
+def validate_block(positions):
+    '''
+    return: a list of (image_id, reasons, num_segments, num_empty_masks, height, width) per image
+    '''
+    annotation_index, main_folder_path, target_dim, num_classes, check_images = worker_state
+    results = []
+    for idx in positions:
+        image_id = str(annotation_index.image_ids[idx])
+        height, width = annotation_index.get_height_and_width(idx)
+        reasons, num_segments, num_empty_masks = validate_annotations(annotation_index, idx, target_dim, num_classes)
+        if check_images:
+            reasons += validate_image(common.get_image_path(main_folder_path, image_id, False), height, width)
+        results.append((image_id, reasons, num_segments, num_empty_masks, height, width))
+    return results
+
+
+def describe(values):
+    if len(values) == 0:
+        return {}
+    return {'min': int(np.min(values)), 'mean': float(np.mean(values)), 'max': int(np.max(values))}
+
+
+def validate(annotation_index, main_folder_path, target_dim, num_classes, check_images=True, num_workers=None, block_size=256):
+    '''
+    Validates all the images of the index in parallel
+    return: (skipped, stats) where skipped maps the ImageId of every bad image to the reasons it is skipped
+    '''
+    start = time.time()
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    blocks = [range(start_idx, min(start_idx + block_size, len(annotation_index))) for start_idx in range(0, len(annotation_index), block_size)]
+    skipped = {}
+    reason_counts = {}
+    num_segments = np.zeros((len(annotation_index),), dtype=np.int64)
+    num_empty_masks = 0
+    heights = []
+    widths = []
+    with multiprocessing.Pool(max(num_workers, 1), initializer=init_worker, initargs=(annotation_index, main_folder_path, target_dim, num_classes, check_images)) as pool:
+        for block_idx, results in enumerate(pool.imap_unordered(validate_block, blocks)):
+            for image_id, reasons, image_segments, image_empty_masks, height, width in results:
+                num_segments[len(heights)] = image_segments
+                num_empty_masks += image_empty_masks
+                heights.append(height)
+                widths.append(width)
+                if len(reasons) == 0:
+                    continue
+                skipped[image_id] = reasons
+                for reason in reasons:
+                    reason = reason.split(':')[0]
+                    reason_counts[reason] = reason_counts.get(reason, 0) + 1
+            print("Validated blocks [{}/{}] skipped [{}] images".format(block_idx + 1, len(blocks), len(skipped)))
+    stats = {
+        'num_images': len(annotation_index),
+        'num_skipped': len(skipped),
+        'reasons': reason_counts,
+        'num_segments': int(np.sum(num_segments)),
+        'num_empty_masks': num_empty_masks,
+        'segments_per_image': describe(num_segments),
+        'height': describe(heights),
+        'width': describe(widths),
+        'target_dim': target_dim,
+        'seconds': time.time() - start,
+    }
+    return skipped, stats
+
+
+def main():
+    args, args_text = parse_args()
+    print("Args: {}".format(args_text))
+
+    csv_path = args.main_folder_path + '/Data/train.csv'
+    with open(args.main_folder_path + '/Data/label_descriptions.json', 'r') as file:
+        num_classes = len(json.load(file)['categories'])
+    annotation_index = annotations.load_annotations(csv_path)
+    skipped, stats = validate(annotation_index, args.main_folder_path, args.target_dim, num_classes, args.check_images, args.num_workers, args.block_size)
+
+    skip_list_path = args.skip_list or os.path.join(args.main_folder_path, 'Data', 'skip_list.json')
+    stats_path = args.stats_file or os.path.join(args.main_folder_path, 'Data', 'validation_stats.json')
+    annotations.write_json_atomic(skip_list_path, {
+        'version': annotations.SKIP_LIST_VERSION,
+        'csv_sha1': annotations.file_sha1(csv_path),
+        'target_dim': args.target_dim,
+        'skipped': skipped,
+    })
+    annotations.write_json_atomic(stats_path, stats)
+    print("Skipped [{}] of [{}] images, skip list [{}] statistics [{}]".format(len(skipped), len(annotation_index), skip_list_path, stats_path))
+    print(json.dumps(stats, indent=2))
+    print("All done.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,13 @@
 import bounding_box as bbx
 import numpy as np
 import helpers
-from PIL import Image
 from datetime import datetime
 import os
 import torch
 import matplotlib.pyplot as plt
 import imat_dataset
 import common
+import annotations
 import math
 
 font = bbx.get_font_with_size(10)
@@ -18,6 +18,8 @@ class Visualize:
         self.target_dim = target_dim
         self.categories_df = categories_df
         self.dest_folder = dest_folder
+        self.annotation_df = None
+        self.annotation_index = None
 
 
     # generate a map from the class id to the label
@@ -51,16 +53,28 @@ class Visualize:
         return image_with_bb
 
 
+    def get_annotation_index(self, data_df):
+        '''
+        The index is built once per DataFrame and reused by the following calls
+        '''
+        if isinstance(data_df, annotations.AnnotationIndex):
+            return data_df
+        if self.annotation_df is not data_df:
+            self.annotation_index = annotations.AnnotationIndex.from_df(data_df)
+            self.annotation_df = data_df
+        return self.annotation_index
+
+
     def show_image_data_ground_truth(self, data_df, image_id, is_colab, figsize=(40, 40)):
         # Get the an image id given in the training set for visualization
-        vis_df = data_df[data_df['ImageId'] == image_id]
-        vis_df = vis_df.reset_index(drop=True)
-        class_ids = helpers.get_labels(vis_df)
-        masks = helpers.get_masks(vis_df, target_dim=self.target_dim)
-        bounding_boxes = helpers.get_bounding_boxes(vis_df, masks)
-        class_ids, masks, bounding_boxes = helpers.remove_empty_masks(class_ids, masks, bounding_boxes)
-        img = Image.open(common.get_image_path(self.main_folder_path, image_id, is_colab)).convert("RGB")
-        img = helpers.rescale(img, target_dim=self.target_dim)
+        annotation_index = self.get_annotation_index(data_df)
+        idx = annotation_index.get_position(image_id)
+        class_ids = annotation_index.get_labels(idx)
+        runs = annotation_index.get_runs(idx, target_dim=self.target_dim)
+        masks = torch.from_numpy(helpers.decode_runs(runs))
+        bounding_boxes, _, keep = helpers.get_boxes_from_runs(runs)
+        class_ids, masks, bounding_boxes = helpers.remove_empty_masks(class_ids, masks, bounding_boxes, keep)
+        img, _ = helpers.load_image(common.get_image_path(self.main_folder_path, image_id, is_colab), self.target_dim)
         self.show_image_data(img, class_ids, masks, bounding_boxes, figsize=figsize)
 
 
@@ -170,8 +184,8 @@ class Visualize:
         masks = prediction[0]['masks'][:, 0]
         if show_groud_truth:
             if isinstance(dataset, imat_dataset.IMATDatasetH5PY):
-                image_ids = dataset_df['ImageId'].unique()
-                image_id = dataset.dataset_h5py_reader.get_image_id(img_idx)
+                image_ids = self.get_annotation_index(dataset_df).image_ids
+                image_id = dataset.get_image_id(img_idx)
                 print(image_id)
                 self.show_image_data_ground_truth(dataset_df, image_ids[image_id], is_colab)
             else: